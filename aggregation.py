@@ -1,22 +1,35 @@
 import blechpy
 import os
+import json
+import hashlib
+import shutil
+import functools
+from collections import Counter, defaultdict
 import numpy as np
 import pandas as pd
 from tqdm import tqdm
 from sklearn.decomposition import PCA
 from scipy.ndimage.filters import gaussian_filter1d
 from scipy.stats import sem
+from scipy.optimize import linear_sum_assignment
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
 from blechpy import project, experiment, dataset, load_dataset, load_experiment
 from blechpy.analysis import held_unit_analysis as hua
 from blechpy.analysis import spike_analysis as sas
 from blechpy.dio import h5io
 from blechpy.utils import print_tools as pt
+import data_cache as dc
+import worker_budget as wb
 from collections.abc import Mapping
 
 
 PAL_MAP = {'Spont': -1, 'Suc': 1, 'QHCl': 4,
            'CA': 3, 'NaCl': 2}
 
+# cap on the number of waveforms per unit used for J3, see subsample_waves
+MAX_J3_WAVES = 20000
+
 ELECTRODES_IN_GC = {'DS31':'both','DS33':'both','DS36':'both','DS39':'both','DS40':'both', 'DS41':'both', 'DS41':'both', 'DS42':'both','DS44':'both','DS45':'both','DS46':'both','DS47':'both'}
 
 
@@ -77,61 +90,231 @@ def get_all_units(proj):
 
     return all_units
 
-def find_held_units(proj, percent_criterion=95, raw_waves=False):
-    all_units = get_all_units(proj)
-    sing_units = all_units[all_units['single_unit']==True]
-    sing_units['intra_J3'] = sing_units.apply(lambda x: get_unit_J3(x['rec_dir'],
-                                                                    x['unit_name'],
-                                                                    raw_waves=raw_waves),
-                                              axis=1)
-    all_units.loc[sing_units.index, 'intra_J3'] = sing_units['intra_J3']
-    threshold = np.percentile(sing_units['intra_J3'], percent_criterion)
-    rec_dirs = sing_units['rec_dir'].unique().tolist()
+HELD_COLUMNS = ['rec1', 'unit1', 'rec2', 'unit2',
+                'inter_J3', 'held', 'held_unit_name', 'exp_group', 'rec_num','time_group', 'exp_name']
+
+
+def held_unit_jobs(sing_units):
+    '''splits held-unit detection into independent jobs, one per animal and
+    electrode: the intra J3 of the electrode's single units in every
+    recording and the inter J3 of each pair of consecutive recordings. A job
+    covers all recordings of the electrode so each unit's waveforms are
+    loaded only once
 
-    # Loop through animal, electrode, rec pairs
+    Parameters
+    ----------
+    sing_units : pd.DataFrame, single units from get_all_units
+
+    Returns
+    -------
+    list of dict with exp_name, electrode and recs, a list of (rec_num, units)
+    in recording order where units is a list of (rec_dir, unit_name)
+    '''
+    jobs = []
+    for (anim, electrode), group in sing_units.groupby(['exp_name', 'electrode']):
+        recs = []
+        for rec_num in sorted(group.rec_num.unique()):
+            g1 = group[group.rec_num == rec_num]
+            recs.append((rec_num, list(zip(g1.rec_dir, g1.unit_name))))
+        jobs.append({'exp_name': anim, 'electrode': electrode, 'recs': recs})
+    return jobs
+
+
+def run_held_unit_job(job, raw_waves=False, max_waves=MAX_J3_WAVES, seed=0):
+    '''runs a job from held_unit_jobs. Each recording's waveforms are loaded
+    for its intra J3 pass and dropped straight after; the inter J3 matrices
+    are then computed from the cached per-unit stats
+
+    Returns
+    -------
+    list of dict, one per recording, with exp_name, electrode, rec_num,
+    units1 (the recording's units), units2 (units of the next recording),
+    intra_J3 (one value per unit in units1) and inter_J3 (units1 x units2)
+    '''
+    stores = {rec_dir: WaveformStore(rec_dir, raw_waves=raw_waves, max_waves=max_waves, seed=seed)
+              for _, units in job['recs'] for rec_dir, _ in units}
+    intra_J3 = []
+    for rec_num, units in job['recs']:
+        intra_J3.append(np.array([stores[rec_dir].unit_J3(unit) for rec_dir, unit in units]))
+        for rec_dir in set(rec_dir for rec_dir, _ in units):
+            stores[rec_dir].clear_waves()
+
+    results = []
+    for k, (rec_num, units1) in enumerate(job['recs']):
+        units2 = job['recs'][k + 1][1] if k + 1 < len(job['recs']) else []
+        if len(units2) > 0:
+            print('Comparing %i units of %s vs %i units of %s on electrode %s'
+                  % (len(units1), os.path.basename(units1[0][0]),
+                     len(units2), os.path.basename(units2[0][0]), job['electrode']))
+            inter_J3 = get_inter_J3_matrix(units1, units2, stores)
+        else:
+            inter_J3 = np.zeros((len(units1), 0))
+        results.append({'exp_name': job['exp_name'], 'electrode': job['electrode'], 'rec_num': rec_num,
+                        'units1': units1, 'units2': units2, 'intra_J3': intra_J3[k], 'inter_J3': inter_J3})
+    return results
+
+
+def held_unit_key(sing_units):
+    '''hash of an animal's sorted (rec_dir, unit_name) list, so saved parts
+    are not reused after units were added or re-sorted'''
+    units = sorted(zip(sing_units['rec_dir'].astype(str), sing_units['unit_name'].astype(str)))
+    return hashlib.sha1(json.dumps(units).encode()).hexdigest()
+
+
+def held_unit_tables(sing_units, results):
+    '''collects the job results of one animal into a table of intra J3 per
+    unit and a table of candidate held-unit pairs (HELD_COLUMNS)'''
+    intra = pd.DataFrame([(rec_dir, unit, J3) for res in results
+                          for (rec_dir, unit), J3 in zip(res['units1'], res['intra_J3'])],
+                         columns=['rec_dir', 'unit_name', 'intra_J3'])
+    J3_mats = {(res['electrode'], res['rec_num']): res['inter_J3'] for res in results}
+
+    # Loop through electrode, rec pairs
     # Store rec1, el1, unit1, rec2, el2, unit2, interJ3, held, held_unit_name
-    held_df = pd.DataFrame(columns=['rec1', 'unit1', 'rec2', 'unit2',
-                                    'inter_J3', 'held', 'held_unit_name', 'exp_group', 'rec_num','time_group', 'exp_name'])
-    for group_name, group in sing_units.groupby(['exp_name', 'electrode']):
-        anim = group_name[0]
-        electrode = group_name[1]
-        
+    held_rows = []
+    for electrode, group in sing_units.groupby('electrode'):
         rec_order = sorted(group.rec_num.unique())
         for i, row in group.iterrows():
-            rec_group = row['rec_group']
             rec1 = row['rec_dir']
-            rec_name1 = row['rec_name']
             unit1 = row['unit_name']
-            #reg_spike = row['regular_spiking']
-            #fast_spike = row['fast_spiking']
             rec_num = row['rec_num']
-            time_group = row['time_group']
-            
+
             idx = rec_order.index(rec_num)
-            
+
             if idx == len(rec_order)-1:
                 continue
 
             next_group = rec_order[idx+1]
-            g2 = group.query('rec_num == @next_group')# and '
-                             #'regular_spiking == @reg_spike and '
-                             #'fast_spiking == @fast_spike')
+            g2 = group[group.rec_num == next_group]
             if g2.empty:
                 continue
 
-            for j, row2 in g2.iterrows():
-                rec2 = row2['rec_dir']
-                unit2 = row2['unit_name']
-                rec_name2 = row2['rec_name']
-                print('Comparing %s %s vs %s %s' % (rec_name1, unit1,
-                                                    rec_name2, unit2))
-                J3 = get_inter_J3(rec1, unit1, rec2, unit2, raw_waves=raw_waves)
-                held_df = held_df.append({'rec1': rec1, 'unit1': unit1,
-                                          'rec2': rec2, 'unit2': unit2,
-                                          'inter_J3': J3, 'exp_group': row['exp_group'],
-                                          'exp_name': anim},
-                                         ignore_index=True)
+            row_J3 = J3_mats[(electrode, rec_num)][list(group.index[group.rec_num == rec_num]).index(i)]
+            for j, row2 in enumerate(g2.itertuples()):
+                held_rows.append({'rec1': rec1, 'unit1': unit1,
+                                  'rec2': row2.rec_dir, 'unit2': row2.unit_name,
+                                  'inter_J3': row_J3[j], 'exp_group': row['exp_group'],
+                                  'exp_name': row['exp_name']})
+    return intra, pd.DataFrame(held_rows, columns=HELD_COLUMNS)
+
+
+def write_feather_atomic(df, path):
+    df.reset_index(drop=True).to_feather(path + '.tmp')
+    os.replace(path + '.tmp', path)
 
+
+def open_held_unit_parts(part_dir, settings, unit_keys):
+    '''loads the per-animal results saved by find_held_units in part_dir.
+    Parts saved with other settings are removed, and so are the parts of an
+    animal whose units changed since they were saved.
+
+    Parameters
+    ----------
+    part_dir : str
+    settings : dict, J3 settings (raw_waves, max_waves, seed)
+    unit_keys : dict of exp_name -> held_unit_key of the animal's units
+
+    Returns
+    -------
+    dict of exp_name -> (intra, pairs) as returned by held_unit_tables
+    '''
+    os.makedirs(part_dir, exist_ok=True)
+    settings_file = os.path.join(part_dir, 'settings.json')
+    saved_keys = {}
+    if os.path.isfile(settings_file):
+        with open(settings_file, 'r') as f:
+            saved = json.load(f)
+        saved_keys = saved.pop('units', {})
+        if saved != settings:
+            print('held unit parts in %s were computed with %s, recomputing' % (part_dir, saved))
+            shutil.rmtree(part_dir)
+            os.makedirs(part_dir)
+            saved_keys = {}
+
+    parts = {}
+    for fn in os.listdir(part_dir):
+        if not fn.endswith('_held_pairs.feather'):
+            continue
+        anim = fn[:-len('_held_pairs.feather')]
+        intra_file = os.path.join(part_dir, anim + '_intra_J3.feather')
+        if saved_keys.get(anim) != unit_keys.get(anim):
+            print('units of %s changed since its held unit results were saved, recomputing' % anim)
+            for path in [intra_file, os.path.join(part_dir, fn)]:
+                if os.path.isfile(path):
+                    os.remove(path)
+        elif os.path.isfile(intra_file):
+            parts[anim] = (pd.read_feather(intra_file), pd.read_feather(os.path.join(part_dir, fn)))
+
+    with open(settings_file, 'w') as f:
+        json.dump(dict(settings, units=unit_keys), f)
+    return parts
+
+
+def find_held_units(proj, percent_criterion=95, raw_waves=False, max_waves=MAX_J3_WAVES, seed=0, n_jobs=-1,
+                    part_dir=None):
+    '''finds units held across consecutive recordings of each animal
+
+    The J3 calculations run as independent jobs, one per animal and
+    electrode (see held_unit_jobs), on a
+    process pool within the worker budget (worker_budget). With part_dir set,
+    the intra J3 values and candidate pairs of each animal are written there
+    as soon as all of its jobs finish, and animals already saved there are
+    skipped, so an interrupted run picks up where it stopped.
+
+    Returns
+    -------
+    all_units : pd.DataFrame, with intra_J3 and held_unit_name
+    held_df : pd.DataFrame, candidate pairs with inter_J3, held and
+        held_unit_name
+    '''
+    all_units = get_all_units(proj)
+    sing_units = all_units[all_units['single_unit']==True]
+
+    if part_dir is None:
+        parts = {}
+    else:
+        unit_keys = {anim: held_unit_key(units) for anim, units in sing_units.groupby('exp_name')}
+        parts = open_held_unit_parts(part_dir, {'raw_waves': bool(raw_waves), 'max_waves': max_waves,
+                                                'seed': seed}, unit_keys)
+        if len(parts) > 0:
+            print('found held unit results for %s' % ', '.join(sorted(parts)))
+
+    jobs = [job for job in held_unit_jobs(sing_units) if job['exp_name'] not in parts]
+    n_left = Counter(job['exp_name'] for job in jobs)
+    results = defaultdict(list)
+    func = functools.partial(run_held_unit_job, raw_waves=raw_waves, max_waves=max_waves, seed=seed)
+
+    def collect(res):
+        anim = res[0]['exp_name']
+        results[anim].extend(res)
+        n_left[anim] -= 1
+        if n_left[anim] == 0:
+            parts[anim] = held_unit_tables(sing_units[sing_units['exp_name'] == anim], results.pop(anim))
+            if part_dir is not None:
+                # pairs are written last, so a saved pairs file means the animal is done
+                write_feather_atomic(parts[anim][0], os.path.join(part_dir, anim + '_intra_J3.feather'))
+                write_feather_atomic(parts[anim][1], os.path.join(part_dir, anim + '_held_pairs.feather'))
+            print('held unit J3 done for %s' % anim)
+
+    if wb.get_n_jobs(n_jobs, len(jobs)) > 1:
+        with wb.Pool(n_jobs, n_tasks=len(jobs)) as pool:
+            for res in pool.imap_unordered(func, jobs):
+                collect(res)
+    else:
+        for job in jobs:
+            collect(func(job))
+
+    anims = sorted(parts)
+    if len(anims) == 0:
+        raise ValueError('No single units found')
+    intra = pd.concat([parts[anim][0] for anim in anims], ignore_index=True)
+    intra = intra.set_index(['rec_dir', 'unit_name'])['intra_J3']
+    sing_units['intra_J3'] = intra.reindex(pd.MultiIndex.from_frame(sing_units[['rec_dir', 'unit_name']])).to_numpy()
+    all_units.loc[sing_units.index, 'intra_J3'] = sing_units['intra_J3']
+    threshold = np.percentile(sing_units['intra_J3'], percent_criterion)
+    rec_dirs = sing_units['rec_dir'].unique().tolist()
+
+    held_df = pd.concat([parts[anim][1] for anim in anims], ignore_index=True)
     new_held_df = None
     for group_name, group in held_df.groupby('exp_group'):
         thresh = np.percentile(sing_units.query('exp_group == @group_name')['intra_J3'],
@@ -142,7 +325,7 @@ def find_held_units(proj, percent_criterion=95, raw_waves=False):
         else:
             max_num = new_held_df['held_unit_name'].max()
             tmp['held_unit_name'] = tmp['held_unit_name'] + max_num
-            new_held_df = new_held_df.append(tmp, ignore_index=True).reset_index(drop=True)
+            new_held_df = pd.concat([new_held_df, tmp], ignore_index=True)
 
     #held_df = resolve_matches(held_df, threshold)
     if new_held_df is not None:
@@ -169,13 +352,15 @@ def find_held_units(proj, percent_criterion=95, raw_waves=False):
     # Plot J3 distributions
     # Save dataframes
 
-def get_inter_J3(rec1, unit1, rec2, unit2, raw_waves=False):
+def get_inter_J3(rec1, unit1, rec2, unit2, raw_waves=False, max_waves=None, seed=0):
     if raw_waves:
         wf1, descrip1, fs1 = h5io.get_raw_unit_waveforms(rec1, unit1)
         wf2, descrip2, fs2 = h5io.get_raw_unit_waveforms(rec2, unit2)
     else:
         wf1, descrip1, fs1 = h5io.get_unit_waveforms(rec1, unit1)
         wf2, descrip2, fs2 = h5io.get_unit_waveforms(rec2, unit2)
+    wf1 = subsample_waves(wf1, max_waves, seed=seed)
+    wf2 = subsample_waves(wf2, max_waves, seed=seed)
     
     if wf1.shape[1] != wf2.shape[1]:
         print('warning: different length spike snapshots, trimming to match. Consider re-clustering & sorting with equal snapshot lengths')
@@ -222,12 +407,13 @@ def _get_inter_J3(rec1, unit1, rec2, unit2, raw_waves=False):
     return J3
 
 
-def get_unit_J3(rec_dir, unit, raw_waves=False):
+def get_unit_J3(rec_dir, unit, raw_waves=False, max_waves=None, seed=0):
     print('Getting intra-recording J3 for %s :: %s' % (rec_dir, unit))
     if raw_waves:
         waves, descrip, fs = h5io.get_raw_unit_waveforms(rec_dir, unit)
     else:
         waves, descrip, fs = h5io.get_unit_waveforms(rec_dir, unit)
+    waves = subsample_waves(waves, max_waves, seed=seed)
 
     pca = PCA(n_components=3)
     pca.fit(waves)
@@ -239,58 +425,484 @@ def get_unit_J3(rec_dir, unit, raw_waves=False):
     return J3
 
 
+def subsample_waves(waves, max_waves=MAX_J3_WAVES, seed=0):
+    '''stratified-in-time subsample of a unit's waveforms: the waveforms (in
+    spike order) are split into max_waves consecutive strata of equal size
+    and one waveform is drawn from each, so the subsample spans the whole
+    recording and keeps spike order (get_unit_J3 compares its first and last
+    thirds)
+
+    Parameters
+    ----------
+    waves : np.array, spikes x samples
+    max_waves : int, cap on the number of waveforms, None for no cap
+    seed : int, seed of the draw within each stratum
+
+    Returns
+    -------
+    np.array, at most max_waves x samples
+    '''
+    n = waves.shape[0]
+    if max_waves is None or n <= max_waves:
+        return waves
+    edges = np.linspace(0, n, max_waves + 1)
+    rng = np.random.default_rng(seed)
+    idx = np.floor(edges[:-1] + rng.random(max_waves) * np.diff(edges)).astype(int)
+    return waves[np.minimum(idx, n - 1)]
+
+
+def top_components(scatter, n_components=3):
+    '''principal axes of a scatter (or covariance) matrix, the same subspace
+    sklearn's PCA(n_components) fits to the data
+
+    Parameters
+    ----------
+    scatter : np.array, D x D or batch x D x D
+
+    Returns
+    -------
+    np.array, D x n_components (or batch x D x n_components)
+    '''
+    _, vecs = np.linalg.eigh(scatter)
+    return vecs[..., ::-1][..., :n_components]
+
+
+def scatter_stats(waves):
+    '''number of waveforms, mean waveform and scatter matrix about the mean'''
+    waves = np.asarray(waves, dtype=float)
+    mean = waves.mean(axis=0)
+    centered = waves - mean
+    return {'n': waves.shape[0], 'mean': mean, 'scatter': centered.T @ centered}
+
+
+def calc_J3_from_stats(axes, n1, mean1, scatter1, n2, mean2, scatter2):
+    '''hua.calc_J3 of two sets of waveforms projected onto axes, computed from
+    their scatter_stats instead of the projected waveforms. All arguments can
+    carry a leading batch dimension.
+
+    J1 (within-cluster scatter) is the trace of the scatter matrices in the
+    projected space and J2 (between-cluster scatter) is
+    n1*n2/(n1+n2) * |projected difference of means|**2. Neither depends on
+    the sign or rotation of the axes.
+
+    Returns
+    -------
+    float or np.array, J3 = J2/J1
+    '''
+    n1 = np.asarray(n1, dtype=float)
+    n2 = np.asarray(n2, dtype=float)
+    J1 = np.einsum('...dk,...de,...ek->...', axes, scatter1 + scatter2, axes)
+    diff = np.einsum('...dk,...d->...k', axes, mean1 - mean2)
+    J2 = n1 * n2 / (n1 + n2) * np.sum(diff ** 2, axis=-1)
+    return J2 / J1
+
+
+class WaveformStore(object):
+    '''Loads the waveforms of each unit in a recording once and keeps their
+    scatter_stats for the J3 calculations of find_held_units. The waveforms
+    themselves can be dropped with clear_waves once the stats exist; they are
+    only reloaded for pairs of units whose snapshots need trimming or
+    interpolation.
+
+    Parameters
+    ----------
+    rec_dir : str
+    raw_waves : bool, use h5io.get_raw_unit_waveforms instead of
+        h5io.get_unit_waveforms
+    max_waves : int, waveforms kept per unit, see subsample_waves
+    seed : int, seed for subsample_waves
+    '''
+
+    def __init__(self, rec_dir, raw_waves=False, max_waves=MAX_J3_WAVES, seed=0):
+        self.rec_dir = rec_dir
+        self.raw_waves = raw_waves
+        self.max_waves = max_waves
+        self.seed = seed
+        self._waves = {}
+        self._info = {}
+        self._stats = {}
+
+    def get_waves(self, unit):
+        '''returns (waveforms, sampling rate) of a unit'''
+        if unit not in self._waves:
+            if self.raw_waves:
+                wf, descrip, fs = h5io.get_raw_unit_waveforms(self.rec_dir, unit)
+            else:
+                wf, descrip, fs = h5io.get_unit_waveforms(self.rec_dir, unit)
+            wf = subsample_waves(wf, self.max_waves, seed=self.seed)
+            self._waves[unit] = (wf, fs)
+            self._info[unit] = (wf.shape[1], fs)
+        return self._waves[unit]
+
+    def get_info(self, unit):
+        '''returns (snapshot length, sampling rate) of a unit'''
+        if unit not in self._info:
+            self.get_waves(unit)
+        return self._info[unit]
+
+    def get_stats(self, unit):
+        if unit not in self._stats:
+            self._stats[unit] = scatter_stats(self.get_waves(unit)[0])
+        return self._stats[unit]
+
+    def unit_J3(self, unit):
+        '''intra-recording J3 of a unit, same as get_unit_J3'''
+        print('Getting intra-recording J3 for %s :: %s' % (self.rec_dir, unit))
+        waves = self.get_waves(unit)[0]
+        axes = top_components(self.get_stats(unit)['scatter'])
+        idx1 = int(waves.shape[0] * (1.0 / 3.0))
+        idx2 = int(waves.shape[0] * (2.0 / 3.0))
+        s1 = scatter_stats(waves[:idx1])
+        s2 = scatter_stats(waves[idx2:])
+        return float(calc_J3_from_stats(axes, s1['n'], s1['mean'], s1['scatter'],
+                                        s2['n'], s2['mean'], s2['scatter']))
+
+    def clear_waves(self):
+        '''drops the loaded waveforms, keeping their stats'''
+        self._waves.clear()
+
+
+def match_waves(wf1, fs1, wf2, fs2):
+    '''trims and interpolates two units' waveforms to a common snapshot, as
+    get_inter_J3 does'''
+    if wf1.shape[1] != wf2.shape[1]:
+        print('warning: different length spike snapshots, trimming to match. Consider re-clustering & sorting with equal snapshot lengths')
+        diff = wf1.shape[1]-wf2.shape[1]
+        if diff > 0:
+            wf1 = wf1[:,diff:]
+        else:
+            wf2 = wf2[:,-diff:]
+
+    if fs1 > fs2:
+        wf1 = sas.interpolate_waves(wf1, fs1, fs2)
+    elif fs1 < fs2:
+        wf2 = sas.interpolate_waves(wf2, fs2, fs1)
+    return wf1, wf2
+
+
+def get_inter_J3_matrix(units1, units2, stores):
+    '''inter-recording J3 of every pair of units1 x units2, with the same
+    values as get_inter_J3. Each pair still gets its own PCA basis, but the
+    bases come from the pooled scatter matrices of the two units (built from
+    the cached scatter_stats of each unit) and all pairs with the same
+    snapshot length are solved in one batched eigh.
+
+    Parameters
+    ----------
+    units1, units2 : list of (rec_dir, unit_name)
+    stores : dict of rec_dir -> WaveformStore
+
+    Returns
+    -------
+    np.array, len(units1) x len(units2)
+    '''
+    J3 = np.full((len(units1), len(units2)), np.nan)
+    batches = {}
+    for i, (rec1, unit1) in enumerate(units1):
+        info1 = stores[rec1].get_info(unit1)
+        for j, (rec2, unit2) in enumerate(units2):
+            if stores[rec2].get_info(unit2) == info1:
+                s1 = stores[rec1].get_stats(unit1)
+                s2 = stores[rec2].get_stats(unit2)
+            else:
+                wf1, wf2 = match_waves(*stores[rec1].get_waves(unit1), *stores[rec2].get_waves(unit2))
+                s1 = scatter_stats(wf1)
+                s2 = scatter_stats(wf2)
+            batches.setdefault(s1['mean'].shape[0], []).append((i, j, s1, s2))
+
+    for pairs in batches.values():
+        n1 = np.array([p[2]['n'] for p in pairs], dtype=float)
+        n2 = np.array([p[3]['n'] for p in pairs], dtype=float)
+        mean1 = np.stack([p[2]['mean'] for p in pairs])
+        mean2 = np.stack([p[3]['mean'] for p in pairs])
+        scatter1 = np.stack([p[2]['scatter'] for p in pairs])
+        scatter2 = np.stack([p[3]['scatter'] for p in pairs])
+        diff = mean1 - mean2
+        # scatter of the concatenated waveforms of each pair, what PCA is fit on
+        pooled = scatter1 + scatter2 + (n1 * n2 / (n1 + n2))[:, None, None] * diff[:, :, None] * diff[:, None, :]
+        axes = top_components(pooled)
+        vals = calc_J3_from_stats(axes, n1, mean1, scatter1, n2, mean2, scatter2)
+        for (i, j, _, _), val in zip(pairs, vals):
+            J3[i, j] = val
+    return J3
+
+
+def check_J3_convergence(units, max_waves=MAX_J3_WAVES, n_units=20, raw_waves=False, seed=0):
+    '''compares J3 computed on subsampled waveforms (subsample_waves) with
+    J3 on all waveforms for a random sample of single units: the intra J3 of
+    each unit and, where the unit's electrode has single units in the next
+    recording of that animal, the inter J3 with the first of them
+
+    Parameters
+    ----------
+    units : pd.DataFrame, from get_all_units
+    max_waves : int, cap to check
+    n_units : int, number of units to sample
+    raw_waves : bool
+    seed : int, seed for the unit sample and for subsample_waves
+
+    Returns
+    -------
+    pd.DataFrame with columns kind ('intra' or 'inter'), rec1, unit1, rec2,
+    unit2, n_waves (of unit1), J3_full, J3_sub, abs_err, rel_err
+    '''
+    sing_units = units[units['single_unit'] == True]
+    sample = sing_units.sample(n=min(n_units, len(sing_units)), random_state=seed)
+    rec_dirs = sing_units['rec_dir'].unique()
+    full = {rec_dir: WaveformStore(rec_dir, raw_waves=raw_waves, max_waves=None) for rec_dir in rec_dirs}
+    sub = {rec_dir: WaveformStore(rec_dir, raw_waves=raw_waves, max_waves=max_waves, seed=seed)
+           for rec_dir in rec_dirs}
+    rows = []
+    for i, row in sample.iterrows():
+        rec1 = row['rec_dir']
+        unit1 = row['unit_name']
+        n_waves = full[rec1].get_waves(unit1)[0].shape[0]
+        rows.append({'kind': 'intra', 'rec1': rec1, 'unit1': unit1, 'rec2': rec1, 'unit2': unit1,
+                     'n_waves': n_waves, 'J3_full': full[rec1].unit_J3(unit1),
+                     'J3_sub': sub[rec1].unit_J3(unit1)})
+        later = sing_units[(sing_units['exp_name'] == row['exp_name']) &
+                           (sing_units['electrode'] == row['electrode']) &
+                           (sing_units['rec_num'] > row['rec_num'])]
+        if not later.empty:
+            row2 = later[later['rec_num'] == later['rec_num'].min()].iloc[0]
+            pair = ([(rec1, unit1)], [(row2['rec_dir'], row2['unit_name'])])
+            rows.append({'kind': 'inter', 'rec1': rec1, 'unit1': unit1, 'rec2': row2['rec_dir'],
+                         'unit2': row2['unit_name'], 'n_waves': n_waves,
+                         'J3_full': get_inter_J3_matrix(*pair, full)[0, 0],
+                         'J3_sub': get_inter_J3_matrix(*pair, sub)[0, 0]})
+        for store in list(full.values()) + list(sub.values()):
+            store.clear_waves()
+
+    out = pd.DataFrame(rows)
+    out['abs_err'] = np.abs(out['J3_sub'] - out['J3_full'])
+    out['rel_err'] = out['abs_err'] / np.abs(out['J3_full'])
+    for kind, grp in out.groupby('kind'):
+        print('%s J3 with max_waves=%s: median absolute error %.3g, max %.3g, median relative error %.3g, '
+              'max %.3g (%i units)' % (kind, max_waves, grp['abs_err'].median(), grp['abs_err'].max(),
+                                       grp['rel_err'].median(), grp['rel_err'].max(), len(grp)))
+    return out
+
+
 def resolve_matches(df, thresh):
+    '''marks which candidate pairs in held_df (from find_held_units) are held
+    units and names them
+
+    For each pair of recordings the candidates form a unit1 x unit2 J3 cost
+    matrix and units are matched one-to-one with a linear assignment solver.
+    Only pairs with inter_J3 < thresh can be matched; as many of them as
+    possible are matched and, among those matchings, total J3 is minimized.
+    Pairs of units on different electrodes are never candidates, so this is
+    the same as solving each electrode on its own. Where every unit has at
+    most one candidate below thresh the matches are the unambiguous ones.
+
+    Held units are then numbered by following matches from one recording to
+    the next.
+
+    Parameters
+    ----------
+    df : pd.DataFrame, with rec1, unit1, rec2, unit2, inter_J3
+    thresh : float, J3 threshold
+
+    Returns
+    -------
+    pd.DataFrame, copy of df with held and held_unit_name
+    '''
     df = df.copy()
-    df['held'] = False
-    df['done'] = False
-    df.loc[df['inter_J3'] >= thresh, 'done'] = True
-    while any(df['done'] == False):
-        for name, group in df.groupby(['rec1', 'rec2']):
-            tmp = group[group['inter_J3'] < thresh].copy()
-            tmp = tmp[tmp['done'] == False]
-            if tmp.empty:
-                continue
+    J3 = df['inter_J3'].to_numpy(dtype=float)
+    held = np.zeros(len(df), dtype=bool)
+    for _, idx in df.groupby(['rec1', 'rec2']).indices.items():
+        units1, i1 = np.unique(df['unit1'].to_numpy()[idx], return_inverse=True)
+        units2, i2 = np.unique(df['unit2'].to_numpy()[idx], return_inverse=True)
+        cost = np.full((len(units1), len(units2)), np.inf)
+        pos = np.full((len(units1), len(units2)), -1)
+        cost[i1, i2] = J3[idx]
+        pos[i1, i2] = idx
+        allowed = cost < thresh
+        if not np.any(allowed):
+            continue
 
-            for u1 in tmp.unit1.unique():
-                all_idx = tmp.index[tmp.unit1 == u1]
-                a = np.argmin(np.array(tmp.loc[all_idx,'inter_J3']))
-                idx = tmp.loc[all_idx, 'inter_J3'].idxmin()
-                u2 = tmp.loc[idx, 'unit2']
-                u2_idx = tmp.index[tmp.unit2 == u2]
-                bidx = tmp.loc[u2_idx, 'inter_J3'].idxmin()
-                if idx == bidx:
-                    others = all_idx.union(u2_idx)
-                    others = others.drop(idx)
-                    df.loc[idx, 'held'] = True
-                    df.loc[others, 'held'] = False
-                    df.loc[idx, 'done'] = True
-                    df.loc[others, 'done'] = True
+        # a disallowed pair costs more than all allowed pairs together, so
+        # the solver first maximizes the number of matches
+        big = np.sum(np.abs(cost[allowed])) + 1.0
+        rows, cols = linear_sum_assignment(np.where(allowed, cost, big))
+        keep = allowed[rows, cols]
+        held[pos[rows[keep], cols[keep]]] = True
 
+    df['held'] = held
+
+    tmp = df[df.held]
+    # held pair that ends at each (rec, unit), to follow a unit back in time
+    ends = {(r2, u2): i for i, r2, u2 in zip(tmp.index, tmp['rec2'], tmp['unit2'])}
+    names = {}
     unit_num = 0
-    tmp = df[df.held].copy()
-    for i, row in tmp.iterrows():
-        r1 = row['rec1']
-        u1 = row['unit1']
-        tmp2 = tmp.query('rec2 == @r1 and unit2 == @u1')
-        if tmp2.empty:
-            df.loc[i, 'held_unit_name'] = unit_num
+    for i, r1, u1 in zip(tmp.index, tmp['rec1'], tmp['unit1']):
+        i2 = ends.get((r1, u1))
+        if i2 is None:
+            names[i] = unit_num
             unit_num += 1
-        elif len(tmp2) == 1:
-            i2 = tmp2.index[0]
-            un = df.loc[i2, 'held_unit_name']
-            if pd.isnull(un):
-                un = unit_num
-                unit_num += 1
-                df.loc[i2, 'held_unit_name'] = un
-
-            df.loc[i, 'held_unit_name'] = un
         else:
-            raise ValueError('Too many matches')
+            if i2 not in names:
+                names[i2] = unit_num
+                unit_num += 1
+            names[i] = names[i2]
 
-    df = df.drop(columns=['done'])
+    if len(names) > 0:
+        df.loc[list(names.keys()), 'held_unit_name'] = list(names.values())
     return df
 
 
+class HeldUnitGraph(object):
+    '''Held units as a graph: each unit (rec_dir, unit_name) is a node with
+    an integer id, held pairs are edges, and each connected component is one
+    unit followed across the recordings of an animal. Lookups are dict/array
+    based, so repeated queries (e.g. once per HMM group) do not filter the
+    unit tables.
+
+    Parameters
+    ----------
+    nodes : pd.DataFrame, one row per unit with rec_dir and unit_name, plus
+        any other columns to keep (exp_name, exp_group, held_unit_name, ...)
+    edges : np.array, n_edges x 2 node ids (row positions in nodes) of held
+        pairs
+    components : np.array, optional component id of every node. Computed
+        from the edges if None
+    '''
+
+    node_columns = ['exp_name', 'exp_group', 'held_unit_name']
+
+    def __init__(self, nodes, edges, components=None):
+        nodes = nodes.reset_index(drop=True).copy()
+        edges = np.asarray(edges, dtype=int).reshape(-1, 2)
+        n_nodes = len(nodes)
+        if components is None:
+            adj = sparse.coo_matrix((np.ones(len(edges)), (edges[:, 0], edges[:, 1])), shape=(n_nodes, n_nodes))
+            _, components = connected_components(adj, directed=False)
+        components = np.asarray(components, dtype=int)
+        rec_codes, rec_dirs = pd.factorize(nodes['rec_dir'])
+        comp_size = np.bincount(components, minlength=components.max() + 1 if n_nodes else 0)
+
+        nodes['node'] = np.arange(n_nodes)
+        nodes['rec'] = rec_codes
+        nodes['component'] = components
+        nodes['held'] = comp_size[components] > 1
+        self.nodes = nodes
+        self.edges = edges
+        self.rec_dirs = list(rec_dirs)
+        self._rec_index = {rd: i for i, rd in enumerate(self.rec_dirs)}
+        self._node_index = {key: i for i, key in enumerate(zip(nodes['rec_dir'], nodes['unit_name']))}
+        self._unit_names = nodes['unit_name'].to_numpy()
+        # node ids of each recording and of each component, in row order
+        order = np.argsort(rec_codes, kind='stable')
+        self._rec_nodes = np.split(order, np.cumsum(np.bincount(rec_codes, minlength=len(self.rec_dirs)))[:-1])
+        order = np.argsort(components, kind='stable')
+        self._comp_nodes = np.split(order, np.cumsum(comp_size)[:-1])
+        self._comp_size = comp_size
+        self._common = {}
+
+    @classmethod
+    def from_held_df(cls, all_units, held_df):
+        '''graph of all units in all_units with the held pairs of held_df
+        (from find_held_units) as edges'''
+        cols = ['rec_dir', 'unit_name'] + [c for c in cls.node_columns if c in all_units.columns]
+        nodes = all_units[cols].reset_index(drop=True)
+        index = {key: i for i, key in enumerate(zip(nodes['rec_dir'], nodes['unit_name']))}
+        held = held_df[held_df['held'] == True]
+        try:
+            edges = [(index[(r1, u1)], index[(r2, u2)])
+                     for r1, u1, r2, u2 in zip(held['rec1'], held['unit1'], held['rec2'], held['unit2'])]
+        except KeyError:
+            raise ValueError('Units not found')
+        return cls(nodes, edges)
+
+    @classmethod
+    def from_all_units(cls, all_units):
+        '''graph of the units in all_units (which may be filtered, e.g. to
+        GC single units) where units that share a held_unit_name are
+        connected. Components of named units are numbered in sorted
+        held_unit_name order, followed by one component per unnamed unit.
+        The rows of all_units are the nodes, in order.'''
+        nodes = all_units.reset_index(drop=True)
+        if 'held_unit_name' not in nodes.columns:
+            return cls(nodes, np.zeros((0, 2), dtype=int), components=np.arange(len(nodes)))
+        codes, names = pd.factorize(nodes['held_unit_name'], sort=True)
+        unnamed = codes < 0
+        codes[unnamed] = len(names) + np.arange(np.sum(unnamed))
+        named = np.flatnonzero(~unnamed)
+        order = named[np.argsort(codes[named], kind='stable')]
+        same = codes[order[1:]] == codes[order[:-1]]
+        edges = np.column_stack([order[:-1][same], order[1:][same]])
+        return cls(nodes, edges, components=codes)
+
+    def save(self, path):
+        '''writes the nodes to path and the edges next to it
+        (<name>_edges.feather)'''
+        cols = ['node', 'rec', 'component', 'rec_dir', 'unit_name'] + \
+            [c for c in self.node_columns if c in self.nodes.columns]
+        self.nodes[cols].to_feather(path)
+        edges = pd.DataFrame(self.edges, columns=['node1', 'node2'])
+        edges.to_feather(path.replace('.feather', '_edges.feather'))
+
+    @classmethod
+    def load(cls, path):
+        nodes = pd.read_feather(path)
+        edges = pd.read_feather(path.replace('.feather', '_edges.feather'))
+        return cls(nodes.drop(columns=['node', 'rec', 'component']), edges[['node1', 'node2']].to_numpy(),
+                   components=nodes['component'].to_numpy())
+
+    def component_of(self, rec_dir, unit_name):
+        return self.nodes['component'].iat[self._node_index[(rec_dir, unit_name)]]
+
+    def component_nodes(self, component):
+        '''node ids (row positions in nodes) of a component'''
+        return self._comp_nodes[component]
+
+    def held_components(self):
+        '''ids of components with more than one unit'''
+        return np.flatnonzero(self._comp_size > 1)
+
+    def recordings_of(self, rec_dir, unit_name):
+        '''all (rec_dir, unit_name) of the held unit that contains this unit'''
+        idx = self._comp_nodes[self.component_of(rec_dir, unit_name)]
+        return [(self.rec_dirs[r], u) for r, u in zip(self.nodes['rec'].to_numpy()[idx], self._unit_names[idx])]
+
+    def units_in(self, rec_dir):
+        '''names of all units (held or not) of a recording, in node order'''
+        if rec_dir not in self._rec_index:
+            return []
+        return list(self._unit_names[self._rec_nodes[self._rec_index[rec_dir]]])
+
+    def held_units(self):
+        '''table of every unit that is part of a held unit'''
+        return self.nodes[self.nodes['held']]
+
+    def units_held_across(self, rec_dirs):
+        '''units held across every one of rec_dirs
+
+        Returns
+        -------
+        dict of rec_dir -> list of unit names (in node order), empty if no
+        unit is held across all of them
+        '''
+        key = tuple(rec_dirs)
+        if key not in self._common:
+            self._common[key] = self._units_held_across(key)
+        return self._common[key]
+
+    def _units_held_across(self, rec_dirs):
+        if any(rd not in self._rec_index for rd in rec_dirs):
+            return {}
+        comps = self.nodes['component'].to_numpy()
+        rec_nodes = [self._rec_nodes[self._rec_index[rd]] for rd in rec_dirs]
+        common = None
+        for idx in rec_nodes:
+            held = set(comps[idx[self._comp_size[comps[idx]] > 1]])
+            common = held if common is None else common & held
+        if not common:
+            return {}
+        return {rd: [self._unit_names[i] for i in idx if comps[i] in common]
+                for rd, idx in zip(rec_dirs, rec_nodes)}
+
+
 def get_firing_rate_trace(rec, unit, ch, bin_size, step_size=None, t_start=None,
                           t_end=None, baseline_win=None, remove_baseline=False):
     '''Gets the spike array for a unit and returns the binned firing rate. If
@@ -311,7 +923,7 @@ def get_firing_rate_trace(rec, unit, ch, bin_size, step_size=None, t_start=None,
     if step_size is None:
         step_size = bin_size
 
-    t, sa = h5io.get_spike_data(rec, unit, ch)
+    t, sa = dc.get_spike_data(rec, unit, ch)
 
     if baseline_win is None:
         baseline_win = np.min(t)
@@ -7,6 +7,8 @@ import numpy as np
 import feather
 import pickle
 import aggregation as agg
+import data_cache as dc
+import worker_budget as wb
 import plotting as plt
 import new_plotting as nplt
 import analysis_stats as stats
@@ -98,12 +100,19 @@ class ProjectAnalysis(object):
         self.save_dir = save_dir
         self.files = {'all_units': os.path.join(save_dir, 'all_units.feather'),
                       'held_units': os.path.join(save_dir, 'held_units.feather'),
+                      'held_unit_graph': os.path.join(save_dir, 'held_unit_graph.feather'),
                       'params': os.path.join(save_dir, 'analysis_params.json')}
 
-    def detect_held_units(self, percent_criterion=95, raw_waves=True, overwrite=False):
+    def detect_held_units(self, percent_criterion=95, raw_waves=True, overwrite=False,
+                          max_waves=agg.MAX_J3_WAVES, n_jobs=-1):
+        '''finds held units with agg.find_held_units. Results of each animal
+        are saved in held_unit_parts as they finish, so a crashed run can be
+        restarted with overwrite=False and only redoes unfinished animals.
+        '''
         save_dir = self.save_dir
         all_units_file = self.files['all_units']
         held_units_file = self.files['held_units']
+        part_dir = os.path.join(save_dir, 'held_unit_parts')
         if not os.path.isdir(save_dir):
             os.makedirs(save_dir)
 
@@ -111,9 +120,14 @@ class ProjectAnalysis(object):
             all_units = feather.read_dataframe(all_units_file)
             held_df = feather.read_dataframe(held_units_file)
         else:
-            all_units, held_df = agg.find_held_units(self.project, percent_criterion, raw_waves)
+            if overwrite and os.path.isdir(part_dir):
+                shutil.rmtree(part_dir)
+            all_units, held_df = agg.find_held_units(self.project, percent_criterion, raw_waves,
+                                                     max_waves=max_waves, n_jobs=n_jobs,
+                                                     part_dir=part_dir)
             feather.write_dataframe(all_units, all_units_file)
             feather.write_dataframe(held_df, held_units_file)
+            agg.HeldUnitGraph.from_held_df(all_units, held_df).save(self.files['held_unit_graph'])
 
             # Plot waveforms and J3 distribution
             plot_dir = os.path.join(save_dir, 'held_unit_waveforms')
@@ -127,6 +141,19 @@ class ProjectAnalysis(object):
 
         return all_units, held_df
 
+    def get_held_unit_graph(self, overwrite=False):
+        '''held units as an agg.HeldUnitGraph, built from the held_units table
+        after detect_held_units and saved next to it'''
+        graph_file = self.files['held_unit_graph']
+        if os.path.isfile(graph_file) and not overwrite:
+            return agg.HeldUnitGraph.load(graph_file)
+
+        all_units = feather.read_dataframe(self.files['all_units'])
+        held_df = feather.read_dataframe(self.files['held_units'])
+        graph = agg.HeldUnitGraph.from_held_df(all_units, held_df)
+        graph.save(graph_file)
+        return graph
+
     def get_unit_info(self, overwrite=False):
         save_dir = self.save_dir
         all_units_file = self.files['all_units']
@@ -227,9 +254,12 @@ class ProjectAnalysis(object):
             comp_time = None
             diff_time = None
 
-            for held_unit_name, group in all_units.groupby('held_unit_name'):
+            graph = agg.HeldUnitGraph.from_all_units(all_units)
+            for component in graph.held_components():
+                group = all_units.iloc[graph.component_nodes(component)]
+                held_unit_name = group['held_unit_name'].iloc[0]
                 if any(group.rec_num == 1):
-                    pre_grp = group.query('rec_num == 1')
+                    pre_grp = group[group.rec_num == 1]
                     for unit_id1, row in pre_grp.iterrows():
                         post_row = group.loc[group.time_group != "1"]
                         if post_row.empty:
@@ -1980,7 +2010,7 @@ class HmmAnalysis(object):
 
         def apply_states(row):
             h5 = hmma.get_hmm_h5(row['rec_dir'])
-            hmm, _, _ = phmm.load_hmm_from_hdf5(h5, row['hmm_id'])
+            hmm, _, _ = dc.load_hmm_from_hdf5(h5, row['hmm_id'])
             tmp = hmma.choose_bsln_early_late_states(hmm)
             return pd.Series({'bsln_state': tmp[0], 'early_state': tmp[1], 'late_state': tmp[2]})
 
@@ -1993,7 +2023,7 @@ class HmmAnalysis(object):
         def apply_states(row):
             if row.n_states > 2:
                 h5 = hmma.get_hmm_h5(row['rec_dir'])
-                hmm, _, _ = phmm.load_hmm_from_hdf5(h5, row['hmm_id'])
+                hmm, _, _ = dc.load_hmm_from_hdf5(h5, row['hmm_id'])
                 tmp = hmma.find_poss_epoch_states(hmm)
                 return pd.Series({'bsln_state': tmp[0], 'early_state': tmp[1], 'late_state': tmp[2]})
             else:
@@ -2007,7 +2037,7 @@ class HmmAnalysis(object):
 
         def apply_states(row):
             h5 = hmma.get_hmm_h5(row['rec_dir'])
-            hmm, _, _ = phmm.load_hmm_from_hdf5(h5, row['hmm_id'])
+            hmm, _, _ = dc.load_hmm_from_hdf5(h5, row['hmm_id'])
             tmp = hmma.choose_early_late_states(hmm)
             return pd.Series({'early_state': tmp[0], 'late_state': tmp[1]})
 
@@ -2022,7 +2052,7 @@ class HmmAnalysis(object):
 
         for i, row in ho.iterrows():
             h5 = hmma.get_hmm_h5(row['rec_dir'])
-            hmm, _, params = phmm.load_hmm_from_hdf5(h5, row['hmm_id'])
+            hmm, _, params = dc.load_hmm_from_hdf5(h5, row['hmm_id'])
             yield i, hmm, params, row
 
     def sort_hmms_by_params(self,
@@ -2173,7 +2203,7 @@ class HmmAnalysis(object):
     def get_gamma_sequences(self, sorting='best_AIC'):
         def getmaxgammaprob(row):
             h5_file = get_hmm_h5(row['rec_dir'])
-            hmm, time, params = phmm.load_hmm_from_hdf5(h5_file, row["hmm_id"])
+            hmm, time, params = dc.load_hmm_from_hdf5(h5_file, row["hmm_id"])
             gamma = hmm.stat_arrays['gamma_probabilities']
             gamma_seqs = np.argmax(gamma, axis=1)
             rowids = hmm.stat_arrays['row_id']
@@ -2203,7 +2233,7 @@ class HmmAnalysis(object):
         if overwrite is True:
             def getbinstateprob(row):
                 h5_file = get_hmm_h5(row['rec_dir'])  # get hmm file name
-                hmm, time, params = phmm.load_hmm_from_hdf5(h5_file, row["hmm_id"])  # load hmm
+                hmm, time, params = dc.load_hmm_from_hdf5(h5_file, row["hmm_id"])  # load hmm
                 mode_seqs, mode_gamma, best_seqs = hmma.getModeHmm(hmm)  # get mode state # and gamma prob
                 rowids = hmm.stat_arrays['row_id']
                 time = hmm.stat_arrays['time']
@@ -2539,7 +2569,7 @@ def fit_group(args):
 
 def fit_piecewise_regression(df, groups, response_col, trial_col):
     # Create a multiprocessing pool
-    with Pool(cpu_count()) as pool:
+    with wb.Pool(cpu_count()) as pool:
         # Prepare the arguments for fit_group
         args = [(name, group, response_col, trial_col) for name, group in df.groupby(groups)]
         # Use the pool to run fit_group in parallel
@@ -3208,7 +3238,7 @@ def get_hmm_firing_rate_PCs(best_hmms):
             hid = row['hmm_id']
             taste = row['taste']
             h5_file = hmma.get_hmm_h5(rd)
-            hmm, time, params = phmm.load_hmm_from_hdf5(h5_file, hid)
+            hmm, time, params = dc.load_hmm_from_hdf5(h5_file, hid)
             emission = hmm.emissions
             for state, emr in emission.T:
                 rates, trials = hmma.get_state_firing_rates(rd, hid, state)
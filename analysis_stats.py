@@ -2,6 +2,7 @@ import numpy as np
 import pandas as pd
 import itertools as it
 from joblib import Parallel, delayed, cpu_count
+import worker_budget as wb
 from scipy.stats import t, fisher_exact, shapiro, levene, chisquare, kruskal, chi2_contingency 
 from scipy.optimize import curve_fit
 from sklearn.model_selection import LeavePOut
@@ -189,8 +190,8 @@ def permutation_test(labels, data, alpha=0.05, group_col=0, n_boot=1000, n_cores
     def foo(x):
         return 100*np.mean(x, axis=0)
 
-    results = (Parallel(n_jobs=n_cores, verbose=8)
-               (delayed(bootstrap_diff)
+    results = (wb.Parallel(n_jobs=n_cores, verbose=8)
+               (wb.delayed(bootstrap_diff)
                 (lbls, data, agg_func=foo)
                 for i in range(n_boot)))
     #results = []
@@ -229,14 +230,42 @@ def bootstrap(data, n_boot=1000, alpha=0.05, n_cores=1, func=np.sum):
         idx = np.random.choice(X.shape[0], size=X.shape[0], replace=True)
         return func(X[idx, :], axis=0)
 
-    results = (Parallel(n_jobs=n_cores, verbose=8)
-               (delayed(sample)(data)
+    results = (wb.Parallel(n_jobs=n_cores, verbose=8)
+               (wb.delayed(sample)(data)
                 for _ in range(n_boot)))
     means = np.vstack(results)
     lower = np.percentile(means, 100*alpha/2, axis=0)
     upper = np.percentile(means, 100*(1-alpha/2), axis=0)
     return np.mean(means, axis=0), lower, upper
 
+def gaussian_class_stats(X):
+    '''sufficient statistics of a block of samples: (count, mean, sum of
+    squared deviations from the mean) per feature'''
+    X = np.asarray(X, dtype=float)
+    if X.shape[0] == 0:
+        return 0, np.zeros(X.shape[1]), np.zeros(X.shape[1])
+    mean = X.mean(axis=0)
+    return X.shape[0], mean, ((X - mean)**2).sum(axis=0)
+
+
+def merge_gaussian_stats(stats_list):
+    '''pools (count, mean, M2) statistics of several blocks into those of the
+    concatenated data (Chan et al. pairwise update)'''
+    n, mean, M2 = 0, None, None
+    for nb, mb, M2b in stats_list:
+        if nb == 0:
+            continue
+        if n == 0:
+            n, mean, M2 = nb, np.array(mb, dtype=float), np.array(M2b, dtype=float)
+            continue
+        tot = n + nb
+        delta = mb - mean
+        mean = mean + delta * nb / tot
+        M2 = M2 + M2b + delta**2 * n * nb / tot
+        n = tot
+    return n, mean, M2
+
+
 class LinRegressor(object):
     def __init__(self, y, X, row_id=None, n_features = 2):
         self.Y = y
@@ -254,24 +283,35 @@ class LinRegressor(object):
     def predict(self, X):
         return self.model.predict(X)
     
-    def leave1out_fit(self):
+    def leave1out_fit(self, closed_form=True):
+        '''leave-one-out fit. If closed_form the held-out predictions come from
+        the PRESS residuals of a single least-squares fit, falling back to
+        refitting for rank-deficient designs or high-leverage points
+        '''
         X = self.X
         Y = self.Y
         lpo = LeavePOut(1)
         n_splits = lpo.get_n_splits(Y)
         correct = 0
         predictions = np.zeros((n_splits,), object)
+        refit = np.ones((n_splits,), dtype=bool)
+        if closed_form:
+            loo_pred, refit = self._press_leave1out_predict()
+            predictions[~refit] = loo_pred[~refit]
         
         poss_states = np.unique(Y)
         
         for train_idx, test_idx in lpo.split(Y):
-            train_x = X[train_idx, :]
-            train_y = Y[train_idx]
-            test_x = X[test_idx, :]
             test_y = Y[test_idx]
-            lr = LR()
-            y_pred = lr.fit(train_x, train_y).predict(test_x)
-            predictions[test_idx] = y_pred[0]
+            if refit[test_idx[0]]:
+                train_x = X[train_idx, :]
+                train_y = Y[train_idx]
+                test_x = X[test_idx, :]
+                lr = LR()
+                y_pred = lr.fit(train_x, train_y).predict(test_x)
+                predictions[test_idx] = y_pred[0]
+            else:
+                y_pred = predictions[test_idx]
             pred_err = abs(y_pred[0]-poss_states)
             idx = np.where(pred_err == min(pred_err))
             Y_match = poss_states[idx]
@@ -286,6 +326,32 @@ class LinRegressor(object):
         self.result = ClassifierResult(accuracy, X, Y, predictions, row_id=self.row_id, model=full_model, loss = mse)
         return self.result
 
+    def _press_leave1out_predict(self, max_leverage=1 - 1e-6):
+        '''leave-one-out predictions of an ordinary least squares fit with
+        intercept from the hat matrix: y_(i) = y_i - e_i / (1 - h_ii)
+
+        Returns
+        -------
+        predictions : np.array, leave-one-out predictions
+        refit : np.array of bool, folds that must be refit
+        '''
+        X = np.asarray(self.X, dtype=float)
+        Y = np.asarray(self.Y, dtype=float)
+        n = X.shape[0]
+        predictions = np.zeros((n,), object)
+        refit = np.ones((n,), dtype=bool)
+        design = np.column_stack([np.ones(n), X])
+        if n <= design.shape[1] or np.linalg.matrix_rank(design) < design.shape[1]:
+            return predictions, refit
+
+        Q, _ = np.linalg.qr(design)
+        h = np.sum(Q**2, axis=1)
+        resid = Y - Q @ (Q.T @ Y)
+        ok = h < max_leverage
+        with np.errstate(divide='ignore', invalid='ignore'):
+            predictions[:] = Y - resid / (1 - h)
+        return predictions, ~ok
+
 class NBClassifier(object):
     def __init__(self, y, X, row_id=None):
         self.Y = y
@@ -301,7 +367,16 @@ class NBClassifier(object):
     def predict(self, X):
         return self.model.predict(X)
 
-    def leave1out_fit(self):
+    def leave1out_fit(self, closed_form=True, class_stats=None):
+        '''leave-one-out fit. If closed_form the held-out models are computed
+        by downdating the per-class sufficient statistics of the full data,
+        which gives the same predictions as refitting GaussianNB per fold.
+        class_stats can pass in precomputed {label: (count, mean, M2)}
+        statistics (see gaussian_class_stats) so they aren't recomputed
+        '''
+        if closed_form:
+            return self._closed_form_leave1out_fit(class_stats=class_stats)
+
         X = self.X
         Y = self.Y
         lpo = LeavePOut(1)
@@ -329,6 +404,74 @@ class NBClassifier(object):
         self.result = ClassifierResult(accuracy, X, Y, predictions, row_id=self.row_id, model=full_model, class_probs=class_probs)
         return self.result
 
+    def _closed_form_leave1out_fit(self, class_stats=None):
+        '''exact leave-one-out for GaussianNB in one vectorized pass. For each
+        held-out sample the class counts, means and variances (and the
+        variance smoothing term) are downdated from the full-data statistics
+        and the joint log likelihood is computed as GaussianNB does. A class
+        whose only sample is held out is absent from that fold, as it would be
+        in a refit, and gets NaN class probability.
+        '''
+        X = np.asarray(self.X, dtype=float)
+        Y = self.Y
+        n, d = X.shape
+        classes, y_idx = np.unique(Y, return_inverse=True)
+        n_classes = len(classes)
+
+        if class_stats is None:
+            class_stats = {c: gaussian_class_stats(X[y_idx == k]) for k, c in enumerate(classes)}
+        counts = np.array([class_stats[c][0] for c in classes], dtype=float)
+        means = np.array([class_stats[c][1] for c in classes], dtype=float)
+        M2 = np.array([class_stats[c][2] for c in classes], dtype=float)
+
+        rows = np.arange(n)
+        own_n = counts[y_idx]
+        dev = X - means[y_idx]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # downdate the held-out sample's own class
+            own_means = (own_n[:, None]*means[y_idx] - X) / (own_n[:, None] - 1)
+            own_M2 = M2[y_idx] - dev**2 * (own_n / (own_n - 1))[:, None]
+        own_M2[own_n <= 2] = 0  # 0 or 1 samples left
+        own_M2 = np.clip(own_M2, 0, None)
+
+        fold_n = np.repeat(counts[None, :], n, axis=0)
+        fold_n[rows, y_idx] -= 1
+        fold_means = np.repeat(means[None, :, :], n, axis=0)
+        fold_means[rows, y_idx] = own_means
+        fold_M2 = np.repeat(M2[None, :, :], n, axis=0)
+        fold_M2[rows, y_idx] = own_M2
+
+        # variance smoothing uses the variance of the training data
+        _, mu, M2_all = merge_gaussian_stats([class_stats[c] for c in classes])
+        loo_var = np.clip(M2_all - (X - mu)**2 * (n / (n - 1)), 0, None) / (n - 1)
+        epsilon = 1e-9 * loo_var.max(axis=1)
+
+        present = fold_n > 0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            var = fold_M2 / fold_n[:, :, None] + epsilon[:, None, None]
+            jll = (np.log(fold_n / (n - 1))
+                   - 0.5 * np.sum(np.log(2. * np.pi * var), axis=2)
+                   - 0.5 * np.sum((X[:, None, :] - fold_means)**2 / var, axis=2))
+        jll[~present] = -np.inf
+
+        pred_idx = np.argmax(jll, axis=1)
+        predictions = np.zeros((n,), object)
+        predictions[:] = classes[pred_idx]
+        correct = (Y == predictions).sum()
+
+        jmax = jll.max(axis=1, keepdims=True)
+        log_norm = jmax + np.log(np.exp(jll - jmax).sum(axis=1, keepdims=True))
+        probs = np.exp(jll - log_norm)
+        probs[~present] = np.nan
+        class_probs = pd.DataFrame(probs, columns=classes)
+
+        full_model = GaussianNB()
+        full_model.fit(X, Y)
+        accuracy = 100* (correct/n)
+        self.model = full_model
+        self.result = ClassifierResult(accuracy, self.X, Y, predictions, row_id=self.row_id, model=full_model, class_probs=class_probs)
+        return self.result
+
 
 class LDAClassifier(object):
     def __init__(self, y, X, row_id=None, n_components=2):
@@ -350,28 +493,147 @@ class LDAClassifier(object):
     def predict(self, X):
         return self.model.predict(X)
 
-    def leave1out_fit(self):
+    def leave1out_fit(self, closed_form=True):
+        '''leave-one-out fit. If closed_form the held-out predictions are
+        computed with rank-one downdates of the pooled within-class scatter
+        and class means, falling back to refitting LDA for folds where the
+        downdate is ill-conditioned
+        '''
         X = self.X
         Y = self.Y
         lpo = LeavePOut(1)
         n_splits = lpo.get_n_splits(Y)
         correct = 0
         predictions = np.zeros((n_splits,), object)
+        refit = np.ones((n_splits,), dtype=bool)
+        full_model = LDA(n_components=self.n_components)
+        new_X = full_model.fit_transform(X, Y)
+        if closed_form:
+            loo_pred, refit = self._rank_one_leave1out_predict(full_model)
+            predictions[~refit] = loo_pred[~refit]
+
         for train_idx, test_idx in lpo.split(Y):
+            if not refit[test_idx[0]]:
+                continue
+
             lda = LDA(n_components=self.n_components)
-            new_X = lda.fit_transform(X[train_idx,:], Y[train_idx])
+            lda.fit(X[train_idx,:], Y[train_idx])
             y_pred = lda.predict(X[test_idx,:])
             correct += (Y[test_idx] == y_pred).sum()
             predictions[test_idx] = y_pred[0]
 
-        full_model = LDA(n_components=self.n_components)
-        new_X = full_model.fit_transform(X, Y)
         self.model = full_model
         accuracy = 100* ((predictions == Y).sum() / Y.shape[0])
         self.result = ClassifierResult(accuracy, new_X, Y, predictions,
                                        row_id=self.row_id, model=full_model)
         return self.result
 
+    def _rank_one_leave1out_predict(self, full_model, min_sv=1e-3):
+        '''leave-one-out LDA predictions from a single decomposition of the
+        pooled within-class scatter W. Removing sample i from class k changes
+        W by -n_k/(n_k-1) d d' (d = x_i - mean_k), so each fold's inverse is a
+        Sherman-Morrison update of W^-1. Matches the svd solver of sklearn's
+        LDA when no directions are truncated; the covariance normalization
+        (n or n - n_classes depending on the sklearn version) is read off
+        full_model, the LDA fit to all the data. Folds whose smallest
+        within-class singular value could come near sklearn's tolerance, or
+        whose class would be emptied, are flagged for refitting.
+
+        Parameters
+        ----------
+        full_model : LinearDiscriminantAnalysis fit to self.X, self.Y
+        min_sv : float, smallest within-class singular value (in correlation
+            units) accepted without refitting
+
+        Returns
+        -------
+        predictions : np.array, leave-one-out predicted labels
+        refit : np.array of bool, folds that must be refit
+        '''
+        X = np.asarray(self.X, dtype=float)
+        Y = self.Y
+        n = X.shape[0]
+        classes, y_idx = np.unique(Y, return_inverse=True)
+        n_classes = len(classes)
+        predictions = np.zeros((n,), object)
+        refit = np.ones((n,), dtype=bool)
+        counts = np.bincount(y_idx, minlength=n_classes).astype(float)
+        if n_classes < 2 or n - 1 - n_classes <= 0:
+            return predictions, refit
+
+        means = np.array([X[y_idx == k].mean(axis=0) for k in range(n_classes)])
+        dev = X - means[y_idx]
+        W = dev.T @ dev
+        # features with no within-class variance are ignored by the svd solver
+        keep = np.diag(W) > 0
+        if not any(keep):
+            return predictions, refit
+        X = X[:, keep]
+        means = means[:, keep]
+        dev = dev[:, keep]
+        W = W[np.ix_(keep, keep)]
+
+        scale = np.sqrt(np.diag(W))
+        evals, evecs = np.linalg.eigh(W / np.outer(scale, scale))
+        if evals[0] <= 0:
+            return predictions, refit
+        A = (evecs / evals) @ evecs.T / np.outer(scale, scale)  # W^-1
+
+        # sklearn truncates between-class directions with small singular values
+        xbar = counts @ means / n
+        Z = (np.sqrt(counts)[:, None] * (means - xbar)) @ (evecs / np.sqrt(evals)).T
+        between_sv = np.linalg.svd(Z, compute_uv=False)[:min(n_classes - 1, X.shape[1])]
+        if between_sv[-1] < 1e-2 * between_sv[0]:
+            return predictions, refit
+
+        # coef_ = cov^-1 (mean - xbar) with cov = W / norm
+        ref = (means - xbar) @ A
+        full_coef = full_model.coef_[:, keep]
+        if n_classes == 2:
+            ref = ref[1:] - ref[:1]
+        norm = np.sum(full_coef * ref) / np.sum(ref * ref)
+        if np.isclose(norm, n, rtol=1e-6):
+            fold_norm = n - 1
+        elif np.isclose(norm, n - n_classes, rtol=1e-6):
+            fold_norm = n - 1 - n_classes
+        else:
+            return predictions, refit
+
+        own_n = counts[y_idx]
+        U = dev @ A  # W^-1 d for each sample
+        h = np.sum(U * dev, axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # singleton classes give c = inf, masked out by ok below
+            c = own_n / (own_n - 1)
+            denom = 1 - c * h
+        # smallest eigenvalue of the fold's within-class correlation is at
+        # least (1 - c h) times that of the full data
+        ok = (own_n > 1) & (denom > 0) & (np.sqrt(np.clip(denom, 0, None) * evals[0]) > min_sv)
+        if any(own_n > 1) and not any(ok):
+            return predictions, refit
+
+        rows = np.arange(n)
+        fold_means = np.repeat(means[None, :, :], n, axis=0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            fold_means[rows, y_idx] = (own_n[:, None]*means[y_idx] - X) / (own_n[:, None] - 1)
+            coef = np.where(ok, c / denom, 0)
+        fold_n = np.repeat(counts[None, :], n, axis=0)
+        fold_n[rows, y_idx] -= 1
+
+        # a' W_i^-1 b = a' A b + coef (a' u)(u' b)
+        MA = fold_means @ A
+        mu_u = np.einsum('nkd,nd->nk', fold_means, U)
+        x_u = np.sum(X * U, axis=1)
+        x_mu = np.einsum('nd,nkd->nk', X, MA) + coef[:, None] * x_u[:, None] * mu_u
+        mu_mu = np.sum(MA * fold_means, axis=2) + coef[:, None] * mu_u**2
+        with np.errstate(divide='ignore'):
+            decision = fold_norm * (x_mu - 0.5 * mu_mu) + np.log(fold_n / (n - 1))
+
+        pred_idx = np.argmax(decision, axis=1)
+        predictions[:] = classes[pred_idx]
+        refit = ~ok
+        return predictions, refit
+
 
 class ClassifierResult(object):
     def __init__(self, accuracy, x, y, y_pred, row_id=None, model=None, loss = None, class_probs=None):
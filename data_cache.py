@@ -0,0 +1,394 @@
+import os
+from collections import OrderedDict
+import numpy as np
+from blechpy.analysis import poissonHMM as ph
+from blechpy.dio import h5io
+
+
+def estimate_nbytes(obj, _seen=None):
+    '''rough estimate of the memory footprint of obj, counting numpy arrays,
+    pandas objects and containers/attribute dicts that hold them
+
+    Parameters
+    ----------
+    obj : any
+
+    Returns
+    -------
+    int, number of bytes
+    '''
+    if _seen is None:
+        _seen = set()
+    if id(obj) in _seen:
+        return 0
+    _seen.add(id(obj))
+    if isinstance(obj, np.ndarray):
+        return int(obj.nbytes)
+    if hasattr(obj, 'memory_usage') and hasattr(obj, 'values'):
+        # pandas Series/DataFrame
+        return int(np.sum(obj.memory_usage(deep=True)))
+    if isinstance(obj, dict):
+        return sum(estimate_nbytes(k, _seen) + estimate_nbytes(v, _seen) for k, v in obj.items())
+    if isinstance(obj, (list, tuple, set)):
+        return sum(estimate_nbytes(x, _seen) for x in obj)
+    if hasattr(obj, '__dict__'):
+        return estimate_nbytes(vars(obj), _seen)
+    return 64
+
+
+class LRUCache(object):
+    '''Least-recently-used cache bounded both by number of entries and by an
+    approximate memory cap. Entries larger than the memory cap are returned
+    but never stored.
+
+    Parameters
+    ----------
+    max_items : int, maximum number of cached entries
+    max_bytes : int, approximate memory cap in bytes (None for no cap)
+    name : str, label used when printing stats
+    '''
+
+    def __init__(self, max_items=128, max_bytes=2 * 1024 ** 3, name='cache'):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.name = name
+        self._data = OrderedDict()
+        self._sizes = {}
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        if key in self._data:
+            self._data.move_to_end(key)
+            self.hits += 1
+            return self._data[key]
+        self.misses += 1
+        return default
+
+    def put(self, key, value, nbytes=None):
+        if nbytes is None:
+            nbytes = estimate_nbytes(value)
+        if key in self._data:
+            self.pop(key)
+        if self.max_bytes is not None and nbytes > self.max_bytes:
+            return value
+        self._data[key] = value
+        self._sizes[key] = nbytes
+        self.nbytes += nbytes
+        while (len(self._data) > self.max_items or
+               (self.max_bytes is not None and self.nbytes > self.max_bytes)):
+            old_key, _ = self._data.popitem(last=False)
+            self.nbytes -= self._sizes.pop(old_key)
+            self.evictions += 1
+        return value
+
+    def pop(self, key):
+        if key not in self._data:
+            return None
+        self.nbytes -= self._sizes.pop(key)
+        return self._data.pop(key)
+
+    def get_or_load(self, key, loader, nbytes=None):
+        '''return cached value for key, or call loader() and cache its result
+        '''
+        if key in self._data:
+            self._data.move_to_end(key)
+            self.hits += 1
+            return self._data[key]
+        self.misses += 1
+        value = loader()
+        return self.put(key, value, nbytes=nbytes)
+
+    def discard_where(self, pred):
+        '''drop every entry whose key satisfies pred(key)'''
+        for key in [k for k in self._data if pred(k)]:
+            self.pop(key)
+
+    def clear(self):
+        self._data.clear()
+        self._sizes.clear()
+        self.nbytes = 0
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {'name': self.name, 'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'entries': len(self._data),
+                'nbytes': self.nbytes,
+                'hit_rate': self.hits / total if total > 0 else np.nan}
+
+
+HMM_CACHE = LRUCache(max_items=256, max_bytes=1024 ** 3, name='hmm')
+
+
+def file_key(h5_file):
+    h5_file = os.path.abspath(h5_file)
+    return h5_file, os.path.getmtime(h5_file)
+
+
+def load_hmm_from_hdf5(h5_file, hmm_id):
+    '''cached drop-in for poissonHMM.load_hmm_from_hdf5. Entries are keyed by
+    (file path, hmm_id, file mtime) so rewriting the hdf5 file invalidates
+    every HMM cached from it.
+
+    Returns
+    -------
+    hmm, time, params : same as poissonHMM.load_hmm_from_hdf5
+    '''
+    path, mtime = file_key(h5_file)
+    hmm_id = int(hmm_id)
+    key = (path, hmm_id, mtime)
+    if key not in HMM_CACHE:
+        # drop anything loaded from an older version of this file
+        HMM_CACHE.discard_where(lambda k: k[0] == path and k[2] != mtime)
+    return HMM_CACHE.get_or_load(key, lambda: ph.load_hmm_from_hdf5(h5_file, hmm_id))
+
+
+SPIKE_CACHE = LRUCache(max_items=64, max_bytes=4 * 1024 ** 3, name='spike')
+
+
+def read_only(arr):
+    arr = np.asarray(arr)
+    arr.setflags(write=False)
+    return arr
+
+
+def _unit_index(unit):
+    if isinstance(unit, str):
+        return h5io.parse_unit_number(unit)
+    return int(unit)
+
+
+def _get_spike_tensor(rec_dir, din):
+    '''returns (time, spike_array) for all units of a recording, read from the
+    hdf5 store once and then served from SPIKE_CACHE. spike_array is trials x
+    units x time for a single din, or a dict keyed by din if din is None and
+    the recording has several digital inputs. Arrays are read-only since they
+    are shared between callers.
+    '''
+    path, mtime = file_key(h5io.get_h5_filename(rec_dir))
+    key = (path, din, mtime)
+    if key not in SPIKE_CACHE:
+        SPIKE_CACHE.discard_where(lambda k: k[0] == path and k[-1] != mtime)
+
+    def loader():
+        time, spikes = h5io.get_spike_data(rec_dir, din=din)
+        if isinstance(spikes, dict):
+            spikes = {k: read_only(v) for k, v in spikes.items()}
+        else:
+            spikes = read_only(spikes)
+        return read_only(time), spikes
+
+    return SPIKE_CACHE.get_or_load(key, loader)
+
+
+def get_spike_data(rec_dir, units=None, din=None, trials=None,
+                   time_start=None, time_end=None):
+    '''cached drop-in for h5io.get_spike_data. The full spike tensor of each
+    (rec_dir, din) is read once and unit, trial and time-window slices are
+    served from memory.
+
+    Parameters
+    ----------
+    rec_dir : str
+    units : str, int or list (optional), unit names or numbers. If a single
+        unit is given the unit axis is dropped
+    din : int (optional), digital input channel
+    trials : int, slice or array of indices (optional), trials to return. An
+        int returns the first n trials
+    time_start, time_end : float (optional), time window in ms, inclusive
+
+    Returns
+    -------
+    time : np.array
+    spike_array : np.array (trials x units x time or trials x time) or dict
+        of arrays keyed by din if din is None and there are multiple dins.
+        Writable copies, as returned by h5io.get_spike_data
+    '''
+    time, spikes = _get_spike_tensor(rec_dir, din)
+
+    t_idx = slice(None)
+    if time_start is not None or time_end is not None:
+        lo = 0 if time_start is None else np.searchsorted(time, time_start, side='left')
+        hi = len(time) if time_end is None else np.searchsorted(time, time_end, side='right')
+        t_idx = slice(lo, hi)
+        time = time[t_idx]
+
+    if units is None:
+        u_idx = slice(None)
+    elif isinstance(units, (list, tuple, np.ndarray)):
+        u_idx = [_unit_index(u) for u in units]
+    else:
+        u_idx = _unit_index(units)
+
+    if trials is None:
+        tr_idx = slice(None)
+    elif isinstance(trials, (int, np.integer)):
+        tr_idx = slice(0, trials)
+    else:
+        tr_idx = trials
+
+    def cut(arr):
+        # index one axis at a time so list indices don't broadcast together.
+        # The result is a writable copy of just the slice: a view would keep
+        # the whole cached tensor alive after SPIKE_CACHE evicts it
+        return np.array(arr[tr_idx][:, u_idx][..., t_idx])
+
+    time = np.array(time)
+    if isinstance(spikes, dict):
+        return time, {k: cut(v) for k, v in spikes.items()}
+
+    return time, cut(spikes)
+
+
+def make_hashable(x):
+    if isinstance(x, (list, tuple, np.ndarray)):
+        return tuple(make_hashable(y) for y in x)
+    return x
+
+
+def get_hmm_spike_data(rec_dir, unit_type, channel, time_start=None,
+                       time_end=None, dt=None, trials=None, area=None):
+    '''cached drop-in for poissonHMM.get_hmm_spike_data. Rebinned spike arrays
+    are cached per (rec_dir, units, channel, window, dt, trials, area) so
+    repeated per-state queries of the same HMM only hit the hdf5 store once.
+
+    Returns
+    -------
+    spikes, dt, time : same as poissonHMM.get_hmm_spike_data, read-only
+    '''
+    path, mtime = file_key(h5io.get_h5_filename(rec_dir))
+    key = ('hmm', path, make_hashable(unit_type), channel, time_start, time_end,
+           dt, make_hashable(trials), area, mtime)
+
+    def loader():
+        spikes, s_dt, s_time = ph.get_hmm_spike_data(rec_dir, unit_type, channel,
+                                                     time_start=time_start,
+                                                     time_end=time_end, dt=dt,
+                                                     trials=trials, area=area)
+        return read_only(spikes), s_dt, read_only(s_time)
+
+    return SPIKE_CACHE.get_or_load(key, loader)
+
+
+class SpikeWindowIndex(object):
+    '''Prefix-sum index over a spike array so that the spike count of any time
+    window is two lookups instead of a sum over the window.
+
+    Parameters
+    ----------
+    spike_array : np.array, trials x units x time (or units x time)
+    time : np.array, time vector matching the last axis of spike_array
+    '''
+
+    def __init__(self, spike_array, time):
+        spike_array = np.asarray(spike_array)
+        self.time = np.asarray(time)
+        self.shape = spike_array.shape
+        dtype = np.int64 if spike_array.dtype.kind in 'biu' else np.float64
+        csum = np.zeros(spike_array.shape[:-1] + (spike_array.shape[-1] + 1,), dtype=dtype)
+        np.cumsum(spike_array, axis=-1, dtype=dtype, out=csum[..., 1:])
+        self.csum = read_only(csum)
+
+    def window_idx(self, t1, t2, inclusive=False):
+        '''returns start and end indices into the time vector for the window
+        [t1, t2), or [t1, t2] if inclusive'''
+        lo = np.searchsorted(self.time, t1, side='left')
+        hi = np.searchsorted(self.time, t2, side='right' if inclusive else 'left')
+        return lo, hi
+
+    def counts(self, t1, t2, trials=None, inclusive=False):
+        '''spike counts per unit in a time window
+
+        Parameters
+        ----------
+        t1, t2 : float or array, window edges in the units of time. If arrays,
+            one window per entry of trials
+        trials : int or array (optional), trial index/indices. If None the
+            window is applied to all trials
+        inclusive : bool, whether the window includes t2
+
+        Returns
+        -------
+        counts : np.array, units (or trials x units) spike counts
+        n_bins : int or np.array, number of time bins in each window
+        '''
+        lo, hi = self.window_idx(t1, t2, inclusive=inclusive)
+        hi = np.maximum(hi, lo)
+        if trials is None:
+            csum = self.csum
+            counts = csum[..., hi] - csum[..., lo]
+        else:
+            csum = self.csum[trials]
+            if np.ndim(trials) == 0:
+                counts = csum[..., hi] - csum[..., lo]
+            else:
+                # one window per trial: trials x units
+                trials = np.arange(len(trials))
+                lo_b = np.broadcast_to(lo, trials.shape)
+                hi_b = np.broadcast_to(hi, trials.shape)
+                counts = csum[trials, :, hi_b] - csum[trials, :, lo_b]
+        return counts, hi - lo
+
+    def rates(self, t1, t2, dt, trials=None, inclusive=False):
+        '''mean firing rate (Hz if dt is in seconds) per unit over a window,
+        computed as counts / (dt * number of bins)'''
+        counts, n_bins = self.counts(t1, t2, trials=trials, inclusive=inclusive)
+        n_bins = np.asarray(n_bins)
+        if n_bins.ndim > 0:
+            n_bins = n_bins[:, None]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return counts / (dt * n_bins)
+
+
+def get_hmm_spike_index(rec_dir, unit_type, channel, time_start=None,
+                        time_end=None, dt=None, trials=None, area=None):
+    '''same query as get_hmm_spike_data but returns a cached
+    SpikeWindowIndex over the spike array instead of the array itself
+
+    Returns
+    -------
+    index : SpikeWindowIndex
+    dt : float
+    time : np.array
+    '''
+    path, mtime = file_key(h5io.get_h5_filename(rec_dir))
+    key = ('hmm_index', path, make_hashable(unit_type), channel, time_start,
+           time_end, dt, make_hashable(trials), area, mtime)
+
+    def loader():
+        spikes, s_dt, s_time = get_hmm_spike_data(rec_dir, unit_type, channel,
+                                                  time_start=time_start,
+                                                  time_end=time_end, dt=dt,
+                                                  trials=trials, area=area)
+        return SpikeWindowIndex(spikes, s_time), s_dt, s_time
+
+    return SPIKE_CACHE.get_or_load(key, loader)
+
+
+def cache_stats(verbose=True):
+    '''return (and optionally print) hit/miss statistics for the data caches'''
+    out = [HMM_CACHE.stats(), SPIKE_CACHE.stats()]
+    if verbose:
+        for s in out:
+            print('%s cache: %i hits, %i misses, %i evictions, %i entries, %.1f MB' %
+                  (s['name'], s['hits'], s['misses'], s['evictions'], s['entries'], s['nbytes'] / 1024 ** 2))
+    return out
+
+
+def clear_caches():
+    for cache in [HMM_CACHE, SPIKE_CACHE]:
+        cache.clear()
+        cache.reset_stats()
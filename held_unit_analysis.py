@@ -4,33 +4,19 @@ from joblib import Parallel, delayed
 import blechpy
 from blechpy import dio
 from multiprocessing import Pool
+import data_cache as dc
+import worker_budget as wb
 
 def get_held_resp(PA):
     PA.detect_held_units(overwrite=False)  # this part also gets the all units file
     [all_units, held_df] = PA.get_unit_info(overwrite=False)  # run and check for correct area then run get best hmm
 
-    # check df for nan in HMMID or early or late state
-    held_df = held_df[held_df.held != False]
-    held_df.reset_index(drop=True, inplace=True)
-    id_vars = ['held_unit_name', 'exp_group', 'exp_name', 'held', 'area']
-    filter_cols = id_vars + ["rec1", "rec2", "unit1", "unit2"]
-    held_df = held_df[filter_cols]
-    held_df_long = pd.melt(held_df, id_vars=id_vars, value_vars=['rec1', 'rec2'], value_name='rec_dir',
-                           var_name='rec_order')
-    held_df_long2 = pd.melt(held_df, id_vars=id_vars, value_vars=['unit1', 'unit2'], value_name='unit_num',
-                            var_name='unit_order')
-    # drop the unit_order columns
-    held_df_long = held_df_long.drop(['rec_order'], axis=1)
-    held_df_long2 = held_df_long2.drop(['unit_order'], axis=1)
-
-    held_df_long = pd.concat([held_df_long, held_df_long2], axis=1)
-
-    final_cols = ['held_unit_name', 'exp_group', 'exp_name', 'held', 'rec_dir', 'unit_num']
-    held_df_long = held_df_long[final_cols]
-    # remove the  duplicated columns
-    held_df_long = held_df_long.T.drop_duplicates().T
-    held_df_long = held_df_long.drop_duplicates()
-    held_df_long['unit_name'] = held_df_long['unit_num']
+    # every unit that is part of a held unit, from the held-unit graph
+    held_df_long = PA.get_held_unit_graph().held_units()
+    held_df_long = held_df_long[['held_unit_name', 'exp_group', 'exp_name', 'rec_dir', 'unit_name']].copy()
+    held_df_long.insert(3, 'held', True)
+    held_df_long.insert(5, 'unit_num', held_df_long['unit_name'])
+    held_df_long = held_df_long.reset_index(drop=True)
 
     resp_units, pal_units = PA.process_single_units(
         overwrite=False)  # run the single-unit analysis, check function to see if all parts are working
@@ -44,7 +30,7 @@ def get_held_resp(PA):
 
     return held_resp
 
-def get_arrays(name, group, query_name='spike_array', query_func=dio.h5io.get_spike_data):
+def get_arrays(name, group, query_name='spike_array', query_func=dc.get_spike_data):
     # get spike arrays or rate arrays (or whatever) for each unit in each recording
     # use the query_func to get the arrays
     # query_name
@@ -109,7 +95,7 @@ def get_rate_array_df(PA):
     held_resp = get_held_resp(PA)
     groups = list(held_resp.groupby(['rec_dir']))
     # Use multiprocessing to process each group in parallel
-    with Pool(processes=4) as pool:  # Adjust the number of processes based on your CPU cores
+    with wb.Pool(processes=4, n_tasks=len(groups)) as pool:  # Adjust the number of processes based on your CPU cores
         results = pool.starmap(get_rate_arrays, groups)
 
     # Flatten the results and construct the DataFrame
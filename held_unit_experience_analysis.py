@@ -422,22 +422,12 @@ def process_nonlinear_regression(rate_array_df, trial_col='session_trial', value
                  'level_4': 'session', 0: 'r2'})
     r2_df_groupmean = r2_df.groupby(['exp_group', 'taste', 'session']).mean().reset_index()
 
-    modeled = []
-    alpha = []
-    beta = []
-    c = []
-    for i, row in rate_array_df.iterrows():
-        group = row[groupings]
-        pr = params[tuple(group)]
-        modeled.append(ta.model(row[trial_col], *pr))
-        alpha.append(pr[0])
-        beta.append(pr[1])
-        c.append(pr[2])
+    pr = ta.map_group_values(rate_array_df, params, groupings)
     modeled_str = 'modeled_' + value_col
-    rate_array_df[modeled_str] = modeled
-    rate_array_df['alpha'] = alpha
-    rate_array_df['beta'] = beta
-    rate_array_df['c'] = c
+    rate_array_df[modeled_str] = ta.model(rate_array_df[trial_col].to_numpy(dtype=float), pr[:, 0], pr[:, 1], pr[:, 2])
+    rate_array_df['alpha'] = pr[:, 0]
+    rate_array_df['beta'] = pr[:, 1]
+    rate_array_df['c'] = pr[:, 2]
     rate_array_df['alpha_pos'] = rate_array_df['alpha'] > 0
 
     for nm, group in rate_array_df.groupby(groupings):
@@ -470,7 +460,7 @@ def process_nonlinear_regression(rate_array_df, trial_col='session_trial', value
     # calculate p-value for each unique held_unit_name in shuff
     names = []
     pvals = []
-    for name, group in shuff.groupby(['exp_group', 'exp_name', 'taste', 'held_unit_name', 'session']):
+    for name, group in shuff.groupby(['exp_group', 'exp_name', 'taste', 'held_unit_name', 'session'], observed=True):
         # get r2 for corresponding group in r2_df
         row = r2_df.loc[(r2_df.exp_group == name[0]) & (r2_df.exp_name == name[1]) & (r2_df.taste == name[2]) & (
                     r2_df.held_unit_name == name[3]) & (r2_df.session == name[4])]
@@ -494,8 +484,8 @@ def process_nonlinear_regression(rate_array_df, trial_col='session_trial', value
     r2_df_groupmean_sig = r2_df.groupby(['exp_group', 'taste', 'session']).mean().reset_index()
 
     # save shuff as feather datafr
-    avg_shuff_sig = shuff_sig.groupby(['exp_group', 'session', 'taste', 'iternum']).mean().reset_index()
-    avg_shuff = shuff.groupby(['exp_group', 'session', 'taste', 'iternum']).mean().reset_index()
+    avg_shuff_sig = shuff_sig.groupby(['exp_group', 'session', 'taste', 'iternum'], observed=True).mean().reset_index()
+    avg_shuff = shuff.groupby(['exp_group', 'session', 'taste', 'iternum'], observed=True).mean().reset_index()
     # %% plot the r2 values for each session with the null distribution
     save_flag = trial_col + '_' + value_col
     ta.plot_null_dist(avg_shuff, r2_df_groupmean, save_flag=save_flag, save_dir=PA.save_dir)
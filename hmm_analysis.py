@@ -16,7 +16,10 @@ from tqdm import tqdm
 import pingouin as pg
 from joblib import Parallel, delayed, cpu_count
 from collections import Counter
+from time import perf_counter
 import aggregation as agg
+import data_cache as dc
+import worker_budget as wb
 import itertools
 from statistics import median
 import analysis as ana
@@ -85,7 +88,7 @@ def get_state_breakdown(rec_dir, hmm_id, h5_file=None):
         handler = ph.HmmHandler(rec_dir)
         hmm, hmm_time, params = handler.get_hmm(hmm_id)
     else:
-        hmm, hmm_time, params = ph.load_hmm_from_hdf5(h5_file, hmm_id)
+        hmm, hmm_time, params = dc.load_hmm_from_hdf5(h5_file, hmm_id)
 
     hmm_id = params['hmm_id']
     n_states = params['n_states']
@@ -97,10 +100,10 @@ def get_state_breakdown(rec_dir, hmm_id, h5_file=None):
     unit_type = params['unit_type']
     channel = params['channel']
     n_trials = params['n_trials']
-    spikes, dt, time = ph.get_hmm_spike_data(rec_dir, unit_type, channel,
-                                             time_start=time_start,
-                                             time_end=time_end, dt=dt,
-                                             trials=n_trials)
+    spike_idx, dt, time = dc.get_hmm_spike_index(rec_dir, unit_type, channel,
+                                                 time_start=time_start,
+                                                 time_end=time_end, dt=dt,
+                                                 trials=n_trials)
     #best_paths = hmm.stat_arrays['best_sequences'].astype('int')
     paths = hmm.stat_arrays['gamma_probabilities']
     best_paths = paths.argmax(axis=1)
@@ -128,7 +131,7 @@ def get_state_breakdown(rec_dir, hmm_id, h5_file=None):
            'recurrence_in_trial': None}
 
     out = []
-    for trial, (trial_path, trial_spikes) in enumerate(zip(best_paths, spikes)):
+    for trial, trial_path in enumerate(best_paths):
         trial_order = get_absolute_order(trial_path)
         tmp_path = trial_path.copy()
         tmp_time = hmm_time.copy()
@@ -156,8 +159,9 @@ def get_state_breakdown(rec_dir, hmm_id, h5_file=None):
             tmp_row['duration'] = tmp_row['t_end'] - tmp_row['t_start']
 
             # Compute cost
-            idx = np.where((time >= tmp_row['t_start']) & (time <= tmp_row['t_end']))[0]
-            fr = np.sum(trial_spikes[:, idx], axis=1) / (tmp_row['duration']/1000)
+            counts, _ = spike_idx.counts(tmp_row['t_start'], tmp_row['t_end'],
+                                         trials=trial, inclusive=True)
+            fr = counts / (tmp_row['duration']/1000)
             est = hmm.emission[:, state]
             tmp_row['cost'] = np.sum((fr-est)**2)**0.5
             out.append(tmp_row)
@@ -175,7 +179,7 @@ def check_ll_asymptote(row):
     hmm_id = row['hmm_id']
     n_iter = row['n_iterations']-1
     h5_file = get_hmm_h5(rec_dir)
-    hmm, time, params = ph.load_hmm_from_hdf5(h5_file, hmm_id)
+    hmm, time, params = dc.load_hmm_from_hdf5(h5_file, hmm_id)
     ll_hist = hmm.stat_arrays['fit_LL']
     filt_ll = gaussian_filter1d(ll_hist, 4)
     # TODO: Finish this
@@ -206,7 +210,7 @@ def get_early_and_late_firing_rates(rec_dir, hmm_id, early_state, late_state, un
     early state
     '''
     h5_file = get_hmm_h5(rec_dir)
-    hmm , time, params = ph.load_hmm_from_hdf5(h5_file, hmm_id)
+    hmm , time, params = dc.load_hmm_from_hdf5(h5_file, hmm_id)
     channel = params['channel']
     n_trials = params['n_trials']
     t_start = params['t_start']
@@ -215,13 +219,13 @@ def get_early_and_late_firing_rates(rec_dir, hmm_id, early_state, late_state, un
     if units is None:
         units = params['unit_type']
 
-    spike_array, dt, s_time = ph.get_hmm_spike_data(rec_dir, units,
-                                                      channel,
-                                                      time_start=t_start,
-                                                      time_end=t_end, dt=dt,
-                                                      trials=n_trials)
+    spike_idx, dt, s_time = dc.get_hmm_spike_index(rec_dir, units,
+                                                   channel,
+                                                   time_start=t_start,
+                                                   time_end=t_end, dt=dt,
+                                                   trials=n_trials)
     # spike_array is trial x neuron x time
-    n_trials, n_cells, n_steps = spike_array.shape
+    n_trials, n_cells, n_steps = spike_idx.shape
     early_rates = []
     late_rates = []
     dropped_trials = []
@@ -229,7 +233,7 @@ def get_early_and_late_firing_rates(rec_dir, hmm_id, early_state, late_state, un
     paths = hmm.stat_arrays['gamma_probabilities']
     paths = paths.argmax(axis=1)
 
-    for trial, (spikes, path) in enumerate(zip(spike_array, paths)):
+    for trial, path in enumerate(paths[:n_trials]):
         if not early_state in path or not late_state in path:
             dropped_trials.append(trial)
             continue
@@ -265,10 +269,8 @@ def get_early_and_late_firing_rates(rec_dir, hmm_id, early_state, late_state, un
         lt1 = time[li1]
         lt2 = time[li2]
         labels.append((trial, et1, et2, lt1, lt2))
-        e_si = np.where((s_time >= et1) & (s_time < et2))[0]
-        l_si = np.where((s_time >= lt1) & (s_time < lt2))[0]
-        e_tmp = np.sum(spikes[:, e_si], axis=-1) / (dt*len(e_si))
-        l_tmp = np.sum(spikes[:, l_si], axis=-1) / (dt*len(l_si))
+        e_tmp = spike_idx.rates(et1, et2, dt, trials=trial)
+        l_tmp = spike_idx.rates(lt1, lt2, dt, trials=trial)
         early_rates.append(e_tmp)
         late_rates.append(l_tmp)
 
@@ -288,7 +290,7 @@ def write_id_pal_to_text(save_file, group, early_id=None,
         rec_dir = row['rec_dir']
         hmm_id = row['hmm_id']
         h5_file = get_hmm_h5(rec_dir)
-        hmm, time, params = ph.load_hmm_from_hdf5(h5_file, hmm_id)
+        hmm, time, params = dc.load_hmm_from_hdf5(h5_file, hmm_id)
         paths = hmm.stat_arrays['gamma_probabilities']
         paths = paths.argmax(axis=1)
         state_map = deduce_state_order(paths)
@@ -388,7 +390,7 @@ def get_state_firing_rates(rec_dir, hmm_id, state, units=None, min_dur=50, max_d
 
     '''
     h5_file = get_hmm_h5(rec_dir)
-    hmm , time, params = ph.load_hmm_from_hdf5(h5_file, hmm_id)
+    hmm , time, params = dc.load_hmm_from_hdf5(h5_file, hmm_id)
     channel = params['channel']
     n_trials = params['n_trials']
     t_start = params['time_start']
@@ -400,15 +402,13 @@ def get_state_firing_rates(rec_dir, hmm_id, state, units=None, min_dur=50, max_d
     seqs = paths.argmax(axis=1)
     if units is not None:
         unit_type = units
-    spike_array, s_dt, s_time = ph.get_hmm_spike_data(rec_dir, unit_type,
-                                                      channel,
-                                                      time_start=t_start,
-                                                      time_end=t_end, dt=dt,
-                                                      trials=n_trials, area=area)
+    spike_idx, s_dt, s_time = dc.get_hmm_spike_index(rec_dir, unit_type,
+                                                     channel,
+                                                     time_start=t_start,
+                                                     time_end=t_end, dt=dt,
+                                                     trials=n_trials, area=area)
     if s_time[0] < 0:
-        idx = np.where(s_time < 0)[0]
-        prestim = spike_array[:,:, idx]
-        prestim = np.sum(prestim, axis=-1) / (s_dt*len(idx))
+        prestim = spike_idx.rates(s_time[0], 0, s_dt)
         baseline = np.mean(prestim, axis=0)
     else:
         baseline = 0
@@ -422,7 +422,7 @@ def get_state_firing_rates(rec_dir, hmm_id, state, units=None, min_dur=50, max_d
     trial_nums = []
     start_times = []
     end_times = []
-    for trial, (spikes, path) in enumerate(zip(spike_array, seqs)):
+    for trial, path in enumerate(seqs[:spike_idx.shape[0]]):
         
         if trial not in valid_trials: # Skip if state is not in trial
             continue
@@ -443,8 +443,7 @@ def get_state_firing_rates(rec_dir, hmm_id, state, units=None, min_dur=50, max_d
         t1 = time[onidx]
         t2 = time[offidx]
 
-        si = np.where((s_time >= t1) & (s_time < t2))[0]
-        tmp = np.sum(spikes[:, si], axis=-1) / (dt*len(si))
+        tmp = spike_idx.rates(t1, t2, dt, trials=trial)
         if remove_baseline and s_time[0] < 0:
             tmp = tmp - baseline
             
@@ -474,9 +473,120 @@ def get_state_firing_rates(rec_dir, hmm_id, state, units=None, min_dur=50, max_d
 
     return np.array(rates), np.array(trial_nums), np.array(start_times), np.array(end_times)
 
+def get_all_state_firing_rates(rec_dir, hmm_id, units=None, min_dur=50,
+                               remove_baseline=False):
+    '''computes the firing rates of every state of an hmm in one pass. For each
+    trial and state this uses the same rules as get_state_firing_rates: the
+    longest instance of the state in the trial is used, the state must have at
+    least 50ms of consecutive points and last longer than min_dur. Results
+    are cached so state combinations can be assembled by indexing.
+
+    Parameters
+    ----------
+    rec_dir : str, recording directory
+    hmm_id : int, id number of the hmm to get states from
+    units: list of str, optional
+        which unit names to use. if not provided units are queried based on hmm
+        params
+    min_dur: int, optional
+        minimum duration in ms of a state for it to be used. Default is 50ms.
+    remove_baseline: bool, subtract the mean prestimulus rate of each unit
+
+    Returns
+    -------
+    rates : np.ndarray, Trials x States x Neurons firing rates, NaN where invalid
+    valid : np.ndarray, Trials x States boolean mask of usable state instances
+    start_times : np.ndarray, Trials x States start time of each state instance
+    end_times : np.ndarray, Trials x States end time of each state instance
+    '''
+    h5_file = get_hmm_h5(rec_dir)
+    path, mtime = dc.file_key(h5_file)
+    key = ('state_rates', path, int(hmm_id), dc.make_hashable(units), min_dur,
+           remove_baseline, mtime)
+
+    def loader():
+        hmm, time, params = dc.load_hmm_from_hdf5(h5_file, hmm_id)
+        channel = params['channel']
+        n_trials = params['n_trials']
+        t_start = params['time_start']
+        t_end = params['time_end']
+        dt = params['dt']
+        unit_type = params['unit_type'] if units is None else units
+        area = params['area']
+        paths = hmm.stat_arrays['gamma_probabilities']
+        n_states = paths.shape[1]
+        seqs = paths.argmax(axis=1)
+        spike_idx, s_dt, s_time = dc.get_hmm_spike_index(rec_dir, unit_type,
+                                                         channel,
+                                                         time_start=t_start,
+                                                         time_end=t_end, dt=dt,
+                                                         trials=n_trials, area=area)
+        seqs = seqs[:spike_idx.shape[0]]
+        n_tr = seqs.shape[0]
+        min_pts = 50/(dt*1000)
+
+        # longest run of each state in each trial, ties go to the first run
+        on_idx = np.zeros((n_tr, n_states), dtype=int)
+        run_len = np.zeros((n_tr, n_states), dtype=int)
+        for trial, seq in enumerate(seqs):
+            summary = agg.summarize_sequence(seq)
+            if len(summary) == 0 or len(np.unique(seq)) == 1:
+                continue
+            for st, start, _, n in summary[::-1]:
+                if n >= run_len[trial, st]:
+                    run_len[trial, st] = n
+                    on_idx[trial, st] = start
+
+        present = (run_len >= min_pts) & (run_len > 0)
+        off_idx = on_idx + np.maximum(run_len, 1) - 1
+        start_times = time[on_idx]
+        end_times = time[off_idx]
+        valid = present & (np.abs(end_times - start_times) > min_dur)
+
+        n_units = spike_idx.shape[1]
+        rates = np.full((n_tr, n_states, n_units), np.nan)
+        tr, st = np.where(valid)
+        if len(tr) > 0:
+            rates[tr, st] = spike_idx.rates(start_times[tr, st], end_times[tr, st],
+                                            dt, trials=tr)
+
+        if remove_baseline and s_time[0] < 0:
+            baseline = np.mean(spike_idx.rates(s_time[0], 0, s_dt), axis=0)
+            rates = rates - baseline
+
+        start_times = np.where(valid, start_times, np.nan)
+        end_times = np.where(valid, end_times, np.nan)
+        return (dc.read_only(rates), dc.read_only(valid),
+                dc.read_only(start_times), dc.read_only(end_times))
+
+    return dc.SPIKE_CACHE.get_or_load(key, loader)
+
+
+def get_state_rates_from_tensor(state_rates, state):
+    '''pulls the output of get_state_firing_rates for one state out of the
+    output of get_all_state_firing_rates
+
+    Returns
+    -------
+    rates, trial_nums, start_times, end_times
+
+    Raises
+    ------
+    Exception : if the state's firing rates are NaN (empty spike array), as
+        get_state_firing_rates does
+    '''
+    rates, valid, start_times, end_times = state_rates
+    trials = np.where(valid[:, state])[0]
+    if len(trials) > 0 and any(np.isnan(rates[trials[0], state])):
+        raise Exception("empty spike array")
+
+    return (rates[trials, state], trials, start_times[trials, state],
+            end_times[trials, state])
+
+
 def get_baseline_rates(rec_dir, hmm_id, units=None, min_dur=50, max_dur = 3000,):
     h5_file = get_hmm_h5(rec_dir)
-    hmm , time, params = ph.load_hmm_from_hdf5(h5_file, hmm_id)
+    hmm , time, params = dc.load_hmm_from_hdf5(h5_file, hmm_id)
     channel = params['channel']
     n_trials = params['n_trials']
     t_start = -250#params['time_start']
@@ -486,7 +596,7 @@ def get_baseline_rates(rec_dir, hmm_id, units=None, min_dur=50, max_dur = 3000,)
     area = params['area']
     if units is not None:
         unit_type = units
-    spike_array, s_dt, s_time = ph.get_hmm_spike_data(rec_dir, unit_type,
+    spike_array, s_dt, s_time = dc.get_hmm_spike_data(rec_dir, unit_type,
                                                       channel,
                                                       time_start=t_start,
                                                       time_end=t_end, dt=dt,
@@ -516,11 +626,10 @@ def get_classifier_data(group, states, label_col, all_units,
         
         un = units[rec_dir]
         #if error is "selection lists cannot have repeated values" then you have repeated units in all_units, go fix PA.detect_held_units()
+        state_rates = get_all_state_firing_rates(rec_dir, hmm_id, units=un,
+                                                 remove_baseline=remove_baseline)
         #get baseline data:
-        tmp_ps_r, tmp_ps_trials ,start, end = get_state_firing_rates(rec_dir,hmm_id,b_state,
-                                                    units = un,
-                                                    remove_baseline=remove_baseline,
-                                                    other_state=None)
+        tmp_ps_r, tmp_ps_trials ,start, end = get_state_rates_from_tensor(state_rates, b_state)
         tmp_ps_l = np.repeat('prestim', tmp_ps_r.shape[0])
         
         tmp_ps_id = [(rec_dir,hmm_id,row[label_col], x, b_state, True) for x in tmp_ps_trials]
@@ -533,10 +642,7 @@ def get_classifier_data(group, states, label_col, all_units,
             continue
             
         #get early state data:
-        tmp_e_r, tmp_e_trials ,start, end = get_state_firing_rates(rec_dir, hmm_id, e_state,
-                                                   units=un,
-                                                   remove_baseline=remove_baseline,
-                                                   other_state=None)
+        tmp_e_r, tmp_e_trials ,start, end = get_state_rates_from_tensor(state_rates, e_state)
         
         tmp_e_l = np.repeat(row[label_col]+'_early', tmp_e_r.shape[0])
         tmp_e_id = [(rec_dir, hmm_id, row[label_col], x, e_state, False) for x in tmp_e_trials]
@@ -547,10 +653,7 @@ def get_classifier_data(group, states, label_col, all_units,
             identifiers.extend(tmp_e_id)
         
         #get late state data:
-        tmp_l_r, tmp_l_trials ,start, end = get_state_firing_rates(rec_dir, hmm_id, l_state,
-                                                   units=un,
-                                                   remove_baseline=remove_baseline,
-                                                   other_state=None) 
+        tmp_l_r, tmp_l_trials ,start, end = get_state_rates_from_tensor(state_rates, l_state)
         tmp_l_l = np.repeat(row[label_col]+'_late', tmp_l_r.shape[0])
         tmp_l_id = [(rec_dir, hmm_id, row[label_col], x, l_state, False) for x in tmp_l_trials]
         
@@ -643,28 +746,28 @@ def get_classifier_data2(group, states, label_col, all_units,
 
 #the error that happens is that all_units has duplicate entries for DS39, must filter them out at some point
 def get_common_units(group, all_units):
-    held = np.array(all_units.held_unit_name.unique())
+    '''units held across every recording in group
+
+    Parameters
+    ----------
+    group : pd.DataFrame, rows with rec_dir
+    all_units : pd.DataFrame or agg.HeldUnitGraph. Callers that look up many
+        groups should build the graph once with
+        agg.HeldUnitGraph.from_all_units and pass it instead of the table
+
+    Returns
+    -------
+    dict of rec_dir -> list of unit names. With a single recording all of
+    its units are returned
+    '''
+    if not isinstance(all_units, agg.HeldUnitGraph):
+        all_units = agg.HeldUnitGraph.from_all_units(all_units)
     rec_dirs = group.rec_dir.unique()
     if len(rec_dirs) == 1:
         rd = rec_dirs[0]
-        out = {rd: all_units.query('rec_dir == @rd')['unit_name'].to_list()}
-        return out
-
-    for rd in group.rec_dir.unique():
-        tmp = all_units.query('rec_dir == @rd').dropna(subset=['held_unit_name'])
-        units = np.array(tmp['held_unit_name'])
-        held = np.intersect1d(held, units)
-
-    out = {}
-    if len(held) == 0:
-        return out
+        return {rd: all_units.units_in(rd)}
 
-    for rd in group.rec_dir.unique():
-        tmp = all_units[all_units['held_unit_name'].isin(held) &
-                        (all_units['rec_dir'] == rd)]
-        out[rd] = tmp['unit_name'].to_list()
-
-    return out
+    return all_units.units_held_across(rec_dirs)
 
 def check_single_state_trials(row, min_dur=1):
     '''takes a row from hmm_overview and determines the number of single state decoded paths
@@ -674,7 +777,7 @@ def check_single_state_trials(row, min_dur=1):
     rec_dir = row['rec_dir']
     hmm_id = row['hmm_id']
     h5_file = get_hmm_h5(rec_dir)
-    hmm, time, params = ph.load_hmm_from_hdf5(h5_file, hmm_id)
+    hmm, time, params = dc.load_hmm_from_hdf5(h5_file, hmm_id)
     dt = params['dt'] * 1000  # convert from sec to ms
     min_idx = int(min_dur/dt)
     #paths = hmm.stat_arrays['best_sequences']
@@ -1005,13 +1108,16 @@ def sequential_constrained(PI, A, B):
     return PI, A, B
 
 #Rabbit hole: NB_classifier_accuracy>get_classifier_data>get_state_firing_rates
-def analyze_NB_state_classification(best_hmms,all_units):
+def analyze_NB_state_classification(best_hmms,all_units, pruned=False):
     '''generates list of combinations (state_df) for every possible combination of HMM states 
     and then uses them as the prior for decoding
     Parameters
     ----------
     best_hmms : Produced by HA.get_best_hmms() 
     all_units : Produced by PA.get_unit_info()
+    pruned : bool, skip combos that cannot beat the best performance found
+        (see StateComboDecoder.search). Gives the same best combos but
+        NB_meta only holds the decoded ones
     Returns
     -------
     NB_res : list with every single decode
@@ -1023,6 +1129,7 @@ def analyze_NB_state_classification(best_hmms,all_units):
     id_cols = ['exp_name','exp_group','time_group']
 
     all_u = all_units.query('area == "GC" and single_unit == True')
+    all_u = agg.HeldUnitGraph.from_all_units(all_u)
     best_hmms_ = best_hmms.dropna(subset=['hmm_id'])
     best_hmms_['single_state_trials'] = best_hmms_.apply(lambda x: check_single_state_trials(x, min_dur=50), axis=1)
 
@@ -1034,16 +1141,13 @@ def analyze_NB_state_classification(best_hmms,all_units):
         n_trials = dict(zip(group.taste,group.n_trials))
         n_single_state = dict(zip(group.taste,group.single_state_trials))
         en = name[0]; eg = name[1]; tg = name[2]
+        decoder = StateComboDecoder(group, all_u, label_col=label_col,
+                                    remove_baseline=False)
         
-        for i, states in state_df.iterrows():
+        for i, states, res in decoder.search(state_df, pruned=pruned):
             #res = NB_classifier_accuracy(group,row,label_col,all_units, other_state)
             
-            labels, rates, identifiers = get_classifier_data(group, states, label_col, all_u,
-                                                             remove_baseline=False)
-            
-            if (labels is not None) & (rates is not None):
-                model = stats.NBClassifier(labels, rates, row_id=identifiers)
-                res = model.leave1out_fit()
+            if res is not None:
                 NB_res.append(res)  
                 n_trials_decoded = []
                 
@@ -1083,12 +1187,14 @@ def analyze_NB_state_classification(best_hmms,all_units):
                 print('decode:', name,' ',i)
                 print(meta_row)
                 metadict.append(meta_row)
+        decoder.print_stats()
                 
     NB_meta = pd.DataFrame(metadict)
     
     NB_meta['earlyness'] = [x.sum() for x in NB_meta.hmm_state]
     NB_meta['tot_trials'] = pd.DataFrame(list(NB_meta.n_trials)).sum(axis=1)
     NB_meta['performance'] = (1-(NB_meta['n_trials_missed']/NB_meta['tot_trials']))*NB_meta['taste_acc'] #(NB_meta['accuracies']*1E-2)
+    dc.cache_stats()
     
     return NB_res, NB_meta #should do process_NB_classification next
 
@@ -1100,6 +1206,7 @@ def NB_state_classification(best_hmms, all_units):
     id_cols = ['exp_name', 'exp_group', 'time_group']
 
     all_units = all_units.query('area == "GC" and single_unit == True')
+    all_units = agg.HeldUnitGraph.from_all_units(all_units)
     best_hmms_ = best_hmms.dropna(subset=['hmm_id'])
     best_hmms_['single_state_trials'] = best_hmms_.apply(lambda x: check_single_state_trials(x, min_dur=50), axis=1)
 
@@ -1122,12 +1229,13 @@ def NB_classify_rec(group, units):
         rec_dir = row['rec_dir']
         un = units[rec_dir]
         h5 = get_hmm_h5(rec_dir)
-        hmm, _, _ = ph.load_hmm_from_hdf5(h5, row['hmm_id'])
+        hmm, _, _ = dc.load_hmm_from_hdf5(h5, row['hmm_id'])
+        state_rates = get_all_state_firing_rates(rec_dir, row['hmm_id'], units=un,
+                                                 remove_baseline=False)
 
         for i in range(hmm.n_states):
             label = row['taste'] + '_' + str(i)
-            tmp_r, tmp_trials , start, end = get_state_firing_rates(row['rec_dir'], row['hmm_id'], i, units=un, other_state=None,
-                                                       remove_baseline=False)
+            tmp_r, tmp_trials , start, end = get_state_rates_from_tensor(state_rates, i)
             tmp_id = [(rec_dir, row['hmm_id'], row['taste'], x, i) for x in tmp_trials]
             # for each index in dim 0 of tmp_r, append the label and id
             trials.extend(tmp_trials)
@@ -1180,6 +1288,196 @@ def NB_classify_rec(group, units):
 
 
 
+class StateComboDecoder(object):
+    '''Leave-one-out NB decoding of state combinations for one group of HMMs
+    (one row per taste). The rates, labels and sufficient statistics of each
+    (taste row, state, role) block are computed once and reused by every
+    combination that includes them, so a combination only costs assembling
+    blocks and the closed-form leave-one-out fit.
+
+    Parameters
+    ----------
+    group : pd.DataFrame, best_hmms rows for one exp_name/exp_group/time_group
+    all_units : pd.DataFrame, unit table used to find units common to all rows
+    label_col : str, column of group holding the class label (taste)
+    remove_baseline : bool, passed to get_all_state_firing_rates
+
+    Attributes
+    ----------
+    n_combos : int, number of combinations decoded
+    n_skipped : int, number of combinations pruned by the last search
+    cache_hits, cache_misses : int, block cache reuse counters
+    combo_times : list of float, seconds spent on each combination
+    '''
+
+    roles = {'bsln': 'prestim', 'early': '_early', 'late': '_late'}
+
+    def __init__(self, group, all_units, label_col='taste', remove_baseline=False):
+        self.group = group
+        self.label_col = label_col
+        self.remove_baseline = remove_baseline
+        self.units = get_common_units(group, all_units)
+        self._blocks = {}
+        self.n_combos = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.combo_times = []
+        self.n_skipped = 0
+
+    def get_block(self, row_idx, state, role):
+        '''returns (rates, labels, identifiers, stats) for the first instance
+        of state in each valid trial of the hmm in group row row_idx'''
+        key = (row_idx, int(state), role)
+        if key in self._blocks:
+            self.cache_hits += 1
+            return self._blocks[key]
+
+        self.cache_misses += 1
+        row = self.group.loc[row_idx]
+        rec_dir = row['rec_dir']
+        hmm_id = int(row['hmm_id'])
+        label = row[self.label_col]
+        state_rates = get_all_state_firing_rates(rec_dir, hmm_id,
+                                                 units=self.units[rec_dir],
+                                                 remove_baseline=self.remove_baseline)
+        rates, trials, _, _ = get_state_rates_from_tensor(state_rates, state)
+        if role == 'bsln':
+            lbl = 'prestim'
+        else:
+            lbl = label + self.roles[role]
+        labels = np.repeat(lbl, rates.shape[0])
+        ids = [(rec_dir, hmm_id, label, x, state, role == 'bsln') for x in trials]
+        block = (rates, labels, ids, stats.gaussian_class_stats(rates))
+        self._blocks[key] = block
+        return block
+
+    def get_classifier_data(self, states):
+        '''same output as get_classifier_data, plus the per-label sufficient
+        statistics merged from the cached blocks'''
+        if self.units == {}:
+            return None, None, None, None
+
+        blocks = []
+        for i, row in self.group.iterrows():
+            label = row[self.label_col]
+            b_block = self.get_block(i, states[label + '_bsln'], 'bsln')
+            if len(b_block[0]) == 0:
+                continue
+
+            blocks.append(b_block)
+            for role in ['early', 'late']:
+                block = self.get_block(i, states[label + '_' + role], role)
+                if len(block[0]) != 0:
+                    blocks.append(block)
+
+        if len(blocks) == 0:
+            return None, None, None, None
+
+        labels = np.concatenate([b[1] for b in blocks])
+        rates = np.vstack([b[0] for b in blocks])
+        identifiers = np.array([x for b in blocks for x in b[2]])
+        class_stats = {}
+        for lbl in np.unique(labels):
+            class_stats[lbl] = stats.merge_gaussian_stats([b[3] for b in blocks
+                                                           if len(b[1]) > 0 and b[1][0] == lbl])
+        return labels, rates, identifiers, class_stats
+
+    def decode(self, states):
+        '''leave-one-out NB decoding of one state combination, returns a
+        ClassifierResult or None if there is no data'''
+        t0 = perf_counter()
+        labels, rates, identifiers, class_stats = self.get_classifier_data(states)
+        res = None
+        if (labels is not None) & (rates is not None):
+            model = stats.NBClassifier(labels, rates, row_id=identifiers)
+            res = model.leave1out_fit(class_stats=class_stats)
+
+        self.n_combos += 1
+        self.combo_times.append(perf_counter() - t0)
+        return res
+
+    def n_decoded_trials(self, states):
+        '''number of early/late samples a combination yields, from the cached
+        block sizes and without fitting'''
+        n = 0
+        for i, row in self.group.iterrows():
+            label = row[self.label_col]
+            if len(self.get_block(i, states[label + '_bsln'], 'bsln')[0]) == 0:
+                continue
+
+            for role in ['early', 'late']:
+                n += len(self.get_block(i, states[label + '_' + role], role)[0])
+
+        return n
+
+    def performance(self, res):
+        '''the performance score used to pick the best combination,
+        (1 - n_trials_missed/tot_trials) * taste_acc'''
+        tot = sum(dict(zip(self.group[self.label_col], self.group.n_trials)).values())
+        tasteidx = res.Y != 'prestim'
+        taste_acc = np.sum(res.Y[tasteidx] == res.Y_predicted[tasteidx]) / np.sum(tasteidx)
+        n_missed = np.sum(self.group.n_trials*2) - np.sum(tasteidx)
+        return (1 - n_missed/tot) * taste_acc
+
+    def performance_bound(self, states):
+        '''upper bound on performance for a combination: taste_acc <= 1 and
+        the number of decoded trials is known from the block sizes'''
+        tot = sum(dict(zip(self.group[self.label_col], self.group.n_trials)).values())
+        n_missed = np.sum(self.group.n_trials*2) - self.n_decoded_trials(states)
+        return max(1 - n_missed/tot, 0)
+
+    def search(self, state_df, pruned=False):
+        '''decodes the combinations in state_df, yielding (index, states,
+        ClassifierResult) in the order of state_df. If pruned, combinations
+        are decoded in order of decreasing performance bound and those whose
+        bound is strictly below the best performance found are skipped. The
+        best combination (and any ties) is always decoded, so the result of
+        process_NB_classification is unchanged.
+        '''
+        self.n_skipped = 0
+        if not pruned:
+            for i, states in state_df.iterrows():
+                yield i, states, self.decode(states)
+            return
+
+        bounds = pd.Series([self.performance_bound(states) for _, states in state_df.iterrows()],
+                           index=state_df.index)
+        order = bounds.sort_values(ascending=False, kind='mergesort').index
+        best = -np.inf
+        results = {}
+        for i in order:
+            if bounds[i] < best:
+                self.n_skipped += 1
+                continue
+
+            res = self.decode(state_df.loc[i])
+            results[i] = res
+            if res is not None:
+                perf = self.performance(res)
+                if perf > best:
+                    best = perf
+
+        for i, states in state_df.iterrows():
+            if i in results:
+                yield i, states, results[i]
+
+    def stats(self):
+        total = self.cache_hits + self.cache_misses
+        return {'combos_evaluated': self.n_combos,
+                'combos_skipped': self.n_skipped,
+                'block_cache_hits': self.cache_hits,
+                'block_cache_misses': self.cache_misses,
+                'block_reuse': self.cache_hits / total if total > 0 else np.nan,
+                'mean_combo_time': np.mean(self.combo_times) if self.combo_times else np.nan,
+                'total_time': np.sum(self.combo_times)}
+
+    def print_stats(self):
+        s = self.stats()
+        print('decoded %i combos (%i skipped), block cache %i hits / %i misses, %.4fs per combo (%.1fs total)' %
+              (s['combos_evaluated'], s['combos_skipped'], s['block_cache_hits'],
+               s['block_cache_misses'], s['mean_combo_time'], s['total_time']))
+
+
 def generate_state_combos(group):
     id_tastes = group.taste
     
@@ -1189,7 +1487,7 @@ def generate_state_combos(group):
     
     for i, row in group.iterrows():
         h5 = get_hmm_h5(row['rec_dir'])
-        hmm, _, _ = ph.load_hmm_from_hdf5(h5, row['hmm_id'])
+        hmm, _, _ = dc.load_hmm_from_hdf5(h5, row['hmm_id'])
         tmp = find_poss_epoch_states(hmm)
         
         b = np.unique(tmp[:,0])
@@ -1222,7 +1520,7 @@ def generate_state_combos(group):
     return state_df, el_tastes
 
 
-def nb_group(group, all_units):
+def nb_group(group, all_units, pruned=False):
     label_col = 'taste'
     state_df, el_tastes = generate_state_combos(group)
 
@@ -1231,62 +1529,59 @@ def nb_group(group, all_units):
     name = group[['exp_name','exp_group','time_group']].drop_duplicates().values.tolist()[0]
     en = name[0]; eg = name[1]; tg = name[2]
     NB_res, metadict = [], []
+    decoder = StateComboDecoder(group, all_units, label_col=label_col,
+                                remove_baseline=False)
     
-    for i, states in state_df.iterrows():
-
-        labels, rates, identifiers = get_classifier_data(group, states, label_col, all_units,
-                                                         remove_baseline=False) #092523: identifiers missing CA trials
-        
-        if (labels is not None) & (rates is not None):
-            model = stats.NBClassifier(labels, rates, row_id=identifiers)
-            res = model.leave1out_fit()
-
-            if (res is not None):
-                NB_res.append(res)
-                n_trials_decoded = []
-
-                res_frame = pd.DataFrame()
-                res_frame['X'] = list(res.X)
-                res_frame['Y'] = res.Y
-                res_frame['Y_pred'] = res.Y_predicted
-                res_frame['row_ID'] = list(res.row_id)
-
-                tasteidx = res.Y != 'prestim'
-                Y_taste = res.Y[tasteidx]
-                Y_pred_taste = res.Y_predicted[tasteidx]
-
-                tasteacc = sum(Y_taste==Y_pred_taste)/len(Y_taste)
-
-
-                for i in el_tastes:
-                    n_dec = np.count_nonzero(res.Y==i)
-                    n_trials_decoded.append(n_dec)
-
-                n_trials_missed = sum(group.n_trials*2)-sum(n_trials_decoded)
-                n_trials_decoded = dict(zip(el_tastes,n_trials_decoded))
-
-                meta_row = {'exp_name': en,
-                            'time_group': tg,
-                            'exp_group': eg,
-                            'accuracies': res.accuracy,
-                            'taste_acc': tasteacc,
-                            'hmm_state': states,
-                            'n_trials': n_trials,
-                            'n_single_state': n_single_state,
-                            'n_trials_dec': n_trials_decoded,
-                            'n_trials_missed': n_trials_missed
-                            }
-
-                meta_row.update(states)
-                print('decode:', name,' ',i)
-                print(meta_row)
-                metadict.append(meta_row)
-            
+    #092523: identifiers missing CA trials
+    for i, states, res in decoder.search(state_df, pruned=pruned):
+
+        if (res is not None):
+            NB_res.append(res)
+            n_trials_decoded = []
+
+            res_frame = pd.DataFrame()
+            res_frame['X'] = list(res.X)
+            res_frame['Y'] = res.Y
+            res_frame['Y_pred'] = res.Y_predicted
+            res_frame['row_ID'] = list(res.row_id)
+
+            tasteidx = res.Y != 'prestim'
+            Y_taste = res.Y[tasteidx]
+            Y_pred_taste = res.Y_predicted[tasteidx]
+
+            tasteacc = sum(Y_taste==Y_pred_taste)/len(Y_taste)
+
+
+            for i in el_tastes:
+                n_dec = np.count_nonzero(res.Y==i)
+                n_trials_decoded.append(n_dec)
+
+            n_trials_missed = sum(group.n_trials*2)-sum(n_trials_decoded)
+            n_trials_decoded = dict(zip(el_tastes,n_trials_decoded))
+
+            meta_row = {'exp_name': en,
+                        'time_group': tg,
+                        'exp_group': eg,
+                        'accuracies': res.accuracy,
+                        'taste_acc': tasteacc,
+                        'hmm_state': states,
+                        'n_trials': n_trials,
+                        'n_single_state': n_single_state,
+                        'n_trials_dec': n_trials_decoded,
+                        'n_trials_missed': n_trials_missed
+                        }
+
+            meta_row.update(states)
+            print('decode:', name,' ',i)
+            print(meta_row)
+            metadict.append(meta_row)
+
+    decoder.print_stats()
     meta = pd.DataFrame(metadict)
     return [NB_res, meta]
 
 
-def nb_lm_group(group, all_units):
+def nb_lm_group(group, all_units, pruned=False):
     label_col = 'taste'
     state_df, el_tastes = generate_state_combos(group)
 
@@ -1297,62 +1592,59 @@ def nb_lm_group(group, all_units):
     eg = name[1];
     tg = name[2]
     NB_res, metadict = [], []
-
-    for i, states in state_df.iterrows():
-
-        labels, rates, identifiers = get_classifier_data(group, states, label_col, all_units,
-                                                         remove_baseline=False)  # 092523: identifiers missing CA trials
-
-        if (labels is not None) & (rates is not None):
-            model = stats.NBClassifier(labels, rates, row_id=identifiers)
-            res = model.leave1out_fit()
-
-            if (res is not None):
-                NB_res.append(res)
-                n_trials_decoded = []
-
-                res_frame = pd.DataFrame()
-                res_frame['X'] = list(res.X)
-                res_frame['Y'] = res.Y
-                res_frame['Y_pred'] = res.Y_predicted
-                res_frame['row_ID'] = list(res.row_id)
-
-                tasteidx = res.Y != 'prestim'
-                Y_taste = res.Y[tasteidx]
-                Y_pred_taste = res.Y_predicted[tasteidx]
-
-                tasteacc = sum(Y_taste == Y_pred_taste) / len(Y_taste)
-
-                for i in el_tastes:
-                    n_dec = np.count_nonzero(res.Y == i)
-                    n_trials_decoded.append(n_dec)
-
-                n_trials_missed = sum(group.n_trials * 2) - sum(n_trials_decoded)
-                n_trials_decoded = dict(zip(el_tastes, n_trials_decoded))
-
-                meta_row = {'exp_name': en,
-                            'time_group': tg,
-                            'exp_group': eg,
-                            'accuracies': res.accuracy,
-                            'taste_acc': tasteacc,
-                            'hmm_state': states,
-                            'n_trials': n_trials,
-                            'n_single_state': n_single_state,
-                            'n_trials_dec': n_trials_decoded,
-                            'n_trials_missed': n_trials_missed
-                            }
-
-                meta_row.update(states)
-                print('decode:', name, ' ', i)
-                print(meta_row)
-                metadict.append(meta_row)
-
+    decoder = StateComboDecoder(group, all_units, label_col=label_col,
+                                remove_baseline=False)
+    
+    #092523: identifiers missing CA trials
+    for i, states, res in decoder.search(state_df, pruned=pruned):
+
+        if (res is not None):
+            NB_res.append(res)
+            n_trials_decoded = []
+
+            res_frame = pd.DataFrame()
+            res_frame['X'] = list(res.X)
+            res_frame['Y'] = res.Y
+            res_frame['Y_pred'] = res.Y_predicted
+            res_frame['row_ID'] = list(res.row_id)
+
+            tasteidx = res.Y != 'prestim'
+            Y_taste = res.Y[tasteidx]
+            Y_pred_taste = res.Y_predicted[tasteidx]
+
+            tasteacc = sum(Y_taste == Y_pred_taste) / len(Y_taste)
+
+            for i in el_tastes:
+                n_dec = np.count_nonzero(res.Y == i)
+                n_trials_decoded.append(n_dec)
+
+            n_trials_missed = sum(group.n_trials * 2) - sum(n_trials_decoded)
+            n_trials_decoded = dict(zip(el_tastes, n_trials_decoded))
+
+            meta_row = {'exp_name': en,
+                        'time_group': tg,
+                        'exp_group': eg,
+                        'accuracies': res.accuracy,
+                        'taste_acc': tasteacc,
+                        'hmm_state': states,
+                        'n_trials': n_trials,
+                        'n_single_state': n_single_state,
+                        'n_trials_dec': n_trials_decoded,
+                        'n_trials_missed': n_trials_missed
+                        }
+
+            meta_row.update(states)
+            print('decode:', name, ' ', i)
+            print(meta_row)
+            metadict.append(meta_row)
+
+    decoder.print_stats()
     meta = pd.DataFrame(metadict)
     return [NB_res, meta]
 
 
 #Rabbit hole: NB_classifier_accuracy>get_classifier_data>get_state_firing_rates
-def analyze_NB_state_classification_parallel(best_hmms,all_units, run_parallel=True):
+def analyze_NB_state_classification_parallel(best_hmms,all_units, run_parallel=True, pruned=False):
     '''generates list of combinations (state_df) for every possible combination of HMM states 
     and then uses them as the prior for decoding
     Parameters
@@ -1368,18 +1660,21 @@ def analyze_NB_state_classification_parallel(best_hmms,all_units, run_parallel=T
     all_units = all_units.copy()
     id_cols = ['exp_name','exp_group','time_group']
     all_units_ = all_units.query('area == "GC" and single_unit == True')
+    all_units_ = agg.HeldUnitGraph.from_all_units(all_units_)
     best_hmms_ = best_hmms.dropna(subset=['hmm_id'])
     best_hmms_['single_state_trials'] = best_hmms_.apply(lambda x: check_single_state_trials(x, min_dur=50), axis=1)
     
     groupedBH = best_hmms_.groupby(id_cols)
 
     if run_parallel==True:
-        delayed_func = delayed(nb_group)
-        res = Parallel(n_jobs=-2)(delayed_func(subgroup, all_units_) for name, subgroup in groupedBH)
+        delayed_func = wb.delayed(nb_group)
+        res = wb.Parallel(n_jobs=-2, n_tasks=groupedBH.ngroups)(delayed_func(subgroup, all_units_, pruned=pruned)
+                                                               for name, subgroup in groupedBH)
     else:
         res = []
         for name, subgroup in groupedBH:
-            res.append(nb_group(subgroup, all_units_))
+            res.append(nb_group(subgroup, all_units_, pruned=pruned))
+        dc.cache_stats()
     
     res_list = [list(x) for x in zip(*res)]
     NB_res = res_list[0]
@@ -1493,7 +1788,7 @@ def process_NB_classification(NB_meta,NB_res):
         rec_dir = nm[0]
         hmm_id = nm[1]
         h5_file = get_hmm_h5(rec_dir)
-        hmm, time, params = ph.load_hmm_from_hdf5(h5_file, hmm_id)
+        hmm, time, params = dc.load_hmm_from_hdf5(h5_file, hmm_id)
         dt = params['dt'] * 1000
         #paths = hmm.stat_arrays['best_sequences']
         paths = hmm.stat_arrays['gamma_probabilities']
@@ -1573,12 +1868,46 @@ def process_LinReg_pal_classification(results):
 #test LDA classifier with 1 axis
 #test linear regression classifier with one axis
 
-def LinReg_pal_classification(best_hmms, all_units):
+def get_pal_state_block(row, state, label_col, units, remove_baseline=False):
+    '''rates, labels and identifiers for one state of one taste's hmm, in the
+    format used by the palatability regressions'''
+    rec_dir = row['rec_dir']
+    hmm_id = int(row['hmm_id'])
+    state_rates = get_all_state_firing_rates(rec_dir, hmm_id, units=units[rec_dir],
+                                             remove_baseline=remove_baseline)
+    rates, trials, _, _ = get_state_rates_from_tensor(state_rates, state)
+    labels = np.repeat(row[label_col], rates.shape[0])
+    ids = [(rec_dir, hmm_id, row[label_col], x, state, False) for x in trials]
+    return rates, labels, ids
+
+
+def LinReg_pal_classification(best_hmms, all_units, pruned=False):
+    '''leave-one-out linear regression of palatability on the firing rates of
+    one state per taste, for every combination of candidate late states
+
+    Parameters
+    ----------
+    best_hmms : Produced by HA.get_best_hmms()
+    all_units : Produced by PA.get_unit_info()
+    pruned : bool, if True the combinations are searched depth-first over
+        tastes and a branch is skipped when n_max**2 / RSS_partial, an upper
+        bound on n**2 / PRESS (the quantity that ranks combos in
+        process_LinReg_pal_classification), is strictly below the best value
+        found. RSS_partial is the in-sample residual sum of squares of the
+        tastes assigned so far, which can only grow as rows are added, and
+        PRESS >= RSS. Returns only the decoded combos, which always include
+        the best one.
+
+    Returns
+    -------
+    list of ClassifierResult
+    '''
     label_col = 'palatability'
     id_cols = ['exp_name','exp_group','time_group']
     linreg_res = []
     
     all_units = all_units.query('area == "GC" and single_unit == True')
+    all_units = agg.HeldUnitGraph.from_all_units(all_units)
     best_hmms = best_hmms.dropna(subset=['hmm_id'])
     
     for name, group in best_hmms.groupby(id_cols):
@@ -1602,17 +1931,79 @@ def LinReg_pal_classification(best_hmms, all_units):
         n_trials = dict(zip(group.taste,group.n_trials))
         
         en = name[0]; eg = name[1]; tg = name[2]
-        
-        for i, states in state_df.iterrows():
+        units = get_common_units(group, all_units)
+        if units == {}:
+            continue
 
-            labels,rates,identifiers = get_classifier_data(group,states,label_col,all_units,
-                                                          remove_baseline = False, other_state_col = None)
-            if labels is None: continue
+        rows = [row for _, row in group.iterrows()]
+        blocks = [{st: get_pal_state_block(row, st, label_col, units)
+                   for st in sts} for row, sts in zip(rows, state_list)]
+
+        def fit_combo(combo):
+            rates = [blocks[k][st][0] for k, st in enumerate(combo)]
+            if sum(len(r) for r in rates) == 0:
+                return None
+            labels = np.concatenate([blocks[k][st][1] for k, st in enumerate(combo)])
+            rates = np.vstack(rates)
+            identifiers = np.array([x for k, st in enumerate(combo) for x in blocks[k][st][2]])
             n_cells = rates.shape[1]
-            if n_cells <2: continue
+            if n_cells <2: return None
             
             model = stats.LinRegressor(labels,rates,row_id = identifiers)
-            results = model.leave1out_fit()
+            return model.leave1out_fit()
+
+        if not pruned:
+            for i, states in state_df.iterrows():
+                results = fit_combo(tuple(states))
+                if results is not None:
+                    print('success')
+                    linreg_res.append(results)
+            continue
+
+        # depth-first branch and bound over tastes, larger blocks first
+        orders = [sorted(sts, key=lambda st: -len(blocks[k][st][0]))
+                  for k, sts in enumerate(state_list)]
+        max_n = [max(len(blocks[k][st][0]) for st in sts) for k, sts in enumerate(state_list)]
+        best = [-np.inf]
+        found = {}
+        n_skipped = [0]
+
+        def n_leaves(k):
+            return int(np.prod([len(sts) for sts in state_list[k:]]))
+
+        def rss(combo):
+            X = [blocks[k][st][0] for k, st in enumerate(combo)]
+            y = np.concatenate([blocks[k][st][1] for k, st in enumerate(combo)]).astype(float)
+            X = np.vstack(X)
+            design = np.column_stack([np.ones(len(y)), X])
+            if len(y) <= design.shape[1]:
+                return 0
+            coef = np.linalg.lstsq(design, y, rcond=None)[0]
+            return np.sum((y - design @ coef)**2)
+
+        def search(combo):
+            k = len(combo)
+            if k == len(state_list):
+                results = fit_combo(combo)
+                found[combo] = results
+                if results is not None:
+                    score = len(results.Y) / results.loss
+                    best[0] = max(best[0], score)
+                return
+
+            for st in orders[k]:
+                partial = combo + (st,)
+                n_max = sum(len(blocks[j][s_][0]) for j, s_ in enumerate(partial)) + sum(max_n[k+1:])
+                r = rss(partial)
+                if r > 0 and n_max**2 / r < best[0]:
+                    n_skipped[0] += n_leaves(k+1)
+                    continue
+                search(partial)
+
+        search(())
+        print('%s: %i of %i combos skipped' % (name, n_skipped[0], len(state_df)))
+        for i, states in state_df.iterrows():
+            results = found.get(tuple(states))
             if results is not None:
                 print('success')
                 linreg_res.append(results)
@@ -1624,6 +2015,7 @@ def Spearman_state_corr(best_hmms, all_units):
     id_cols = ['exp_name','exp_group','time_group']
     
     all_units = all_units.query('area == "GC" and single_unit == True')
+    all_units = agg.HeldUnitGraph.from_all_units(all_units)
     best_hmms = best_hmms.dropna(subset=['hmm_id'])
     
     for name, group in best_hmms.groupby(id_cols):
@@ -1691,6 +2083,7 @@ def LDA_classifier_accuracy(group, states, label_col, all_units, other_state_col
         metadict = []
         
         all_units = all_units.query('area == "GC" and single_unit == True')
+        all_units = agg.HeldUnitGraph.from_all_units(all_units)
         best_hmms = best_hmms.dropna(subset=['hmm_id'])
         
         for name, group in best_hmms.groupby(id_cols):
@@ -1979,7 +2372,7 @@ def analyze_hmm_state_timing(best_hmms, min_dur=100):
             template[k] = row[k]
 
         h5_file = get_hmm_h5(row['rec_dir'])
-        hmm, time, params = ph.load_hmm_from_hdf5(h5_file, row['hmm_id'])
+        hmm, time, params = dc.load_hmm_from_hdf5(h5_file, row['hmm_id'])
         for k in param_cols:
             template[k] = params[k]
 
@@ -2068,7 +2461,7 @@ def getNBTimings(HA):
 def getMaxGamma(best_hmms, trial_group = 5):
     def maxgamma(row):
         h5_file = get_hmm_h5(row['rec_dir'])
-        hmm, time, params = ph.load_hmm_from_hdf5(h5_file, row["hmm_id"])
+        hmm, time, params = dc.load_hmm_from_hdf5(h5_file, row["hmm_id"])
         gamma = hmm.stat_arrays['gamma_probabilities']
         max_gamma = np.amax(gamma,axis = 1)
         
@@ -2104,7 +2497,7 @@ def getModeHmm(hmm):
 def binstate(best_hmms, statefunc=getModeHmm):
     def getbinstateprob(row):
         h5_file = get_hmm_h5(row['rec_dir']) #get hmm file name
-        hmm, time, params = ph.load_hmm_from_hdf5(h5_file, row["hmm_id"]) #load hmm
+        hmm, time, params = dc.load_hmm_from_hdf5(h5_file, row["hmm_id"]) #load hmm
         mode_seqs, mode_gamma = statefunc(hmm) #get mode state # and gamma prob
 
         rowids = hmm.stat_arrays['row_id']
@@ -2138,7 +2531,7 @@ def add_trial_group(df, trial_group = 5):
 def binwrong(best_hmms, trial_group = 5):
     def getwrongbin(row, trial_group):
         h5_file = get_hmm_h5(row['rec_dir'])
-        hmm, time, params = ph.load_hmm_from_hdf5(h5_file, row["hmm_id"])
+        hmm, time, params = dc.load_hmm_from_hdf5(h5_file, row["hmm_id"])
         mode_seqs, mode_gamma = getModeHmm(hmm) #get mode state # and gamma prob
 
         rowids = hmm.stat_arrays['row_id']
@@ -2182,7 +2575,7 @@ def analyze_classified_hmm_state_timing(best_hmms, decodes, min_dur=1):
             template[k] = row[k]
 
         h5_file = get_hmm_h5(row['rec_dir'])
-        hmm, time, params = ph.load_hmm_from_hdf5(h5_file, row['hmm_id'])
+        hmm, time, params = dc.load_hmm_from_hdf5(h5_file, row['hmm_id'])
         for k in param_cols:
             template[k] = params[k]
 
@@ -2494,7 +2887,7 @@ class CustomHandler(ph.HmmHandler):
         else:
             n_cpu = 1
 
-        results = Parallel(n_jobs=n_cpu, verbose=100)(delayed(ph.fit_hmm_mp)
+        results = wb.Parallel(n_jobs=n_cpu, verbose=100)(wb.delayed(ph.fit_hmm_mp)
                                                      (p['rec_dir'], p, h5_file,
                                                       constraint_func)
                                                      for p in fit_params)
@@ -18,41 +18,7 @@ def preprocess_nonlinear_regression(df, subject_col, group_cols, trial_col, valu
     groupings = [subject_col] + group_cols
     params, r2, y_pred = ta.nonlinear_regression(df, subject_cols=groupings, trial_col=trial_col, value_col=value_col,
                                                  parallel=parallel, yMin=yMin, yMax=yMax)
-    r2_df = pd.Series(r2).reset_index()  # turn dict into a series with multi-index
-    r2_df = r2_df.reset_index(drop=True)  # reset the index so it becomes a dataframe
-    colnames = groupings + ['r2']
-    column_mapping = dict(zip(r2_df.columns, colnames))
-    r2_df = r2_df.rename(columns=column_mapping)
-
-    #r2_df_groupmean = r2_df.groupby(group_cols).mean().reset_index()
-    # %% plot the nonlinear regression fits with the raw data
-    identifiers = []
-    alpha = []
-    beta = []
-    c = []
-    for i, group in df.groupby(groupings):
-        pr = params[i]
-        identifiers.append(i)
-        alpha.append(pr[0])
-        beta.append(pr[1])
-        c.append(pr[2])
-
-    ids_df = pd.DataFrame(identifiers, columns=groupings)
-    params_df = ids_df.copy()
-    params_df['alpha'] = alpha
-    params_df['beta'] = beta
-    params_df['c'] = c
-
-    # merge the params with df
-    df2 = df.merge(params_df, on=groupings)
-    df3 = df2.merge(r2_df, on=groupings)
-    # for each row of df3, get the modeled value for that row, by passing the trial number and alpha, beta, c values to the model function
-    modeled = []
-    for i, row in df3.iterrows():
-        pr = row[['alpha', 'beta', 'c']]
-        mod = ta.model(row[trial_col], *pr)
-        modeled.append(mod)
-    df3['modeled'] = modeled
+    df3 = ta.add_model_columns(df, params, groupings, trial_col, r2=r2)
     # get the null distribution of r2 values
     shuffle = ta.iter_shuffle(df3, nIter=nIter, subject_cols=groupings, trial_col=trial_col, value_col=value_col,
                             yMin=yMin, yMax=yMax,
@@ -62,7 +28,7 @@ def preprocess_nonlinear_regression(df, subject_col, group_cols, trial_col, valu
         raise ValueError('shuffle is None')
     return df3, shuffle
 
-def plot_nonlinear_line_graphs(df3, shuff, subject_col, group_cols, trial_col, value_col, flag=None, nIter=100, parallel=True, yMin=None, yMax=None, textsize=20):
+def plot_nonlinear_line_graphs(df3, shuff, subject_col, group_cols, trial_col, value_col, flag=None, nIter=100, yMin=None, yMax=None, textsize=20):
     groups = [subject_col] + group_cols
     if yMin is None:
         yMin = min(df3[value_col])
@@ -71,7 +37,7 @@ def plot_nonlinear_line_graphs(df3, shuff, subject_col, group_cols, trial_col, v
 
     ta.plot_fits_summary_avg(df3, shuff_df=shuff, dat_col=value_col, trial_col=trial_col, save_dir=HA.save_dir,
                              use_alpha_pos=False, textsize=textsize, dotalpha=0.15, flag=flag, nIter=nIter,
-                             parallel=parallel, yMin=yMin, yMax=yMax)
+                             yMin=yMin, yMax=yMax)
     for exp_group, group in df3.groupby(['exp_group']):
         group_shuff = shuff.groupby('exp_group').get_group(exp_group)
         if flag is not None:
@@ -80,12 +46,12 @@ def plot_nonlinear_line_graphs(df3, shuff, subject_col, group_cols, trial_col, v
             save_flag = exp_group
         ta.plot_fits_summary_avg(group, shuff_df=group_shuff, dat_col=value_col, trial_col=trial_col,
                                  save_dir=HA.save_dir, use_alpha_pos=False, textsize=textsize, dotalpha=0.15,
-                                 flag=flag, nIter=nIter, parallel=parallel, yMin=yMin, yMax=yMax)
+                                 flag=flag, nIter=nIter, yMin=yMin, yMax=yMax)
 
 #this function plots the bar graphs of the differences in r2 between exp groups
 def plot_nonlinear_regression_comparison(df3, shuff, stat_col, subject_col, group_cols, trial_col, value_col, flag=None, nIter=100, ymin=None, ymax=None, textsize=20):
     groups = [subject_col] + group_cols
-    avg_shuff = shuff.groupby(group_cols + ['iternum']).mean().reset_index()
+    avg_shuff = shuff.groupby(group_cols + ['iternum'], observed=True).mean().reset_index()
     avg_df3 = df3.groupby(groups).mean().reset_index() #trial average df3
     # plot the r2 values for each session with the null distribution
     if flag is not None:
@@ -97,7 +63,7 @@ def plot_nonlinear_regression_comparison(df3, shuff, stat_col, subject_col, grou
 #for each group, plot the bar graphs quantifying the r2 values
 def plot_nonlinear_regression_stats(df3, shuff, subject_col, group_cols, trial_col, value_col, flag=None, nIter=100, textsize=20, ymin=None, ymax=None):
     groups = [subject_col] + group_cols
-    avg_shuff = shuff.groupby(groups + ['iternum']).mean().reset_index() #average across exp_names
+    avg_shuff = shuff.groupby(groups + ['iternum'], observed=True).mean().reset_index() #average across exp_names
     avg_df3 = df3.groupby(groups).mean().reset_index() #trial average df3
 
     for exp_group, group in avg_df3.groupby(['exp_group']):
@@ -113,37 +79,7 @@ def plot_nonlinear_regression_stats(df3, shuff, subject_col, group_cols, trial_c
 #import joblib parallel
 from joblib import Parallel, delayed
 def get_session_differences(df3, shuff, stat_col='r2'):
-    diff_col = stat_col + ' difference'
-    #make a new dataframe called day_diffs that contains the difference in r2 between day 1 and day 2, and day 1 and day 3, and day 2 and day 3
-    def calculate_differences(group_name, group_df):
-        results = []
-        for i in range(len(group_df) - 1):
-            for j in range(i + 1, len(group_df)):
-                diff = group_df.iloc[i][stat_col] - group_df.iloc[j][stat_col]
-                session_diff = f"{group_df.iloc[i]['session']}-{group_df.iloc[j]['session']}"
-                results.append({'Group': group_name, 'Session Difference': session_diff, diff_col: diff})
-        return results
-
-    group_columns = ['exp_group', 'exp_name', 'taste']
-    grouped = df3.groupby(group_columns)
-    results = Parallel(n_jobs=-1)(delayed(calculate_differences)(group_name, group_df.sort_values('session')) for group_name, group_df in grouped)
-    flat_results = [item for sublist in results for item in sublist]
-    r2_diffs = pd.DataFrame(flat_results)
-    expanded_groups = pd.DataFrame(r2_diffs['Group'].tolist(), columns=group_columns)
-    # Concatenate the new columns with the original DataFrame
-    r2_diffs = pd.concat([expanded_groups, r2_diffs.drop('Group', axis=1)], axis=1)
-
-    # Apply function to shuff_r2_df
-    group_columns = ['exp_group', 'exp_name', 'taste', 'iternum']
-    grouped = shuff.groupby(group_columns)
-    results = Parallel(n_jobs=-1)(delayed(calculate_differences)(group_name, group_df.sort_values('session')) for group_name, group_df in grouped)
-    flat_results = [item for sublist in results for item in sublist]
-    shuff_r2_diffs = pd.DataFrame(flat_results)
-    expanded_groups = pd.DataFrame(shuff_r2_diffs['Group'].tolist(), columns=group_columns)
-    # Concatenate the new columns with the original DataFrame
-    shuff_r2_diffs = pd.concat([expanded_groups, shuff_r2_diffs.drop('Group', axis=1)], axis=1)
-    shuff_r2_diffs = shuff_r2_diffs.groupby(['Session Difference', 'exp_group', 'taste', 'iternum']).mean().reset_index()
-    return r2_diffs, shuff_r2_diffs
+    return ta.get_session_differences(df3, shuff, stat_col=stat_col)
 
 def plot_session_differences(df3, shuff, subject_col, group_cols, trial_col, value_col, stat_col=None, flag=None, nIter=100, textsize=20, ymin=None, ymax=None):
     if stat_col is None:
@@ -160,29 +96,11 @@ def plot_session_differences(df3, shuff, subject_col, group_cols, trial_col, val
     ta.plot_daywise_r2_pval_diffs(shuff_r2_diffs, r2_diffs, stat_col=stat_col, save_flag=save_flag, save_dir=HA.save_dir, textsize=textsize, nIter=nIter, n_comp=3, ymin=ymin, ymax=ymax)
 
 def get_pred_change(df3, shuff, subject_col, group_cols, trial_col):
-    groups = [subject_col] + group_cols
-    trials = df3[trial_col].unique()
-
-    avg_df3 = df3.groupby(groups).mean().reset_index() #trial average df3
-    def add_pred_change(df):
-        pred_change = []
-        for i, row in df.iterrows():
-            params = row[['alpha', 'beta', 'c']]
-            pred_change.append(ta.calc_pred_change(trials, params))
-        df['pred. change'] = pred_change
-        return df
-
-    pred_change_df = add_pred_change(avg_df3)
+    return ta.get_pred_change(df3, shuff, subject_col, group_cols, trial_col)
 
-    pred_change_shuff = []
-    for i, row in shuff.iterrows():
-        params = row['params']
-        pred_change_shuff.append(ta.calc_pred_change(trials, params))
-    shuff['pred. change'] = pred_change_shuff
-    return pred_change_df, shuff
 def plot_predicted_change(pred_change_df, pred_change_shuff, subject_col, group_cols, trial_col, value_col, flag=None, nIter=100, textsize=20, ymin=None, ymax=None):
 
-    avg_shuff = pred_change_shuff.groupby(group_cols + ['iternum']).mean().reset_index()
+    avg_shuff = pred_change_shuff.groupby(group_cols + ['iternum'], observed=True).mean().reset_index()
 
     if flag is not None:
         save_flag = trial_col + '_' + value_col + '_' + flag
@@ -83,7 +83,7 @@ def plot_nonlinear_regression_stats(df3, shuff, subject_col, group_cols, trial_c
         else:
             save_flag = trial_col + '_' + value_col + '_' + exp_group + '_only'
         ta.plot_r2_pval_summary(avg_group_shuff, group, save_flag=save_flag, save_dir=HA.save_dir, textsize=textsize, nIter=nIter, n_comp=3, ymin=ymin, ymax=ymax)
-def plot_nonlinear_line_graphs(df3, shuff, subject_col, group_cols, trial_col, value_col, flag=None, nIter=100, parallel=True, yMin=None, yMax=None, textsize=20):
+def plot_nonlinear_line_graphs(df3, shuff, subject_col, group_cols, trial_col, value_col, flag=None, nIter=100, yMin=None, yMax=None, textsize=20):
     groups = [subject_col] + group_cols
     if yMin is None:
         yMin = min(df3[value_col])
@@ -92,7 +92,7 @@ def plot_nonlinear_line_graphs(df3, shuff, subject_col, group_cols, trial_col, v
 
     ta.plot_fits_summary_avg(df3, shuff_df=shuff, dat_col=value_col, trial_col=trial_col, save_dir=HA.save_dir,
                              use_alpha_pos=False, textsize=textsize, dotalpha=0.15, flag=flag, nIter=nIter,
-                             parallel=parallel, yMin=yMin, yMax=yMax)
+                             yMin=yMin, yMax=yMax)
     for exp_group, group in df3.groupby(['exp_group']):
         group_shuff = shuff.groupby('exp_group').get_group(exp_group)
         if flag is not None:
@@ -101,7 +101,7 @@ def plot_nonlinear_line_graphs(df3, shuff, subject_col, group_cols, trial_col, v
             save_flag = exp_group
         ta.plot_fits_summary_avg(group, shuff_df=group_shuff, dat_col=value_col, trial_col=trial_col,
                                  save_dir=HA.save_dir, use_alpha_pos=False, textsize=textsize, dotalpha=0.15,
-                                 flag=flag, nIter=nIter, parallel=parallel, yMin=yMin, yMax=yMax)
+                                 flag=flag, nIter=nIter, yMin=yMin, yMax=yMax)
 
 
 trial_col = ['session_trial', 'taste_trial', 'session time']
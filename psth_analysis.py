@@ -1,6 +1,7 @@
 import blechpy
 import numpy as np
 import blechpy.dio.h5io as h5io
+import data_cache as dc
 import pandas as pd
 from joblib import Parallel, delayed
 import trialwise_analysis as ta
@@ -54,7 +55,7 @@ for din in [0,1,2,3]:
 
         for i, row in group.iterrows():
             rec_dir = row['rec_dir']
-            time_array, spike_array = h5io.get_spike_data(rec_dir, din=din)
+            time_array, spike_array = dc.get_spike_data(rec_dir, din=din)
             #rebin axis 2 by summing every 10ms
             spike_array = spike_array.reshape(spike_array.shape[0], spike_array.shape[1], -1, 10).sum(axis=3)
             spike_array = spike_array[:, :, 100:600]
@@ -207,6 +208,7 @@ import pandas as pd
 import analysis as ana
 import blechpy
 import blechpy.dio.h5io as h5io
+import data_cache as dc
 import held_unit_analysis as hua
 import matplotlib.pyplot as plt
 import seaborn as sns
@@ -4,6 +4,7 @@ import blechpy.dio.h5io as h5io
 import pandas as pd
 from joblib import Parallel, delayed
 import trialwise_analysis as ta
+import worker_budget as wb
 import analysis as ana
 import matplotlib.pyplot as plt
 import feather
@@ -97,7 +98,7 @@ def process_rec_dir(rec_dir):
 
 # Parallelize processing of each rec_dir
 num_cores = -1  # Use all available cores
-final_dfs = Parallel(n_jobs=num_cores)(delayed(process_rec_dir)(rec_dir) for rec_dir in rec_dirs)
+final_dfs = wb.Parallel(n_jobs=num_cores)(wb.delayed(process_rec_dir)(rec_dir) for rec_dir in rec_dirs)
 
 # Concatenate all resulting data frames into one
 final_df = pd.concat(final_dfs, ignore_index=True)
@@ -116,12 +117,11 @@ preprodf, shuffle = ta.preprocess_nonlinear_regression(final_df, subject_col, gr
 flag = 'test'
 nIter = 10000
 textsize = 20
-parallel = True
 yMin = preprodf[value_col].min()
 yMax = preprodf[value_col].max()
 ta.plot_fits_summary_avg(preprodf, shuff_df=shuffle, dat_col=value_col, trial_col=trial_col, save_dir=PA.save_dir,
                          use_alpha_pos=False, textsize=textsize, dotalpha=0.15, flag=flag, nIter=nIter,
-                         parallel=parallel, yMin=yMin, yMax=yMax)
+                         yMin=yMin, yMax=yMax)
 for exp_group, group in preprodf.groupby(['exp_group']):
     group_shuff = shuffle.groupby('exp_group').get_group(exp_group)
     if flag is not None:
@@ -130,7 +130,7 @@ for exp_group, group in preprodf.groupby(['exp_group']):
         save_flag = exp_group
     ta.plot_fits_summary_avg(group, shuff_df=group_shuff, dat_col=value_col, trial_col=trial_col,
                              save_dir=PA.save_dir, use_alpha_pos=False, textsize=textsize, dotalpha=0.15,
-                             flag=save_flag, nIter=nIter, parallel=parallel, yMin=yMin, yMax=yMax)
+                             flag=save_flag, nIter=nIter, yMin=yMin, yMax=yMax)
 
 ta.plot_fits_summary(preprodf, dat_col=value_col, trial_col=trial_col, save_dir=PA.save_dir, time_col='session',
                      use_alpha_pos=False, dotalpha=0.15, flag=flag)
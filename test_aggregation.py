@@ -0,0 +1,156 @@
+import types
+import itertools
+import numpy as np
+import pandas as pd
+import pytest
+import aggregation as agg
+
+
+def fake_waveforms(rec_dir, unit):
+    # noisy spike templates, a few units with a longer snapshot
+    k = int(unit[-1])
+    rng = np.random.default_rng([int(rec_dir[-1]), k])
+    n_samples = 45 if k == 3 else 40
+    t = np.linspace(0, 1, n_samples)
+    template = -np.exp(-((t - 0.3 - 0.04 * k) / 0.05)**2)
+    drift = np.linspace(0, 0.2, 300)[:, None] * rng.normal(size=n_samples)
+    waves = template + drift + rng.normal(0, 0.1, (300, n_samples))
+    return waves, None, 30000
+
+
+def test_J3_from_stats_matches_pca(monkeypatch):
+    monkeypatch.setattr(agg, 'h5io', types.SimpleNamespace(get_unit_waveforms=fake_waveforms))
+    units1 = [('rec1', 'unit%i' % k) for k in range(4)]
+    units2 = [('rec2', 'unit%i' % k) for k in range(4)]
+    stores = {rec: agg.WaveformStore(rec, max_waves=200) for rec in ['rec1', 'rec2']}
+
+    for rec, unit in units1:
+        assert np.isclose(stores[rec].unit_J3(unit), agg.get_unit_J3(rec, unit, max_waves=200))
+
+    J3 = agg.get_inter_J3_matrix(units1, units2, stores)
+    for (i, (rec1, unit1)), (j, (rec2, unit2)) in itertools.product(enumerate(units1), enumerate(units2)):
+        assert np.isclose(J3[i, j], agg.get_inter_J3(rec1, unit1, rec2, unit2, max_waves=200))
+
+
+def resolve_matches_loop(df, thresh):
+    # resolve_matches before the assignment solver, as a reference
+    df = df.copy()
+    df['held'] = False
+    df['done'] = False
+    df.loc[df['inter_J3'] >= thresh, 'done'] = True
+    while any(df['done'] == False):
+        for name, group in df.groupby(['rec1', 'rec2']):
+            tmp = group[group['inter_J3'] < thresh].copy()
+            tmp = tmp[tmp['done'] == False]
+            if tmp.empty:
+                continue
+
+            for u1 in tmp.unit1.unique():
+                all_idx = tmp.index[tmp.unit1 == u1]
+                idx = tmp.loc[all_idx, 'inter_J3'].idxmin()
+                u2 = tmp.loc[idx, 'unit2']
+                u2_idx = tmp.index[tmp.unit2 == u2]
+                bidx = tmp.loc[u2_idx, 'inter_J3'].idxmin()
+                if idx == bidx:
+                    others = all_idx.union(u2_idx).drop(idx)
+                    df.loc[idx, 'held'] = True
+                    df.loc[others, 'held'] = False
+                    df.loc[idx, 'done'] = True
+                    df.loc[others, 'done'] = True
+
+    unit_num = 0
+    tmp = df[df.held].copy()
+    for i, row in tmp.iterrows():
+        r1 = row['rec1']
+        u1 = row['unit1']
+        tmp2 = tmp.query('rec2 == @r1 and unit2 == @u1')
+        if tmp2.empty:
+            df.loc[i, 'held_unit_name'] = unit_num
+            unit_num += 1
+        else:
+            i2 = tmp2.index[0]
+            un = df.loc[i2, 'held_unit_name']
+            if pd.isnull(un):
+                un = unit_num
+                unit_num += 1
+                df.loc[i2, 'held_unit_name'] = un
+            df.loc[i, 'held_unit_name'] = un
+
+    return df.drop(columns=['done'])
+
+
+def make_candidates(rng, n_recs=4, n_units=5, thresh=1.0, unambiguous=True):
+    # every unit pair of consecutive recordings; with unambiguous each unit
+    # has at most one candidate under thresh
+    rows = []
+    for r in range(n_recs - 1):
+        J3 = rng.uniform(thresh, 3 * thresh, (n_units, n_units))
+        if unambiguous:
+            perm = rng.permutation(n_units)
+            for u in rng.choice(n_units, n_units - 1, replace=False):
+                J3[u, perm[u]] = rng.uniform(0, thresh)
+        else:
+            J3[rng.random(J3.shape) < 0.4] = rng.uniform(0, thresh)
+        rows += [dict(rec1='rec%i' % r, unit1='unit%i' % u1, rec2='rec%i' % (r + 1), unit2='unit%i' % u2,
+                      inter_J3=J3[u1, u2]) for u1 in range(n_units) for u2 in range(n_units)]
+    return pd.DataFrame(rows)
+
+
+def test_resolve_matches_matches_loop():
+    rng = np.random.default_rng(0)
+    for _ in range(20):
+        df = make_candidates(rng)
+        new = agg.resolve_matches(df, 1.0)
+        old = resolve_matches_loop(df, 1.0)
+        assert new['held'].equals(old['held'])
+        assert np.array_equal(new['held_unit_name'].to_numpy(float), old['held_unit_name'].to_numpy(float),
+                              equal_nan=True)
+
+
+def test_resolve_matches_is_optimal_assignment():
+    # against brute force: most matches under thresh, then least total J3
+    rng = np.random.default_rng(1)
+    for _ in range(20):
+        df = make_candidates(rng, n_recs=2, n_units=4, unambiguous=False)
+        held = agg.resolve_matches(df, 1.0)
+        held = held[held.held]
+        assert held.unit1.is_unique and held.unit2.is_unique and np.all(held.inter_J3 < 1.0)
+
+        J3 = df.pivot(index='unit1', columns='unit2', values='inter_J3').to_numpy()
+        best = max((int(np.sum(J3[range(4), p] < 1.0)), -np.sum(np.where(J3[range(4), p] < 1.0, J3[range(4), p], 0)))
+                   for p in itertools.permutations(range(4)))
+        assert (len(held), -held.inter_J3.sum()) == pytest.approx(best)
+
+
+def common_units_filter(rec_dirs, all_units):
+    # units held across rec_dirs with the table filters HeldUnitGraph replaced
+    held = np.array(all_units.held_unit_name.unique())
+    for rd in rec_dirs:
+        tmp = all_units.query('rec_dir == @rd').dropna(subset=['held_unit_name'])
+        held = np.intersect1d(held, np.array(tmp['held_unit_name']))
+
+    out = {}
+    if len(held) == 0:
+        return out
+    for rd in rec_dirs:
+        tmp = all_units[all_units['held_unit_name'].isin(held) & (all_units['rec_dir'] == rd)]
+        out[rd] = tmp['unit_name'].to_list()
+    return out
+
+
+def test_units_held_across_matches_filters():
+    rng = np.random.default_rng(0)
+    for _ in range(20):
+        # units followed through up to 4 recordings, some never held
+        rows = []
+        for name in range(12):
+            recs = sorted(rng.choice(4, rng.integers(1, 5), replace=False))
+            held_name = float(name) if len(recs) > 1 else np.nan
+            rows += [dict(rec_dir='rec%i' % r, unit_name='unit%02i' % rng.integers(100), held_unit_name=held_name)
+                     for r in recs]
+        all_units = pd.DataFrame(rows).drop_duplicates(['rec_dir', 'unit_name'])
+        all_units = all_units.sample(frac=1, random_state=1).reset_index(drop=True)
+        graph = agg.HeldUnitGraph.from_all_units(all_units)
+        for n in range(2, 5):
+            for rec_dirs in itertools.combinations(['rec%i' % r for r in range(4)], n):
+                assert graph.units_held_across(rec_dirs) == common_units_filter(rec_dirs, all_units)
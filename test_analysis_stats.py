@@ -0,0 +1,43 @@
+import numpy as np
+from analysis_stats import LDAClassifier, NBClassifier, LinRegressor
+
+
+def make_classes(n_per_class=(12, 9, 10), n_features=4, seed=0):
+    rng = np.random.default_rng(seed)
+    X = np.vstack([rng.normal(k, 1.5, (n, n_features)) for k, n in enumerate(n_per_class)])
+    y = np.concatenate([np.full(n, 'abc'[k]) for k, n in enumerate(n_per_class)]).astype(object)
+    return X, y
+
+
+def test_lda_closed_form_matches_refit():
+    X, y = make_classes()
+    fast = LDAClassifier(y, X).leave1out_fit(closed_form=True)
+    slow = LDAClassifier(y, X).leave1out_fit(closed_form=False)
+    assert np.array_equal(fast.Y_predicted, slow.Y_predicted)
+    assert fast.accuracy == slow.accuracy
+    # the result holds the full-data projection, not the last fold's
+    assert fast.X.shape == slow.X.shape == (len(y), 2)
+
+
+def test_nb_closed_form_matches_refit():
+    X, y = make_classes()
+    # a class with a single sample is absent from the fold that holds it out
+    X = np.vstack([X, np.full((1, X.shape[1]), 5.)])
+    y = np.append(y, 'd').astype(object)
+    fast = NBClassifier(y, X).leave1out_fit(closed_form=True)
+    slow = NBClassifier(y, X).leave1out_fit(closed_form=False)
+    assert np.array_equal(fast.Y_predicted, slow.Y_predicted)
+    assert fast.accuracy == slow.accuracy
+    fast_p = fast.class_probs[slow.class_probs.columns].to_numpy(float)
+    slow_p = slow.class_probs.to_numpy(float)
+    assert np.allclose(np.nan_to_num(fast_p), np.nan_to_num(slow_p), atol=1e-8)
+
+
+def test_linreg_press_matches_refit():
+    X, y = make_classes(n_features=3)
+    y = np.unique(y, return_inverse=True)[1].astype(float)
+    fast = LinRegressor(y, X).leave1out_fit(closed_form=True)
+    slow = LinRegressor(y, X).leave1out_fit(closed_form=False)
+    assert np.allclose(fast.Y_predicted.astype(float), slow.Y_predicted.astype(float))
+    assert np.allclose(fast.accuracy, slow.accuracy)
+    assert np.isclose(fast.loss, slow.loss)
@@ -0,0 +1,69 @@
+import itertools
+import numpy as np
+import pandas as pd
+import hmm_analysis as hmma
+
+
+def make_state_rates(seed, n_trials=15, n_states=4, n_units=5):
+    # rates of every state in every trial, with states missing from some
+    # trials so combinations decode different numbers of trials
+    rng = np.random.default_rng(seed)
+    rates = rng.poisson(5, (n_trials, n_states, n_units)) + np.arange(n_states)[None, :, None] * seed
+    valid = rng.random((n_trials, n_states)) < np.linspace(1, 0.4, n_states)[None, :]
+    times = np.where(valid, 0., np.nan)
+    return rates.astype(float), valid, times, times
+
+
+def make_group(monkeypatch, tastes=('Suc', 'NaCl', 'QHCl'), n_trials=15, n_states=4):
+    group = pd.DataFrame({'rec_dir': ['rec_%s' % t for t in tastes], 'hmm_id': np.arange(len(tastes)),
+                          'taste': list(tastes), 'n_trials': n_trials})
+    state_rates = {rd: make_state_rates(k + 1, n_trials, n_states) for k, rd in enumerate(group.rec_dir)}
+    monkeypatch.setattr(hmma, 'get_common_units', lambda group, all_units: {rd: None for rd in group.rec_dir})
+    monkeypatch.setattr(hmma, 'get_all_state_firing_rates',
+                        lambda rec_dir, hmm_id, units=None, remove_baseline=False: state_rates[rec_dir])
+    return group
+
+
+def make_state_df(tastes, n_states):
+    # every baseline < early < late state choice for every taste
+    per_taste = [(b, e, l) for b, e, l in itertools.product(range(n_states), repeat=3) if b < e < l]
+    cols = ([t + '_bsln' for t in tastes] + [t + '_early' for t in tastes] +
+            [t + '_late' for t in tastes])
+    combos = []
+    for choice in itertools.product(per_taste, repeat=len(tastes)):
+        combos.append([c[0] for c in choice] + [c[1] for c in choice] + [c[2] for c in choice])
+    return pd.DataFrame(combos, columns=cols)
+
+
+def test_pruned_search_finds_exhaustive_best(monkeypatch):
+    group = make_group(monkeypatch)
+    state_df = make_state_df(group.taste, 4)
+    decoder = hmma.StateComboDecoder(group, None)
+    full = {i: decoder.performance(res) for i, _, res in decoder.search(state_df)}
+    pruned = {i: decoder.performance(res) for i, _, res in decoder.search(state_df, pruned=True)}
+    assert decoder.n_skipped > 0
+
+    best = max(full.values())
+    assert max(pruned.values()) == best
+    assert ({i for i, p in pruned.items() if p == best} ==
+            {i for i, p in full.items() if p == best})
+    assert all(full[i] == p for i, p in pruned.items())
+
+
+def test_pruned_linreg_finds_exhaustive_best(monkeypatch):
+    tastes = ['Water', 'Suc', 'NaCl', 'CA', 'QHCl']
+    group = make_group(monkeypatch, tastes=tastes, n_states=5)
+    group['palatability'] = np.arange(len(tastes), 0, -1)
+    group['n_states'] = 5
+    group['exp_name'], group['exp_group'], group['time_group'] = 'A', 'g', 1
+    monkeypatch.setattr(hmma.agg.HeldUnitGraph, 'from_all_units', staticmethod(lambda all_units: None))
+    all_units = pd.DataFrame({'area': ['GC'], 'single_unit': [True]})
+
+    def scores(pruned):
+        res = hmma.LinReg_pal_classification(group, all_units, pruned=pruned)
+        return sorted(len(r.Y) / r.loss for r in res)
+
+    full = scores(False)
+    pruned = scores(True)
+    assert len(pruned) < len(full)
+    assert pruned[-1] == full[-1]
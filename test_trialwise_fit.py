@@ -0,0 +1,39 @@
+import numpy as np
+import pandas as pd
+from trialwise_analysis import nonlinear_regression, model
+
+
+def make_curves(seed=0, n_subjects=8):
+    # decaying and rising curves of different lengths and noise levels
+    rng = np.random.default_rng(seed)
+    rows = []
+    for subject in range(n_subjects):
+        n = rng.integers(15, 40)
+        trials = np.arange(1, n + 1)
+        a, b, c = rng.uniform(0, 0.5), rng.uniform(0.5, 1), rng.uniform(0.02, 0.5)
+        values = model(trials, a, b, c) + rng.normal(0, rng.uniform(0.02, 0.3), n)
+        rows += [dict(Subject=subject, Trial=t, Value=v) for t, v in zip(trials, values)]
+    return pd.DataFrame(rows)
+
+
+def sse(df, params):
+    return {s: np.sum((g.Value - model(g.Trial.to_numpy(), *params[(s,)]))**2)
+            for s, g in df.groupby('Subject')}
+
+
+def check_no_worse_than_curve_fit(solver, seeds=range(3)):
+    for seed in seeds:
+        df = make_curves(seed)
+        ref, _, _ = nonlinear_regression(df, solver='curve_fit', parallel=False)
+        fast, _, _ = nonlinear_regression(df, solver=solver, parallel=False)
+        ref, fast = sse(df, ref), sse(df, fast)
+        for s in ref:
+            assert fast[s] <= ref[s] * (1 + 1e-6) + 1e-12
+
+
+def test_batched_no_worse_than_curve_fit():
+    check_no_worse_than_curve_fit('batched')
+
+
+def test_varpro_no_worse_than_curve_fit():
+    check_no_worse_than_curve_fit('varpro')
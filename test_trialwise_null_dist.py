@@ -0,0 +1,108 @@
+import os
+import numpy as np
+import pandas as pd
+from trialwise_analysis import (iter_shuffle, preprocess_nonlinear_regression_multi, shuffle_null_dist,
+                                sequential_shuffle_pvals, get_shuff_pvals, model)
+
+
+def make_data(seed=0):
+    rng = np.random.default_rng(seed)
+    rows = []
+    for subject in range(3):
+        for taste in ['a', 'b']:
+            n = rng.integers(20, 40)
+            trials = np.arange(1, n + 1)
+            values = model(trials, 0.2, 0.8, 0.1) + rng.normal(0, 0.2, n)
+            rows += [dict(Subject=subject, taste=taste, Trial=t, Trial2=2. * t, Value=v)
+                     for t, v in zip(trials, values)]
+    return pd.DataFrame(rows)
+
+
+def test_null_dist_depends_only_on_seed():
+    df = make_data()
+    kw = dict(subject_cols=['Subject', 'taste'], seed=7, parallel=False)
+    full = shuffle_null_dist(df, nIter=40, **kw)
+    assert np.array_equal(full['r2'], shuffle_null_dist(df, nIter=40, block_size=3, **kw)['r2'])
+    parts = pd.concat([shuffle_null_dist(df, nIter=25, **kw), shuffle_null_dist(df, nIter=15, iter_start=25, **kw)])
+    assert np.array_equal(full['r2'], parts['r2'])
+    assert np.array_equal(full['iternum'], parts['iternum'])
+
+
+def tamper(save_dir):
+    # overwrite every saved null distribution with values a fit cannot give
+    for fn in os.listdir(save_dir):
+        if fn.endswith('.feather'):
+            path = os.path.join(save_dir, fn)
+            iters = pd.read_feather(path)
+            iters['r2'] = np.float32(-99.)
+            iters.to_feather(path)
+
+
+def test_iter_shuffle_overwrite_recomputes(tmp_path):
+    df = make_data()
+    kw = dict(nIter=20, subject_cols=['Subject', 'taste'], save_dir=str(tmp_path), solver='varpro', seed=3,
+              chunk_size=10, parallel=False)
+    first = iter_shuffle(df, overwrite=True, **kw)
+    tamper(str(tmp_path))
+    assert np.all(iter_shuffle(df, overwrite=False, **kw)['r2'] == -99.)
+
+    again = iter_shuffle(df, overwrite=True, **kw)
+    assert not np.any(again['r2'] == -99.)
+    assert np.allclose(again['r2'], first['r2'])
+
+
+def test_multi_overwrite_recomputes(tmp_path):
+    df = make_data()
+    kw = dict(nIter=20, save_dir=str(tmp_path), solver='varpro', seed=5, chunk_size=10, parallel=False)
+    first = preprocess_nonlinear_regression_multi(df, 'Subject', ['taste'], ['Trial', 'Trial2'], ['Value'],
+                                                  overwrite=True, **kw)
+    tamper(str(tmp_path))
+    again = preprocess_nonlinear_regression_multi(df, 'Subject', ['taste'], ['Trial', 'Trial2'], ['Value'],
+                                                  overwrite=True, **kw)
+    for target, (df3, shuffle) in again.items():
+        assert not np.any(shuffle['r2'] == -99.)
+        assert np.allclose(shuffle['r2'], first[target][1]['r2'])
+
+
+def test_chunked_and_extended_match_fresh(tmp_path):
+    df = make_data()
+    kw = dict(subject_cols=['Subject', 'taste'], solver='varpro', seed=11, parallel=False)
+    fresh = iter_shuffle(df, nIter=40, chunk_size=40, save_dir=str(tmp_path / 'fresh'), **kw)
+    chunked = iter_shuffle(df, nIter=40, chunk_size=7, save_dir=str(tmp_path / 'chunked'), **kw)
+    assert np.array_equal(fresh['r2'], chunked['r2'])
+
+    iter_shuffle(df, nIter=20, chunk_size=20, save_dir=str(tmp_path / 'extended'), **kw)
+    extended = iter_shuffle(df, nIter=40, chunk_size=20, save_dir=str(tmp_path / 'extended'), overwrite=False, **kw)
+    assert np.array_equal(fresh['r2'], extended['r2'])
+    assert np.array_equal(fresh['iternum'], extended['iternum'])
+
+
+def test_multi_chunked_and_extended_match_fresh(tmp_path):
+    df = make_data()
+    args = (df, 'Subject', ['taste'], ['Trial', 'Trial2'], ['Value'])
+    kw = dict(solver='varpro', seed=13, parallel=False)
+    fresh = preprocess_nonlinear_regression_multi(*args, nIter=30, chunk_size=30, save_dir=str(tmp_path / 'fresh'),
+                                                  **kw)
+    preprocess_nonlinear_regression_multi(*args, nIter=10, chunk_size=10, save_dir=str(tmp_path / 'extended'), **kw)
+    extended = preprocess_nonlinear_regression_multi(*args, nIter=30, chunk_size=4, overwrite=False,
+                                                     save_dir=str(tmp_path / 'extended'), **kw)
+    for target, (df3, shuffle) in fresh.items():
+        assert np.array_equal(shuffle['r2'], extended[target][1]['r2'])
+
+
+def test_sequential_pvals_match_saved_null():
+    df = make_data()
+    kw = dict(subject_cols=['Subject', 'taste'], solver='varpro', seed=17)
+    pval_df, iters = sequential_shuffle_pvals(df, h=3, max_iter=60, batch_size=20, **kw)
+    null = shuffle_null_dist(df, nIter=60, parallel=False, **kw)
+    # each group's draws are those of shuffle_null_dist, whichever groups stopped
+    merged = iters.merge(null, on=['Subject', 'taste', 'iternum'], suffixes=('', '_full'))
+    assert len(merged) == len(iters)
+    assert np.array_equal(merged['r2'], merged['r2_full'])
+
+    pvals = get_shuff_pvals(null, pval_df, groups=['Subject', 'taste'], h=3, batch_size=20)
+    pvals = pvals.merge(pval_df, on=['Subject', 'taste'], suffixes=('', '_seq'))
+    assert np.allclose(pvals['pval'], pvals['pval_seq'])
+    # groups that never stopped are bounded away from 0
+    ran_out = pval_df[pval_df['n_exceed'] < 3]
+    assert np.all(ran_out['pval'] == (ran_out['n_exceed'] + 1) / 61)
@@ -1,4 +1,9 @@
 import numpy as np
+import os
+import shutil
+import json
+import hashlib
+import inspect
 import random
 from scipy.optimize import curve_fit
 from sklearn.metrics import r2_score
@@ -11,6 +16,7 @@ import matplotlib.lines as mlines
 import random
 import scipy.stats as stats
 from sklearn.utils import resample
+import worker_budget as wb
 
 
 # def model(x, a, b, c):
@@ -97,8 +103,294 @@ def calc_cmax(dy, dx, nTrials):
     return cmax
 
 
+def parse_bounds(paramMax, paramMin, yMin=None, yMax=None):
+    buffer = 1e-10
+    if paramMax == paramMin:
+        print('bound collision detected, adjusting max/min values')
+        if yMax is None and yMin is None:
+            paramMin = paramMin - buffer
+            paramMax = paramMax + buffer
+            print('new bounds: ' + str(paramMin) + ' ' + str(paramMax))
+        else:
+            if yMax is not None:
+                if paramMin == yMax:
+                    paramMin = paramMin - buffer
+            if yMin is not None:
+                if paramMax == yMin:
+                    paramMax = paramMax + buffer
+            print('new bounds: ' + str(paramMin) + ' ' + str(paramMax))
+    if paramMax == paramMin:
+        raise Exception('bounds still equal after adjustment')
+    #if either paramMin or paramMax is nan, raise exception
+    if np.isnan(paramMin) or np.isnan(paramMax):
+        raise Exception('paramMin or paramMax is nan')
+    return paramMin, paramMax
+
+
+def get_fit_bounds(trials, values, trialMax, trialMin, yMin=None, yMax=None):
+    """
+    Bounds and initial guess for fitting model to one subject's data (trials
+    sorted ascending). a and b are bounded by the range of the data and c by
+    calc_cmax. The initial guess comes from a linear regression.
+
+    Returns:
+    tuple: (p0, lower, upper) each as [a, b, c]
+    """
+    valMax = np.max(values)
+    valMin = np.min(values)
+    aMin = valMin
+    aMax = valMax
+    bMax = valMax
+    bMin = valMin
+
+    dy = abs(valMax - valMin)
+    dx = abs(trialMax - trialMin)
+    nTrials = len(trials)
+
+    cMax = calc_cmax(dy, dx, nTrials)
+    cMin = 0
+
+    aMin, aMax = parse_bounds(aMax, aMin, yMin=yMin, yMax=yMax)
+    bMin, bMax = parse_bounds(bMax, bMin, yMin=yMin, yMax=yMax)
+    cMin, cMax = parse_bounds(cMax, cMin, yMin=yMin, yMax=yMax)
+
+    slope, intercept, r_value, p_value, std_err = stats.linregress(trials,
+                                                                   values)  # first estimate bounds using linear regression
+    y0 = slope * np.min(trials) + intercept  # calculate the y value at the min(trials)
+    y1 = slope * np.max(trials) + intercept  # calculate the y value at the max(trials)
+    c0 = abs(slope)  # slope is the initial guess for c
+
+    if aMin <= y0 <= aMax:
+        a0 = y0
+    else:
+        a0 = values[0]
+
+    if bMin <= y1 <= bMax:
+        b0 = y1
+    else:
+        b0 = values[-1]
+
+    if c0 > cMax:
+        c0 = cMax
+
+    return [a0, b0, c0], [aMin, bMin, cMin], [aMax, bMax, cMax]
+
+
+def pad_groups(arrays, fill=0.):
+    """
+    Stacks a list of 1-D arrays of different lengths into a padded 2-D array.
+
+    Returns:
+    tuple: (padded array, boolean mask of real entries)
+    """
+    n = max(len(x) for x in arrays)
+    out = np.full((len(arrays), n), fill, dtype=float)
+    mask = np.zeros((len(arrays), n), dtype=bool)
+    for i, x in enumerate(arrays):
+        out[i, :len(x)] = x
+        mask[i, :len(x)] = True
+    return out, mask
+
+
+def fit_batched(trials, values, mask, p0, lower, upper, max_iter=500, ftol=1e-12, xtol=1e-12):
+    """
+    Fits model to many groups at once with a vectorized, bound-constrained
+    Levenberg-Marquardt. Parameters sitting on a bound with the gradient
+    pointing outwards are held fixed for that step and steps are projected
+    back into the bounds.
+
+    Args:
+    trials, values, mask (np.array): G x T padded arrays (see pad_groups)
+    p0, lower, upper (np.array): G x 3 initial guesses and bounds for (a, b, c)
+
+    Returns:
+    np.array: G x 3 fitted parameters
+    """
+    lower = np.asarray(lower, dtype=float)
+    upper = np.asarray(upper, dtype=float)
+    p = np.clip(np.asarray(p0, dtype=float), lower, upper)
+    n_groups = p.shape[0]
+    eye = np.eye(3)
+
+    def residuals(p, trials, values, mask):
+        r = model(trials, p[:, 0:1], p[:, 1:2], p[:, 2:3]) - values
+        return np.where(mask, r, 0.)
+
+    r = residuals(p, trials, values, mask)
+    cost = np.sum(r**2, axis=1)
+    lam = np.full(n_groups, 1e-3)
+    active = np.ones(n_groups, dtype=bool)
+    for it in range(max_iter):
+        # only the groups that have not converged yet are updated
+        idx = np.flatnonzero(active)
+        if len(idx) == 0:
+            break
+
+        pi, ri, ti, mi = p[idx], r[idx], trials[idx], mask[idx]
+        e = np.exp(-pi[:, 2:3] * ti)
+        J = np.stack([e, 1 - e, -(pi[:, 0:1] - pi[:, 1:2]) * ti * e], axis=2)
+        J = np.where(mi[:, :, None], J, 0.)
+        g = np.einsum('gtk,gt->gk', J, ri)
+        H = np.einsum('gtk,gtl->gkl', J, J)
+
+        lo, hi = lower[idx], upper[idx]
+        fixed = ((pi <= lo) & (g > 0)) | ((pi >= hi) & (g < 0))
+        free = ~fixed
+        A = H + lam[idx, None, None] * (H * eye) + 1e-15 * eye
+        A = np.where(free[:, :, None] & free[:, None, :], A, 0.) + fixed[:, :, None] * eye
+        step = np.linalg.solve(A, np.where(free, -g, 0.)[:, :, None])[:, :, 0]
+
+        p_new = np.clip(pi + step, lo, hi)
+        r_new = residuals(p_new, ti, values[idx], mi)
+        new_cost = np.sum(r_new**2, axis=1)
+        improved = new_cost < cost[idx]
+
+        small_step = np.linalg.norm(p_new - pi, axis=1) <= xtol * (np.linalg.norm(pi, axis=1) + xtol)
+        small_gain = improved & ((cost[idx] - new_cost) <= ftol * cost[idx])
+
+        p[idx] = np.where(improved[:, None], p_new, pi)
+        r[idx] = np.where(improved[:, None], r_new, ri)
+        cost[idx] = np.where(improved, new_cost, cost[idx])
+        lam[idx] = np.where(improved, lam[idx] / 3, lam[idx] * 2)
+        active[idx] = ~(small_step | small_gain | (lam[idx] > 1e12))
+
+    return p
+
+
+def fit_batched_multistart(trials, values, mask, p0, lower, upper, c_starts=(1/30, 1/10, 1/3)):
+    """
+    Runs fit_batched from p0 and from restarts with c set to fractions of
+    cMax, keeping the lowest-cost fit per group. The model has local minima
+    along c, so this makes the batched fit at least as good as a single
+    local fit from p0.
+    """
+    n_groups = p0.shape[0]
+    starts = [p0]
+    for frac in c_starts:
+        p = p0.copy()
+        p[:, 2] = lower[:, 2] + frac * (upper[:, 2] - lower[:, 2])
+        starts.append(p)
+    n_starts = len(starts)
+    tile = lambda x: np.concatenate([x] * n_starts)
+    params = fit_batched(tile(trials), tile(values), tile(mask), np.concatenate(starts), tile(lower), tile(upper))
+    pred = model(tile(trials), params[:, 0:1], params[:, 1:2], params[:, 2:3])
+    cost = np.sum(np.where(tile(mask), pred - tile(values), 0.)**2, axis=1)
+    best = np.argmin(cost.reshape(n_starts, n_groups), axis=0)
+    return params.reshape(n_starts, n_groups, 3)[best, np.arange(n_groups)]
+
+
+def varpro_ab(trials, values, mask, c, lower, upper):
+    """
+    For fixed c the model is linear in a and b (y = a*e + b*(1-e) with
+    e = exp(-c*t)), so the bounded least squares solution for (a, b) can be
+    found in closed form. The optimum is either the unconstrained solution or
+    lies on one of the four edges of the box, so all candidates are evaluated
+    and the feasible one with the lowest cost is kept.
+
+    Args:
+    trials, values, mask (np.array): G x T padded arrays (see pad_groups)
+    c (np.array): G x K values of c to evaluate for each group
+    lower, upper (np.array): G x 3 bounds for (a, b, c)
+
+    Returns:
+    tuple: (a, b, cost) each G x K
+    """
+    e = np.exp(-c[:, :, None] * trials[:, None, :])
+    f = np.where(mask[:, None, :], 1 - e, 0.)
+    e = np.where(mask[:, None, :], e, 0.)
+    y = np.where(mask, values, 0.)[:, None, :]
+    See, Sef, Sff = np.sum(e * e, axis=2), np.sum(e * f, axis=2), np.sum(f * f, axis=2)
+    Sey, Sfy = np.sum(e * y, axis=2), np.sum(f * y, axis=2)
+    Syy = np.sum(y * y, axis=2)
+    aMin, aMax = lower[:, 0:1], upper[:, 0:1]
+    bMin, bMax = lower[:, 1:2], upper[:, 1:2]
+
+    def cost(a, b):
+        return Syy - 2 * (a * Sey + b * Sfy) + a * a * See + 2 * a * b * Sef + b * b * Sff
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        det = See * Sff - Sef**2
+        a_free = (Sey * Sff - Sfy * Sef) / det
+        b_free = (Sfy * See - Sey * Sef) / det
+        feasible = (det > 1e-12 * See * Sff) & (a_free >= aMin) & (a_free <= aMax) & \
+                   (b_free >= bMin) & (b_free <= bMax)
+        candidates = [(np.where(feasible, a_free, aMin), np.where(feasible, b_free, bMin), feasible)]
+        for a_edge in (aMin, aMax):
+            a_edge = np.broadcast_to(a_edge, c.shape)
+            b_edge = np.clip(np.where(Sff > 0, (Sfy - a_edge * Sef) / Sff, bMin), bMin, bMax)
+            candidates.append((a_edge, b_edge, None))
+        for b_edge in (bMin, bMax):
+            b_edge = np.broadcast_to(b_edge, c.shape)
+            a_edge = np.clip(np.where(See > 0, (Sey - b_edge * Sef) / See, aMin), aMin, aMax)
+            candidates.append((a_edge, b_edge, None))
+
+    best_a, best_b, best_cost = None, None, None
+    for a, b, ok in candidates:
+        cst = cost(a, b)
+        if ok is not None:
+            cst = np.where(ok, cst, np.inf)
+        if best_cost is None:
+            best_a, best_b, best_cost = a, b, cst
+        else:
+            better = cst < best_cost
+            best_a = np.where(better, a, best_a)
+            best_b = np.where(better, b, best_b)
+            best_cost = np.where(better, cst, best_cost)
+    return best_a, best_b, best_cost
+
+
+def fit_varpro(trials, values, mask, lower, upper, n_grid=48, n_golden=30):
+    """
+    Fits model to many groups at once by variable projection: a and b are
+    solved in closed form for each c (varpro_ab), c is first picked from a
+    grid over [cMin, cMax] and then refined by golden-section search between
+    the neighbouring grid points.
+
+    Args:
+    trials, values, mask (np.array): G x T padded arrays (see pad_groups)
+    lower, upper (np.array): G x 3 bounds for (a, b, c)
+    n_grid (int): number of grid points for c, spaced densely at small c
+    n_golden (int): golden-section iterations
+
+    Returns:
+    np.array: G x 3 fitted parameters
+    """
+    lower = np.asarray(lower, dtype=float)
+    upper = np.asarray(upper, dtype=float)
+    n_groups = lower.shape[0]
+    rows = np.arange(n_groups)
+    cMin, cMax = lower[:, 2:3], upper[:, 2:3]
+
+    grid = cMin + (cMax - cMin) * np.linspace(0, 1, n_grid)[None, :]**2
+    _, _, grid_cost = varpro_ab(trials, values, mask, grid, lower, upper)
+    k = np.argmin(grid_cost, axis=1)
+    lo = grid[rows, np.maximum(k - 1, 0)]
+    hi = grid[rows, np.minimum(k + 1, n_grid - 1)]
+
+    ratio = (np.sqrt(5) - 1) / 2
+    x1 = hi - ratio * (hi - lo)
+    x2 = lo + ratio * (hi - lo)
+    _, _, f = varpro_ab(trials, values, mask, np.stack([x1, x2], axis=1), lower, upper)
+    f1, f2 = f[:, 0], f[:, 1]
+    for it in range(n_golden):
+        left = f1 < f2
+        hi = np.where(left, x2, hi)
+        lo = np.where(left, lo, x1)
+        x_new = np.where(left, hi - ratio * (hi - lo), lo + ratio * (hi - lo))
+        _, _, f_new = varpro_ab(trials, values, mask, x_new[:, None], lower, upper)
+        f_new = f_new[:, 0]
+        x1, x2 = np.where(left, x_new, x2), np.where(left, x1, x_new)
+        f1, f2 = np.where(left, f_new, f2), np.where(left, f1, f_new)
+
+    # keep the grid point if the refinement did not improve on it
+    c = np.stack([grid[rows, k], (lo + hi) / 2], axis=1)
+    a, b, cst = varpro_ab(trials, values, mask, c, lower, upper)
+    best = np.argmin(cst, axis=1)
+    return np.stack([a[rows, best], b[rows, best], c[rows, best]], axis=1)
+
+
 def nonlinear_regression(data, subject_cols=['Subject'], trial_col='Trial', value_col='Value', yMin=None, yMax=None,
-                         parallel=True):
+                         parallel=True, solver='curve_fit'):
     """
     Performs nonlinear regression on the synthetic data for each subject.
 
@@ -108,93 +400,66 @@ def nonlinear_regression(data, subject_cols=['Subject'], trial_col='Trial', valu
     trial_col (str): Name of the column containing trial data.
     value_col (str): Name of the column containing value data.
     model (function): The nonlinear model function.
+    solver (str): 'curve_fit' fits each subject with scipy curve_fit,
+        'batched' fits all subjects at once with fit_batched_multistart,
+        'varpro' fits all subjects at once with fit_varpro
 
     Returns:
     dict: A dictionary containing the fitted parameters and R2 scores for each subject.
     """
 
-    def parse_bounds(paramMax, paramMin):
-        buffer = 1e-10
-        if paramMax == paramMin:
-            print('bound collision detected, adjusting max/min values')
-            if yMax is None and yMin is None:
-                paramMin = paramMin - buffer
-                paramMax = paramMax + buffer
-                print('new bounds: ' + str(paramMin) + ' ' + str(paramMax))
-            else:
-                if yMax is not None:
-                    if paramMin == yMax:
-                        paramMin = paramMin - buffer
-                if yMin is not None:
-                    if paramMax == yMin:
-                        paramMax = paramMax + buffer
-                print('new bounds: ' + str(paramMin) + ' ' + str(paramMax))
-        if paramMax == paramMin:
-            raise Exception('bounds still equal after adjustment')
-        #if either paramMin or paramMax is nan, raise exception
-        if np.isnan(paramMin) or np.isnan(paramMax):
-            raise Exception('paramMin or paramMax is nan')
-        return paramMin, paramMax
-
     trialMax = np.max(data[trial_col])
     trialMin = np.min(data[trial_col])
 
-    def fit_for_subject(subject, subject_data):
-        if len(subject_data[trial_col]) < 2:
-            print('Not enough data points to fit model for subject ' + str(subject))
-            return subject, (np.nan, np.nan, np.nan), np.nan, np.nan
+    def prep_subject(subject, subject_data):
         # sort subject data by trial_col
         subject_data = subject_data.copy().sort_values(by=[trial_col]).reset_index(drop=True)
         trials = subject_data[trial_col].to_numpy()
         values = subject_data[value_col].to_numpy()
+        return trials, values
 
-        valMax = np.max(values)
-        valMin = np.min(values)
-        aMin = valMin
-        aMax = valMax
-        bMax = valMax
-        bMin = valMin
-
-        dy = abs(valMax - valMin)
-        dx = abs(trialMax - trialMin)
-        nTrials = len(trials)
-
-        cMax = calc_cmax(dy, dx, nTrials)
-        cMin = 0
-
-        aMin, aMax = parse_bounds(aMax, aMin)
-        bMin, bMax = parse_bounds(bMax, bMin)
-        cMin, cMax = parse_bounds(cMax, cMin)
-
-        slope, intercept, r_value, p_value, std_err = stats.linregress(trials,
-                                                                       values)  # first estimate bounds using linear regression
-        y0 = slope * np.min(trials) + intercept  # calculate the y value at the min(trials)
-        y1 = slope * np.max(trials) + intercept  # calculate the y value at the max(trials)
-        c0 = abs(slope)  # slope is the initial guess for c
-
-        if aMin <= y0 <= aMax:
-            a0 = y0
-        else:
-            a0 = values[0]
-
-        if bMin <= y1 <= bMax:
-            b0 = y1
-        else:
-            b0 = values[-1]
-
-        if c0 > cMax:
-            c0 = cMax
+    def fit_for_subject(subject, subject_data):
+        if len(subject_data[trial_col]) < 2:
+            print('Not enough data points to fit model for subject ' + str(subject))
+            return subject, (np.nan, np.nan, np.nan), np.nan, np.nan
+        trials, values = prep_subject(subject, subject_data)
+        p0, lower, upper = get_fit_bounds(trials, values, trialMax, trialMin, yMin=yMin, yMax=yMax)
 
-        params, _ = curve_fit(model, trials, values, p0=[a0, b0, c0], bounds=[[aMin, bMin, cMin], [aMax, bMax, cMax]],
+        params, _ = curve_fit(model, trials, values, p0=p0, bounds=[lower, upper],
                               maxfev=10000000)
         y_pred = model(trials, *params)
         r2 = r2_score(values, y_pred)
 
         return subject, params, r2, y_pred
 
-    if parallel:
-        results = Parallel(n_jobs=-1)(
-            delayed(fit_for_subject)(subject, subject_data) for subject, subject_data in data.groupby(subject_cols))
+    if solver != 'curve_fit':
+        if solver not in ('batched', 'varpro'):
+            raise ValueError('unknown solver ' + str(solver))
+        results = []
+        to_fit = []
+        for subject, subject_data in data.groupby(subject_cols):
+            results.append((subject, (np.nan, np.nan, np.nan), np.nan, np.nan))
+            if len(subject_data[trial_col]) < 2:
+                print('Not enough data points to fit model for subject ' + str(subject))
+                continue
+            trials, values = prep_subject(subject, subject_data)
+            to_fit.append((len(results) - 1, trials, values) + tuple(get_fit_bounds(trials, values, trialMax, trialMin,
+                                                                                   yMin=yMin, yMax=yMax)))
+        if len(to_fit) > 0:
+            idx, trials, values, p0, lower, upper = zip(*to_fit)
+            X, mask = pad_groups(trials)
+            Y, _ = pad_groups(values)
+            p0, lower, upper = np.array(p0), np.array(lower), np.array(upper)
+            if solver == 'batched':
+                params = fit_batched_multistart(X, Y, mask, p0, lower, upper)
+            else:
+                params = fit_varpro(X, Y, mask, lower, upper)
+            for i, x, y, prm in zip(idx, trials, values, params):
+                y_pred = model(x, *prm)
+                results[i] = (results[i][0], prm, r2_score(y, y_pred), y_pred)
+    elif parallel:
+        results = wb.Parallel(n_jobs=-1)(
+            wb.delayed(fit_for_subject)(subject, subject_data) for subject, subject_data in data.groupby(subject_cols))
     else:
         results = []
         for subject, subject_data in data.groupby(subject_cols):
@@ -207,20 +472,58 @@ def nonlinear_regression(data, subject_cols=['Subject'], trial_col='Trial', valu
     return fitted_params, r2_scores, y_pred
 
 
-def bootstrap_stats(matrix, n_bootstraps=1000, axis=0):
-    # Number of rows and columns in the matrix
-    n_rows, n_cols = matrix.shape
+def bootstrap_kernel(data, n_boot=1000, reducer=np.nanmean, reducer_axis=True, percentiles=(2.5, 97.5),
+                     max_elements=2e7, rng=None):
+    """
+    Bootstraps a statistic of every column of data at once. An n_boot x n
+    matrix of resampling indices is drawn in one call and reducer is applied
+    to the resampled n_boot x n x m array along axis 1. When that array would
+    hold more than max_elements values the resamples are evaluated in chunks.
+
+    Args:
+    data (np.array): n samples (x m columns)
+    n_boot (int): number of bootstrap resamples
+    reducer (function): statistic of the B x n x m sample that returns B x m
+    reducer_axis (bool): if True reducer is called as reducer(sample, axis=1),
+        otherwise as reducer(sample)
+    percentiles (tuple): percentiles of the bootstrap distribution to return
+    rng (np.random.Generator): random generator, np.random is used if None
 
-    # Initialize arrays to store bootstrap means and standard deviations
-    boot_means = np.zeros((n_bootstraps, n_cols))
+    Returns:
+    dict: 'boot' (n_boot x m statistics), 'mean' (nanmean over resamples)
+        and 'ci' (len(percentiles) x m)
+    """
+    data = np.asarray(data, dtype=float)
+    vector = data.ndim == 1
+    if vector:
+        data = data[:, None]
+    n, m = data.shape
+    if rng is None:
+        idx = np.random.randint(0, n, size=(n_boot, n))
+    else:
+        idx = rng.integers(0, n, size=(n_boot, n))
+
+    chunk = int(max(1, max_elements // max(n * m, 1)))
+    boot = []
+    for start in range(0, n_boot, chunk):
+        sample = data[idx[start:start + chunk]]
+        if reducer_axis:
+            boot.append(reducer(sample, axis=1))
+        else:
+            boot.append(reducer(sample))
+    boot = np.concatenate(boot)
 
-    # Perform bootstrap resampling
-    for i in range(n_bootstraps):
-        # Sample with replacement from the rows of the matrix
-        sample = matrix[np.random.randint(0, n_rows, size=n_rows)]
+    res = {'boot': boot, 'mean': np.nanmean(boot, axis=0), 'ci': np.nanpercentile(boot, percentiles, axis=0)}
+    if vector:
+        res = {k: v[..., 0][()] for k, v in res.items()}
+    return res
 
-        # Calculate mean and standard deviation for each column in the sample, ignoring NaNs
-        boot_means[i, :] = np.nanmean(sample, axis=axis)
+
+def bootstrap_stats(matrix, n_bootstraps=1000, axis=0):
+    # resample the rows of the matrix and take the mean of each column, ignoring NaNs
+    boot_means = bootstrap_kernel(matrix, n_boot=n_bootstraps,
+                                  reducer=lambda sample: np.nanmean(sample, axis=axis + 1),
+                                  reducer_axis=False)['boot']
 
     bootmean = np.nanmean(boot_means, axis=axis)
     bootci = np.nanpercentile(boot_means, [2.5, 97.5], axis=axis)
@@ -305,95 +608,575 @@ def calc_pred_change(trials, params):
     min_pr = model(min_trial, *params)
     return max_pr - min_pr
 
-def iter_shuffle(data, nIter=10000, subject_cols=['Subject'], trial_col='Trial', value_col='Value', yMin=None,
-                 yMax=None, save_dir=None, overwrite=True, parallel=True, flag=None):
-
-    shuffname = trial_col + '_' + value_col + '_nonlinearNullDist.feather'
-    if flag:
-        shuffname = flag + '_' + shuffname
-
-    if overwrite is False:
-        try:
-            iters = pd.read_feather(save_dir + '/' + shuffname)
-            #check if iters is actually a dataframe
-            if type(iters) != pd.core.frame.DataFrame:
-                raise ValueError('iters is not a dataframe, try re-running with overwrite=True')
-            elif iters is None:
-                raise ValueError('iters is None, try re-running with overwrite=True')
-            else:
-                return iters
-        except FileNotFoundError:
-            print('file ' + shuffname + ' not found, overwriting')
-            overwrite = True
+
+def calc_pred_change_columns(trials, alpha, beta, c):
+    """
+    Vectorized calc_pred_change for arrays of alpha, beta and c.
+    """
+    alpha, beta, c = [np.asarray(x, dtype=float) for x in (alpha, beta, c)]
+    return model(np.max(trials), alpha, beta, c) - model(np.min(trials), alpha, beta, c)
+
+
+SHUFF_PARAM_COLS = ['alpha', 'beta', 'c']
+SHUFF_VALUE_COLS = ['params'] + SHUFF_PARAM_COLS + ['r2']
+
+
+def shuffle_frame(keys, params, r2, iternum):
+    """
+    Builds a shuffle result table: the group key columns as categoricals,
+    alpha, beta, c and r2 as float32 columns and iternum.
+
+    Args:
+    keys (pd.DataFrame): group key columns, one row per result
+    params (np.array): N x 3 fitted (alpha, beta, c)
+    r2 (np.array): N r2 scores
+    iternum (np.array): N iteration numbers
+    """
+    iters = keys.reset_index(drop=True).copy()
+    params = np.asarray(params, dtype=float).reshape(-1, 3)
+    for i, col in enumerate(SHUFF_PARAM_COLS):
+        iters[col] = params[:, i]
+    iters['r2'] = r2
+    iters['iternum'] = iternum
+    return shuffle_to_columnar(iters)
+
+
+def shuffle_to_columnar(iters):
+    """
+    Converts a shuffle result table to the columnar schema (see
+    shuffle_frame). Tables in the legacy layout, with a 'params' column of
+    (alpha, beta, c) tuples, are unpacked.
+    """
+    iters = iters.copy()
+    if 'params' in iters.columns:
+        params = np.array([np.full(3, np.nan) if p is None else np.asarray(p, dtype=float) for p in iters['params']])
+        params = params.reshape(-1, 3)
+        iters = iters.drop(columns='params')
+        for i, col in enumerate(SHUFF_PARAM_COLS):
+            iters[col] = params[:, i]
+    key_cols = [col for col in iters.columns if col not in SHUFF_VALUE_COLS + ['iternum']]
+    for col in key_cols:
+        iters[col] = iters[col].astype('category')
+    for col in SHUFF_PARAM_COLS + ['r2']:
+        iters[col] = iters[col].astype(np.float32)
+    iters['iternum'] = iters['iternum'].astype(np.int32)
+    return iters[key_cols + SHUFF_PARAM_COLS + ['r2', 'iternum']]
+
+
+def shuffle_iteration(data, i, subject_cols=['Subject'], trial_col='Trial', value_col='Value', yMin=None, yMax=None,
+                      solver='curve_fit'):
+    shuff = shuffle_time(data, subject_cols=subject_cols, trial_col=trial_col)
+    params, r2, _ = nonlinear_regression(shuff, subject_cols=subject_cols, trial_col=trial_col, value_col=value_col,
+                                         yMin=yMin, yMax=yMax, solver=solver)
+    keys = pd.DataFrame([k if isinstance(k, tuple) else (k,) for k in params.keys()], columns=subject_cols)
+    return shuffle_frame(keys, [params[k] for k in params.keys()], [r2[k] for k in params.keys()],
+                         np.full(len(keys), i))
+
+
+def shuffle_chunk(data, iter_start, iter_stop, subject_cols=['Subject'], trial_col='Trial', value_col='Value',
+                  yMin=None, yMax=None, parallel=True, solver='curve_fit', seed=None):
+    """
+    Computes the shuffle iterations iter_start to iter_stop - 1, with the
+    array engine (shuffle_null_dist) for solver 'varpro'/'batched' or one
+    shuffle_time + nonlinear_regression per iteration for 'curve_fit'.
+    """
+    if solver != 'curve_fit':
+        return shuffle_null_dist(data, nIter=iter_stop - iter_start, subject_cols=subject_cols, trial_col=trial_col,
+                                 value_col=value_col, yMin=yMin, yMax=yMax, solver=solver, parallel=parallel,
+                                 seed=seed, iter_start=iter_start)
+    if parallel:
+        iters = wb.Parallel(n_jobs=-1, n_tasks=iter_stop - iter_start)(
+            wb.delayed(shuffle_iteration)(data, i, subject_cols=subject_cols, trial_col=trial_col, value_col=value_col,
+                                          yMin=yMin, yMax=yMax)
+            for i in range(iter_start, iter_stop))
+    else:
+        iters = []
+        for i in range(iter_start, iter_stop):
+            print("iter " + str(i) + " of " + str(iter_stop))
+            iters.append(shuffle_iteration(data, i, subject_cols=subject_cols, trial_col=trial_col,
+                                           value_col=value_col, yMin=yMin, yMax=yMax))
+    return shuffle_to_columnar(pd.concat(iters).reset_index(drop=True))
+
+
+def load_null_dist(shuffpath, chunk_dir):
+    """
+    Loads a saved null distribution together with any checkpointed chunks
+    that have not been merged into it yet, in the columnar schema of
+    shuffle_frame (legacy files are converted). Returns None if there is
+    nothing saved.
+    """
+    iters = []
+    if os.path.exists(shuffpath):
+        iters.append(pd.read_feather(shuffpath))
+    if os.path.isdir(chunk_dir):
+        for fn in sorted(os.listdir(chunk_dir)):
+            if fn.endswith('.feather'):
+                iters.append(pd.read_feather(os.path.join(chunk_dir, fn)))
+    iters = [df for df in iters if isinstance(df, pd.DataFrame) and len(df) > 0]
+    if len(iters) == 0:
+        return None
+    iters = shuffle_to_columnar(pd.concat([shuffle_to_columnar(df) for df in iters]))
+    # a chunk can overlap the merged file if a run was killed while merging;
+    # chunks are read after the merged file, so the newer chunk rows are kept
+    iters = iters[~iters.duplicated(subset=[col for col in iters.columns if col not in SHUFF_VALUE_COLS],
+                                    keep='last')]
+    return iters.sort_values('iternum', kind='stable').reset_index(drop=True)
+
+
+def write_feather_atomic(df, path):
+    tmp = path + '.tmp'
+    df.reset_index(drop=True).to_feather(tmp)
+    os.replace(tmp, path)
+
+
+NULL_DIST_INDEX = 'nonlinearNullDist_index.json'
+
+
+def null_dist_key(data, subject_cols, trial_col, value_col, yMin=None, yMax=None, solver='curve_fit', seed=None):
+    """
+    Hash identifying a null distribution: the rows that enter the fit, the
+    grouping columns, the bounds, the model source, the solver and the seed.
+    nIter is left out so that a distribution can be extended (see iter_shuffle).
+    """
+    cols = list(subject_cols) + [trial_col, value_col]
+    try:
+        model_src = inspect.getsource(model)
+    except (OSError, TypeError):
+        model_src = model.__code__.co_code.hex() + repr(model.__code__.co_consts)
+    settings = {'subject_cols': list(subject_cols), 'trial_col': trial_col, 'value_col': value_col, 'yMin': yMin,
+                'yMax': yMax, 'solver': solver, 'seed': seed, 'model': model_src}
+    h = hashlib.sha1(json.dumps(settings, sort_keys=True, default=str).encode())
+    h.update(pd.util.hash_pandas_object(data[cols].reset_index(drop=True), index=False).to_numpy().tobytes())
+    return h.hexdigest()
+
+
+def read_null_dist_index(save_dir):
+    path = os.path.join(save_dir, NULL_DIST_INDEX)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def update_null_dist_index(save_dir, key, entry):
+    index = read_null_dist_index(save_dir)
+    index[key] = entry
+    path = os.path.join(save_dir, NULL_DIST_INDEX)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(index, f, indent=1, default=str)
+    os.replace(path + '.tmp', path)
+
+
+def open_null_dist(data, subject_cols, trial_col, value_col, save_dir, yMin=None, yMax=None, solver='curve_fit',
+                   seed=None, flag=None, overwrite=False):
+    """
+    Finds the saved null distribution for these settings (see null_dist_key)
+    and loads what has been computed so far, including checkpointed chunks.
+    With overwrite=True leftover chunks are removed and nothing is loaded.
+
+    Returns:
+    dict: key, shuffname, shuffpath, chunk_dir, iters (None if nothing was
+        loaded), n_done (first iternum still to compute) and the settings
+        recorded in the index by close_null_dist
+    """
+    key = null_dist_key(data, subject_cols, trial_col, value_col, yMin=yMin, yMax=yMax, solver=solver, seed=seed)
+    index = read_null_dist_index(save_dir)
+    if key in index and os.path.exists(os.path.join(save_dir, index[key]['file'])):
+        shuffname = index[key]['file']
+    else:
+        shuffname = trial_col + '_' + value_col + '_nonlinearNullDist_' + key[:12] + '.feather'
+        if flag:
+            shuffname = flag + '_' + shuffname
+
+    shuffpath = os.path.join(save_dir, shuffname)
+    chunk_dir = shuffpath[:-len('.feather')] + '_chunks'
     if overwrite is True:
-        if parallel:
-            iters = iter_shuffle_parallel(data, nIter=nIter, subject_cols=subject_cols, trial_col=trial_col,
-                                          value_col=value_col, save_dir=save_dir, overwrite=overwrite, yMin=yMin, yMax=yMax)
-        else:
-            iters = []
-            for i in range(nIter):
-                print("iter " + str(i) + " of " + str(nIter))
-                shuff = shuffle_time(data, subject_cols=subject_cols, trial_col=trial_col)
-                params, r2, _ = nonlinear_regression(shuff, subject_cols=subject_cols, trial_col=trial_col, value_col=value_col, yMin=yMin, yMax=yMax)
-
-                paramdf = pd.Series(params, name='params').to_frame()
-                r2df = pd.Series(r2, name='r2').to_frame()
-                df = pd.concat([paramdf, r2df], axis=1).reset_index()
-                cols = subject_cols + ['params', 'r2']
-                df = df.set_axis(cols, axis=1)
-                df['iternum'] = i
-                iters.append(df)
-
-            iters = pd.concat(iters)
-            iters = iters.reset_index(drop=True)
-        if save_dir is not None:
-            iters.to_feather(save_dir + '/' + shuffname)
-        return iters
+        # remove the merged file too, otherwise close_null_dist would merge
+        # the old iterations back in with the new chunks
+        if os.path.isdir(chunk_dir):
+            shutil.rmtree(chunk_dir)
+        if os.path.exists(shuffpath):
+            os.remove(shuffpath)
+        iters = None
+    else:
+        iters = load_null_dist(shuffpath, chunk_dir)
+        if iters is None:
+            print('file ' + shuffname + ' not found, overwriting')
+
+    n_done = 0 if iters is None else int(iters['iternum'].max()) + 1
+    if n_done > 0:
+        print('found ' + str(n_done) + ' iterations of ' + shuffname)
+    settings = {'subject_cols': list(subject_cols), 'trial_col': trial_col, 'value_col': value_col, 'yMin': yMin,
+                'yMax': yMax, 'solver': solver, 'seed': seed, 'flag': flag, 'n_rows': len(data)}
+    return {'key': key, 'save_dir': save_dir, 'shuffname': shuffname, 'shuffpath': shuffpath, 'chunk_dir': chunk_dir,
+            'iters': iters, 'n_done': n_done, 'settings': settings}
+
+
+def write_null_chunk(nd, chunk, start, stop):
+    os.makedirs(nd['chunk_dir'], exist_ok=True)
+    write_feather_atomic(chunk, os.path.join(nd['chunk_dir'], 'iters_%08d_%08d.feather' % (start, stop)))
+
+
+def close_null_dist(nd, nIter):
+    """
+    Merges the checkpointed chunks of a null distribution opened with
+    open_null_dist into its feather file, records it in the index and
+    returns the iterations below nIter.
+    """
+    iters = load_null_dist(nd['shuffpath'], nd['chunk_dir'])
+    if os.path.isdir(nd['chunk_dir']):
+        write_feather_atomic(iters, nd['shuffpath'])
+        shutil.rmtree(nd['chunk_dir'])
+        update_null_dist_index(nd['save_dir'], nd['key'], {'file': nd['shuffname'],
+                                                           'nIter': int(iters['iternum'].max()) + 1,
+                                                           **nd['settings']})
+    iters = iters[iters['iternum'] < nIter]
+    return iters.reset_index(drop=True)
+
+
+def iter_shuffle(data, nIter=10000, subject_cols=['Subject'], trial_col='Trial', value_col='Value', yMin=None,
+                 yMax=None, save_dir=None, overwrite=True, parallel=True, flag=None, solver='curve_fit', seed=None,
+                 chunk_size=500):
+    """
+    Builds the null distribution of fits to trial-shuffled data (see
+    shuffle_chunk).
+
+    Saved distributions are keyed by null_dist_key, and the key -> file
+    mapping is kept in save_dir/nonlinearNullDist_index.json, so a saved
+    distribution is only reused for the same data, grouping, bounds, model,
+    solver and seed.
+
+    With save_dir set, iterations are computed in chunks of chunk_size and
+    each finished chunk is written to <shuffname>_chunks/ straight away. With
+    overwrite=False an existing distribution is reused: a killed run resumes
+    after the highest finished iternum, and a distribution with fewer than
+    nIter iterations is extended by computing only the missing ones. When all
+    nIter iterations exist the chunks are merged into the feather file. With
+    the array engine and a fixed seed, resumed, extended and chunked runs give
+    the same iterations as one uninterrupted run (see fit_permutation_block).
+
+    Returns:
+    pd.DataFrame: subject_cols, alpha, beta, c, r2, iternum for iternum < nIter
+        (see shuffle_frame)
+    """
+    if save_dir is None:
+        return shuffle_chunk(data, 0, nIter, subject_cols=subject_cols, trial_col=trial_col, value_col=value_col,
+                             yMin=yMin, yMax=yMax, parallel=parallel, solver=solver, seed=seed)
+
+    nd = open_null_dist(data, subject_cols, trial_col, value_col, save_dir, yMin=yMin, yMax=yMax, solver=solver,
+                        seed=seed, flag=flag, overwrite=overwrite)
+    if nd['n_done'] < nIter:
+        os.makedirs(nd['chunk_dir'], exist_ok=True)
+        for start in range(nd['n_done'], nIter, chunk_size):
+            stop = min(start + chunk_size, nIter)
+            chunk = shuffle_chunk(data, start, stop, subject_cols=subject_cols, trial_col=trial_col,
+                                  value_col=value_col, yMin=yMin, yMax=yMax, parallel=parallel, solver=solver,
+                                  seed=seed)
+            write_null_chunk(nd, chunk, start, stop)
+    return close_null_dist(nd, nIter)
 
 
 from joblib import Parallel, delayed
 
 def iter_shuffle_parallel(data, nIter=10000, subject_cols=['Subject'], trial_col='Time', value_col='Value', yMin=None,
-                          yMax=None, save_dir=None, overwrite=True):
-    def single_iteration(i):
-        shuff = shuffle_time(data, subject_cols=subject_cols, trial_col=trial_col)
-        params, r2, _ = nonlinear_regression(shuff, subject_cols=subject_cols, trial_col=trial_col, value_col=value_col,
-                                             yMin=yMin, yMax=yMax)
-        paramdf = pd.Series(params, name='params').to_frame()
-        r2df = pd.Series(r2, name='r2').to_frame()
-        df = pd.concat([paramdf, r2df], axis=1).reset_index()
-        cols = subject_cols + ['params', 'r2']
-        df = df.set_axis(cols, axis=1)
-        df['iternum'] = i
-        return df
-
-    shuffname = trial_col + '_' + value_col + '_nonlinearNullDist.feather'
-    if overwrite is False:
-        try:
-            iters = pd.read_feather(save_dir + '/' + shuffname)
-            return iters
-        except FileNotFoundError:
-            pass
-
-    iters = Parallel(n_jobs=-1)(delayed(single_iteration)(i) for i in range(nIter))
-    iters = pd.concat(iters)
-    iters = iters.reset_index(drop=True)
+                          yMax=None, save_dir=None, overwrite=True, solver='curve_fit', seed=None, chunk_size=500):
+    return iter_shuffle(data, nIter=nIter, subject_cols=subject_cols, trial_col=trial_col, value_col=value_col,
+                        yMin=yMin, yMax=yMax, save_dir=save_dir, overwrite=overwrite, parallel=True, solver=solver,
+                        seed=seed, chunk_size=chunk_size)
 
-    if save_dir is not None:
-        iters.to_feather(save_dir + '/' + shuffname)
 
-    return iters
+def encode_shuffle_groups(data, subject_cols=['Subject'], trial_col='Trial', value_col='Value', yMin=None, yMax=None):
+    """
+    Encodes data once for repeated permutation fits: each group becomes a row
+    of padded arrays with its trials sorted, and the fit bounds (which do not
+    depend on the order of the values) are computed up front.
+
+    Returns:
+    dict: keys (group labels in groupby order), trials/values/mask (G x T),
+        lower/upper (G x 3) and valid (groups with at least 2 points)
+    """
+    trialMax = np.max(data[trial_col])
+    trialMin = np.min(data[trial_col])
+    keys, trials, values, lower, upper, valid = [], [], [], [], [], []
+    for subject, subject_data in data.groupby(subject_cols):
+        keys.append(subject)
+        order = np.argsort(subject_data[trial_col].to_numpy(), kind='stable')
+        x = subject_data[trial_col].to_numpy()[order]
+        y = subject_data[value_col].to_numpy()[order]
+        trials.append(x)
+        values.append(y)
+        if len(x) < 2:
+            print('Not enough data points to fit model for subject ' + str(subject))
+            valid.append(False)
+            lower.append([np.nan] * 3)
+            upper.append([np.nan] * 3)
+            continue
+        _, lo, hi = get_fit_bounds(x, y, trialMax, trialMin, yMin=yMin, yMax=yMax)
+        valid.append(True)
+        lower.append(lo)
+        upper.append(hi)
+
+    X, mask = pad_groups(trials)
+    Y, _ = pad_groups(values)
+    return {'keys': keys, 'trials': X, 'values': Y, 'mask': mask, 'lower': np.array(lower, dtype=float),
+            'upper': np.array(upper, dtype=float), 'valid': np.array(valid)}
+
+
+def batched_p0(trials, values, mask, lower, upper):
+    """
+    Vectorized version of the initial guess in get_fit_bounds: a linear
+    regression gives a0 and b0 at the first and last trial and |slope| gives c0.
+    """
+    n = mask.sum(axis=1)
+    tm = np.sum(np.where(mask, trials, 0.), axis=1) / n
+    ym = np.sum(np.where(mask, values, 0.), axis=1) / n
+    dt = np.where(mask, trials - tm[:, None], 0.)
+    dy = np.where(mask, values - ym[:, None], 0.)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = np.sum(dt * dy, axis=1) / np.sum(dt * dt, axis=1)
+    intercept = ym - slope * tm
+    last = n - 1
+    rows = np.arange(len(n))
+    y0 = slope * trials[:, 0] + intercept
+    y1 = slope * trials[rows, last] + intercept
+    a0 = np.where((lower[:, 0] <= y0) & (y0 <= upper[:, 0]), y0, values[:, 0])
+    b0 = np.where((lower[:, 1] <= y1) & (y1 <= upper[:, 1]), y1, values[rows, last])
+    c0 = np.minimum(np.abs(slope), upper[:, 2])
+    return np.stack([a0, b0, c0], axis=1)
+
+
+def fit_arrays(trials, values, mask, lower, upper, solver='varpro'):
+    """
+    Fits padded G x T arrays with the 'varpro' or 'batched' solver.
+
+    Returns:
+    np.array: G x 3 fitted parameters
+    """
+    if solver == 'varpro':
+        return fit_varpro(trials, values, mask, lower, upper)
+    elif solver == 'batched':
+        return fit_batched_multistart(trials, values, mask, batched_p0(trials, values, mask, lower, upper), lower,
+                                      upper)
+    raise ValueError('unknown solver ' + str(solver))
+
+
+def r2_arrays(trials, values, mask, params):
+    """
+    r2 of model with G x 3 params on padded G x T arrays, with the same
+    convention as r2_score for constant data.
+    """
+    pred = model(trials, params[:, 0:1], params[:, 1:2], params[:, 2:3])
+    ss_res = np.sum(np.where(mask, pred - values, 0.)**2, axis=1)
+    n = mask.sum(axis=1)
+    ym = np.sum(np.where(mask, values, 0.), axis=1) / n
+    ss_tot = np.sum(np.where(mask, values - ym[:, None], 0.)**2, axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(ss_tot > 0, 1 - ss_res / ss_tot, np.where(ss_res == 0, 1., 0.))
+
+
+def stack_encodings(encs):
+    """
+    Stacks encodings from encode_shuffle_groups (one per target) along the
+    group axis so that all targets are fit in one batch. Rows of different
+    targets that belong to the same group share their permutation draws
+    (draw_index) in fit_permutation_block.
+
+    Returns:
+    dict: stacked encoding, plus target (target number of each row)
+    """
+    n_trials = max(enc['trials'].shape[1] for enc in encs)
+    draw_keys = []
+    for enc in encs:
+        for key in enc['keys']:
+            if key not in draw_keys:
+                draw_keys.append(key)
+    draw_lookup = {key: i for i, key in enumerate(draw_keys)}
+
+    def pad(x, fill):
+        return np.pad(x, ((0, 0), (0, n_trials - x.shape[1])), constant_values=fill)
+
+    stacked = {'keys': [key for enc in encs for key in enc['keys']],
+               'trials': np.concatenate([pad(enc['trials'], 0.) for enc in encs]),
+               'values': np.concatenate([pad(enc['values'], 0.) for enc in encs]),
+               'mask': np.concatenate([pad(enc['mask'], False) for enc in encs]),
+               'lower': np.concatenate([enc['lower'] for enc in encs]),
+               'upper': np.concatenate([enc['upper'] for enc in encs]),
+               'valid': np.concatenate([enc['valid'] for enc in encs]),
+               'target': np.concatenate([np.full(len(enc['keys']), i) for i, enc in enumerate(encs)]),
+               'draw_index': np.array([draw_lookup[key] for enc in encs for key in enc['keys']]),
+               'n_draws': len(draw_keys)}
+    return stacked
+
+
+def fit_permutation_block(enc, seed, iternums, solver='varpro'):
+    """
+    Fits model to one random within-group permutation of the encoded data per
+    iternum in iternums, all permutations x groups as one batch. Shuffling
+    the trial labels within a group is the same as permuting the values
+    against the sorted trials.
+
+    The permutations of iternum i are drawn from np.random.default_rng([seed,
+    i]), one row of keys per group of the full encoding (draw_index), so the
+    draws of a group depend only on seed and iternum and not on the block
+    size or on which other groups are fit in the same block.
 
+    Returns:
+    tuple: (params, r2) with shapes len(iternums) x G x 3 and len(iternums) x G
+    """
+    X, Y, mask, valid = enc['trials'], enc['values'], enc['mask'], enc['valid']
+    n_groups, n_trials = X.shape
+    n_perm = len(iternums)
+    params = np.full((n_perm, n_groups, 3), np.nan)
+    r2 = np.full((n_perm, n_groups), np.nan)
+    if not np.any(valid):
+        return params, r2
+    X, Y, mask = X[valid], Y[valid], mask[valid]
+    lower, upper = enc['lower'][valid], enc['upper'][valid]
+    n_valid = X.shape[0]
+
+    # rows of a stacked encoding that share a group share its permutation draws
+    draw_index = enc.get('draw_index', np.arange(n_groups))
+    n_draws = enc.get('n_draws', n_groups)
+    perm_keys = np.stack([np.random.default_rng([seed, int(i)]).random((n_draws, n_trials))
+                          for i in iternums])[:, draw_index[valid]]
+    # padding is given a key above any real one so it stays at the end of each row
+    perm_keys[:, ~mask] = 2.
+    perm = np.argsort(perm_keys, axis=2)
+    Yp = np.take_along_axis(np.broadcast_to(Y, perm.shape), perm, axis=2).reshape(-1, n_trials)
+    Xp = np.broadcast_to(X, perm.shape).reshape(-1, n_trials)
+    mp = np.broadcast_to(mask, perm.shape).reshape(-1, n_trials)
+    lo = np.broadcast_to(lower, (n_perm, n_valid, 3)).reshape(-1, 3)
+    hi = np.broadcast_to(upper, (n_perm, n_valid, 3)).reshape(-1, 3)
+
+    prm = fit_arrays(Xp, Yp, mp, lo, hi, solver=solver)
+    r2_valid = r2_arrays(Xp, Yp, mp, prm)
+
+    params[:, valid] = prm.reshape(n_perm, n_valid, 3)
+    r2[:, valid] = r2_valid.reshape(n_perm, n_valid)
+    return params, r2
+
+
+def default_block_size(n_groups, n_trials, nIter):
+    # keeps the G x K x T arrays of fit_varpro to a few tens of MB per block;
+    # the block size does not change the draws (see fit_permutation_block)
+    return int(max(1, min(nIter, 4e6 // (n_groups * n_trials * 48))))
+
+
+def subset_encoding(enc, keep):
+    """
+    Restricts an encoding from encode_shuffle_groups to the groups in the
+    boolean array keep. The groups keep their rows of permutation draws
+    (draw_index), so they are shuffled as they would be in the full encoding.
+    """
+    sub = {k: (v[keep] if isinstance(v, np.ndarray) else v) for k, v in enc.items()}
+    sub['keys'] = [k for k, kp in zip(enc['keys'], keep) if kp]
+    if 'draw_index' not in enc:
+        sub['draw_index'] = np.flatnonzero(keep)
+        sub['n_draws'] = len(enc['keys'])
+    return sub
+
+
+def permutation_blocks(enc, seed, iter_start, iter_stop, solver='varpro', block_size=None, parallel=True,
+                       verbose=False):
+    """
+    Fit permutations iter_start to iter_stop of an encoding in blocks.
 
-def get_shuff_pvals(shuff, r2_df, groups=['exp_group', 'exp_name', 'taste', 'session']):
+    Args:
+    enc (dict): from encode_shuffle_groups or stack_encodings
+    seed (int): permutation iternum uses np.random.default_rng([seed, iternum])
+        (see fit_permutation_block), so the draws do not depend on block_size
+        or on how a run was split into chunks
+    block_size (int): permutations fit per block, see default_block_size
+    parallel (bool): fit blocks in parallel with joblib
+    verbose (bool): print progress after each block when not parallel
+
+    Returns:
+    np.ndarray: parameters, n_perm x G x 3
+    np.ndarray: r2, n_perm x G
+    """
+    n_groups, n_trials = enc['trials'].shape
+    n_iter = iter_stop - iter_start
+    if block_size is None:
+        block_size = default_block_size(n_groups, n_trials, n_iter)
+    starts = list(range(iter_start, iter_stop, block_size))
+
+    def run_block(start):
+        iternums = np.arange(start, min(start + block_size, iter_stop))
+        return fit_permutation_block(enc, seed, iternums, solver=solver)
+
+    if parallel:
+        blocks = wb.Parallel(n_jobs=-1, n_tasks=len(starts))(wb.delayed(run_block)(start) for start in starts)
+    else:
+        blocks = []
+        for start in starts:
+            if verbose:
+                print("iter " + str(start) + " of " + str(iter_stop))
+            blocks.append(run_block(start))
+    params = np.concatenate([b[0] for b in blocks]).reshape(n_iter, n_groups, 3)
+    r2 = np.concatenate([b[1] for b in blocks]).reshape(n_iter, n_groups)
+    return params, r2
+
+
+def shuffle_null_dist(data, nIter=10000, subject_cols=['Subject'], trial_col='Trial', value_col='Value', yMin=None,
+                      yMax=None, solver='varpro', block_size=None, parallel=True, seed=None, iter_start=0,
+                      verbose=False):
+    """
+    Array-native replacement for the shuffle_time/nonlinear_regression loop
+    of iter_shuffle. The data are encoded once (encode_shuffle_groups) and
+    permutations are generated and fit in blocks (fit_permutation_block),
+    without building a DataFrame per iteration.
+
+    Args:
+    solver (str): 'varpro' or 'batched', see nonlinear_regression
+    block_size (int): permutations fit per block. By default it is chosen
+        to keep each block's arrays to a few tens of MB
+    parallel (bool): fit blocks in parallel with joblib
+    seed (int): seed for the permutations. Permutation iternum is drawn from
+        np.random.default_rng([seed, iternum]), so a seed reproduces the same
+        null whatever nIter, block_size or chunking
+    iter_start (int): iternum of the first permutation, so that a run can be
+        continued in chunks (see iter_shuffle)
+    verbose (bool): print progress after each block when not parallel
+
+    Returns:
+    pd.DataFrame: subject_cols, alpha, beta, c, r2, iternum (see shuffle_frame)
+    """
+    enc = encode_shuffle_groups(data, subject_cols=subject_cols, trial_col=trial_col, value_col=value_col, yMin=yMin,
+                                yMax=yMax)
+    n_groups = enc['trials'].shape[0]
+    if seed is None:
+        seed = int(np.random.default_rng().integers(2**32))
+    iter_stop = iter_start + nIter
+    params, r2 = permutation_blocks(enc, seed, iter_start, iter_stop, solver=solver, block_size=block_size,
+                                    parallel=parallel, verbose=verbose)
+    params = params.reshape(-1, 3)
+    r2 = r2.reshape(-1)
+
+    keys = pd.DataFrame([k if isinstance(k, tuple) else (k,) for k in enc['keys']], columns=subject_cols)
+    return shuffle_frame(keys.iloc[np.tile(np.arange(n_groups), nIter)], params, r2,
+                         np.repeat(np.arange(iter_start, iter_stop), n_groups))
+
+
+def get_shuff_pvals(shuff, r2_df, groups=['exp_group', 'exp_name', 'taste', 'session'], h=None, batch_size=100):
+    """
+    p-value of the r2 of each group in r2_df against its null distribution in
+    shuff, with pval_from_null. If h is set the p-values use Besag-Clifford
+    stopping instead (sequential_pval_from_null), which are the p-values
+    sequential_shuffle_pvals gives with the same h, batch_size and seed when
+    shuff is a null from shuffle_null_dist with nIter = max_iter.
+    """
     names = []
     pvals = []
 
     r2_df_gb = r2_df.groupby(groups)
-    for name, group in shuff.groupby(groups):
+    for name, group in shuff.groupby(groups, observed=True):
         # get r2 for corresponding group in r2_df
         r2_group = r2_df_gb.get_group(name)
-        pval = pval_from_null(group.r2.to_numpy(), r2_group.r2.to_numpy())
+        if h is None:
+            pval = pval_from_null(group.r2.to_numpy(), r2_group.r2.to_numpy())
+        else:
+            null_dist = group.sort_values('iternum', kind='stable').r2.to_numpy(dtype=float)
+            pval = sequential_pval_from_null(null_dist, float(r2_group.r2.iloc[0]), h, batch_size=batch_size)
         pvals.append(pval)
         names.append(name)
 
@@ -402,6 +1185,135 @@ def get_shuff_pvals(shuff, r2_df, groups=['exp_group', 'exp_name', 'taste', 'ses
     return pval_df
 
 
+def besag_clifford_pval(n_exceed, n_iter, h):
+    """
+    Besag-Clifford p-value: n_exceed/n_iter for a null that stopped once it
+    had h draws at least as extreme as the observed value, and
+    (n_exceed + 1)/(n_iter + 1) for one that ran out of draws first, so a
+    group without exceedances gets 1/(n_iter + 1) rather than 0. NaN where
+    n_iter is 0.
+    """
+    n_exceed = np.asarray(n_exceed, dtype=float)
+    n_iter = np.asarray(n_iter, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pval = np.where(n_exceed >= h, n_exceed / n_iter, (n_exceed + 1) / (n_iter + 1))
+    return np.where(n_iter > 0, pval, np.nan)
+
+
+def sequential_pval_from_null(null_dist, test_stat, h, batch_size=100):
+    """
+    The p-value sequential_shuffle_pvals reports for a group whose null
+    draws, in iternum order, are null_dist: the tail is set by the mean of
+    the first batch_size draws and the exceedances are counted up to the
+    first batch end where they reach h (see besag_clifford_pval).
+    """
+    null_dist = np.asarray(null_dist, dtype=float)
+    n = len(null_dist)
+    if np.nanmean(null_dist[:batch_size]) < test_stat:
+        exceed = np.cumsum(null_dist >= test_stat)
+    else:
+        exceed = np.cumsum(null_dist <= test_stat)
+    ends = np.minimum(np.arange(batch_size, n + batch_size, batch_size), n)
+    stop = np.flatnonzero(exceed[ends - 1] >= h)
+    n_iter = ends[stop[0]] if len(stop) > 0 else n
+    return float(besag_clifford_pval(exceed[n_iter - 1], n_iter, h))
+
+
+def sequential_shuffle_pvals(data, subject_cols=['Subject'], trial_col='Trial', value_col='Value', yMin=None,
+                             yMax=None, obs_r2=None, alpha=0.05, h=10, max_iter=10000, batch_size=100,
+                             solver='varpro', seed=None, verbose=False):
+    """
+    Permutation p-values for the r2 of each group with Besag-Clifford
+    sequential stopping. Each group's null distribution is grown in batches
+    of batch_size shuffles with the array engine, and a group stops once h
+    null r2 values are at least as extreme as its observed r2. Such a group
+    has p = h/L > alpha as soon as it stops before L = h/alpha iterations.
+    Groups that never reach h exceedances run to max_iter and get
+    p = (n_exceed + 1)/(max_iter + 1) (see besag_clifford_pval).
+
+    As in pval_from_null, the tail is the one away from the null mean, which
+    is fixed after the first batch.
+
+    A group's permutation at each iternum is the one shuffle_null_dist draws
+    with the same seed, whichever groups are still running, so the p-values
+    can be reproduced with get_shuff_pvals(..., h=h, batch_size=batch_size)
+    on a shuffle_null_dist null of max_iter iterations.
+
+    Args:
+    obs_r2 (dict): observed r2 per group as returned by nonlinear_regression.
+        It is computed with the same solver if None
+    alpha (float): significance level, used only to report significant
+    h (int): number of exceedances after which a group stops
+    verbose (bool): print progress after each batch
+
+    Returns:
+    tuple: (pval_df, iters) where pval_df has subject_cols, r2, pval, n_iter,
+        n_exceed, stopped_early and significant, and iters holds the null
+        draws in the iter_shuffle layout
+    """
+    enc = encode_shuffle_groups(data, subject_cols=subject_cols, trial_col=trial_col, value_col=value_col, yMin=yMin,
+                                yMax=yMax)
+    if obs_r2 is None:
+        _, obs_r2, _ = nonlinear_regression(data, subject_cols=subject_cols, trial_col=trial_col, value_col=value_col,
+                                            yMin=yMin, yMax=yMax, solver=solver)
+    if seed is None:
+        seed = int(np.random.default_rng().integers(2**32))
+    obs = np.array([obs_r2[k] for k in enc['keys']], dtype=float)
+    n_groups, n_trials = enc['trials'].shape
+    n_iter = np.zeros(n_groups, dtype=int)
+    n_exceed = np.zeros(n_groups, dtype=int)
+    upper_tail = None
+    active = enc['valid'] & np.isfinite(obs)
+
+    null_rows = []
+    start = 0
+    while np.any(active) and start < max_iter:
+        n_batch = min(batch_size, max_iter - start)
+        sub = subset_encoding(enc, active)
+        idx = np.flatnonzero(active)
+        block_size = default_block_size(len(idx), n_trials, n_batch)
+        params, r2 = [], []
+        for block_start in range(start, start + n_batch, block_size):
+            iternums = np.arange(block_start, min(block_start + block_size, start + n_batch))
+            prm, r = fit_permutation_block(sub, seed, iternums, solver=solver)
+            params.append(prm)
+            r2.append(r)
+        params = np.concatenate(params)
+        r2 = np.concatenate(r2)
+
+        n_iter[idx] += n_batch
+        if upper_tail is None:
+            upper_tail = np.zeros(n_groups, dtype=bool)
+            upper_tail[idx] = np.nanmean(r2, axis=0) < obs[idx]
+        with np.errstate(invalid='ignore'):
+            exceed = np.where(upper_tail[idx], r2 >= obs[idx], r2 <= obs[idx])
+        n_exceed[idx] += exceed.sum(axis=0)
+        null_rows.append((np.repeat(np.arange(start, start + n_batch), len(idx)), np.tile(idx, n_batch),
+                          params.reshape(-1, 3), r2.reshape(-1)))
+
+        active[idx] = n_exceed[idx] < h
+        start += n_batch
+        if verbose:
+            print('iter ' + str(start) + ' of ' + str(max_iter) + ', ' + str(np.sum(active)) + ' groups still running')
+
+    pvals = besag_clifford_pval(n_exceed, n_iter, h)
+    keys = pd.DataFrame([k if isinstance(k, tuple) else (k,) for k in enc['keys']], columns=subject_cols)
+    pval_df = keys.copy()
+    pval_df['r2'] = obs
+    pval_df['pval'] = pvals
+    pval_df['n_iter'] = n_iter
+    pval_df['n_exceed'] = n_exceed
+    pval_df['stopped_early'] = (n_exceed >= h) & (n_iter < max_iter)
+    pval_df['significant'] = pvals <= alpha
+
+    if len(null_rows) > 0:
+        iternum, group, params, r2 = [np.concatenate(x) for x in zip(*null_rows)]
+        iters = shuffle_frame(keys.iloc[group], params, r2, iternum)
+    else:
+        iters = shuffle_frame(keys.iloc[[]], np.zeros((0, 3)), [], [])
+    return pval_df, iters
+
+
 exp_group_index = {'naive': 0, 'suc_preexp': 1, 'sucrose preexposed': 1, 'sucrose pre-exposed': 1}
 taste_index = {'Suc': 0, 'NaCl': 1, 'CA': 2, 'QHCl': 3}
 session_index = {1: 0, 2: 1, 3: 2}
@@ -621,7 +1533,7 @@ def mean_resample(col):
     s = resample(col)
     return np.nanmean(s)
 
-def calc_boot(group, trial_col, nIter=100, parallel=False):
+def calc_boot(group, trial_col, nIter=100):
     unique_trials = np.sort(group[trial_col].unique())
     trial = []
     models = []
@@ -635,30 +1547,18 @@ def calc_boot(group, trial_col, nIter=100, parallel=False):
         models.append(model(unique_trials, alpha[0], beta[0], c[0]))
     models = np.vstack(models)
     model_mean = np.nanmean(models, axis=0)
-    # for each column in models, bootstrap the 95% ci
-    boot_mean = []
-    boot_low = []
-    boot_high = []
-
-    for col in models.T:
-        if parallel:
-            samples = Parallel(n_jobs=-1)(delayed(mean_resample)(col) for i in range(nIter))
-        else:
-            samples = []
-            for iter in range(nIter):
-                sample = resample(col)
-                samples.append(np.nanmean(sample))
-        boot_mean.append(np.nanmean(samples))
-        bootci = np.nanpercentile(samples, [2.5, 97.5])
-        boot_low.append(bootci[0])
-        boot_high.append(bootci[1])
+    # bootstrap the 95% ci of every column of models at once
+    boot = bootstrap_kernel(models, n_boot=nIter)
+    boot_mean = list(boot['mean'])
+    boot_low = list(boot['ci'][0])
+    boot_high = list(boot['ci'][1])
 
     return boot_mean, boot_low, boot_high
 
 
-def plot_boot(ax, nm, group, color, trial_col='session_trial', shade_alpha=0.2, nIter=100, parallel=False):
+def plot_boot(ax, nm, group, color, trial_col='session_trial', shade_alpha=0.2, nIter=100):
     unique_trials = np.sort(group[trial_col].unique())
-    boot_mean, boot_low, boot_high = calc_boot(group, trial_col, nIter=nIter, parallel=parallel)
+    boot_mean, boot_low, boot_high = calc_boot(group, trial_col, nIter=nIter)
     ax.fill_between(unique_trials, boot_low, boot_high, alpha=shade_alpha, color=color)
     ax.plot(unique_trials, boot_mean, alpha=1, color=color, linewidth=2)
 
@@ -671,19 +1571,19 @@ def plot_scatter(ax, group, color, dat_col, trial_col='session_trial', dotalpha=
 
 
 def plot_shuff(ax, group, trials, color, linestyle):
-    # for each model in group, model data using column params:
-    models = []
-    for i, row in group.iterrows():
-        params = row['params']
-        models.append(model(trials, *params))
-    models = np.vstack(models)
+    # model data for every row of group at once from the alpha, beta and c columns
+    if 'params' in group.columns:
+        group = shuffle_to_columnar(group)
+    trials = np.asarray(trials, dtype=float)
+    models = model(trials[None, :], group['alpha'].to_numpy(dtype=float)[:, None],
+                   group['beta'].to_numpy(dtype=float)[:, None], group['c'].to_numpy(dtype=float)[:, None])
     model_mean = np.nanmean(models, axis=0)
     ax.plot(trials, model_mean, alpha=1, color=color, linestyle=linestyle, linewidth=1.5)
 
 #plots the line graph of the average model for each session, with the data points overlaid, and the 95% confidence interval for the model
 def plot_fits_summary_avg(df, shuff_df, trial_col='session_trial', dat_col='pr(mode state)', time_col='session',
                           save_dir=None, use_alpha_pos=False, dotalpha=0.1, textsize=12, flag=None, nIter=100,
-                          parallel=True, r2df=None, yMin=None, yMax=None):
+                          r2df=None, yMin=None, yMax=None):
     unique_trials = np.sort(df[trial_col].unique())
     unique_exp_groups = df['exp_group'].unique()
     unique_exp_names = df['exp_name'].unique()
@@ -717,7 +1617,7 @@ def plot_fits_summary_avg(df, shuff_df, trial_col='session_trial', dat_col='pr(m
         fig, axes = plt.subplots(1, n_time_groups, sharex=True, sharey=True, figsize=(10, 5))
         legend_handles = []
         # plot shuffled data:
-        for nm, group in shuff_df.groupby([time_col, 'session_index', 'exp_group', 'exp_group_index']):
+        for nm, group in shuff_df.groupby([time_col, 'session_index', 'exp_group', 'exp_group_index'], observed=True):
             ax = axes[nm[1]]
             linestyle = shuff_linestyles[nm[3]]
             plot_shuff(ax, group, color='gray', trials=unique_trials, linestyle=linestyle)
@@ -736,7 +1636,7 @@ def plot_fits_summary_avg(df, shuff_df, trial_col='session_trial', dat_col='pr(m
         for nm, group in plot_df.groupby(['session', 'session_index', 'exp_group', 'exp_group_index']):
             ax = axes[nm[1]]
             color = pal[nm[3]]
-            plot_boot(ax, nm, group, color=color, nIter=nIter, trial_col=trial_col, parallel=parallel)
+            plot_boot(ax, nm, group, color=color, nIter=nIter, trial_col=trial_col)
 
             if nm[1] == 0:
                 legend_handle = mlines.Line2D([], [], color=color, marker='o', linestyle='None', label=nm[2], alpha=1)
@@ -825,11 +1725,8 @@ def bootstrap_mean_ci(data, n_bootstrap=100, ci=95):
     low = (100 - ci) / 2
     high = 100 - low
 
-    bootstrap_means = np.array(
-        [np.nanmean(np.random.choice(data, size=len(data), replace=True)) for _ in range(n_bootstrap)])
-    lower_bound = np.nanpercentile(bootstrap_means, low)
-    upper_bound = np.nanpercentile(bootstrap_means, high)
-    return np.nanmean(bootstrap_means), lower_bound, upper_bound
+    boot = bootstrap_kernel(np.asarray(data).ravel(), n_boot=n_bootstrap, percentiles=(low, high))
+    return boot['mean'], boot['ci'][0], boot['ci'][1]
 
 def plot_bars(ax, r2_data, shuff_r2_data, label, bar_pos, bar_width, nIter, indices, color, textsize, n_comp=1, two_tailed=False, boot_data=True):
     #get the lower 0.025 and upper 0.975 percentiles for the shuff_r2
@@ -1350,55 +2247,172 @@ def plot_null_dist(avg_shuff, r2_df_groupmean, save_flag=None, save_dir=None):
             savename = '/' + save_flag + '_r2_perm_test.png'
         plt.savefig(save_dir + savename)
 
-def preprocess_nonlinear_regression(df, subject_col, group_cols, trial_col, value_col, yMin=None, yMax=None, parallel=True, overwrite=False, nIter=10000, save_dir=None, flag=None):
+def map_group_values(df, values, groupings):
+    """
+    Looks up the entry of values (a dict keyed by group, as returned by
+    nonlinear_regression) for every row of df in one pass, using the group
+    codes of df.groupby(groupings) instead of per-row lookups.
+
+    Returns:
+    np.array: N x k values per row (k = 1 for scalar entries), NaN for rows
+        whose group is missing from values or has a NaN key
+    """
+    gb = df.groupby(groupings)
+    codes = gb.ngroup().to_numpy()
+    entries = []
+    for key in gb.size().index:
+        if not isinstance(key, tuple):
+            key = (key,)
+        if key not in values and len(key) == 1:
+            key = key[0]
+        entries.append(np.atleast_1d(np.asarray(values.get(key, np.nan), dtype=float)))
+    width = max([len(e) for e in entries], default=1)
+    # the extra last row stays NaN: groupby gives rows with NaN keys code -1
+    table = np.full((len(entries) + 1, width), np.nan)
+    for i, e in enumerate(entries):
+        if len(e) == width:
+            table[i] = e
+    return table[codes]
+
+
+def add_model_columns(df, params, groupings, trial_col, r2=None, model_col='modeled'):
+    """
+    Adds the fitted alpha, beta and c of each row's group (and r2 if given)
+    to df, and evaluates model for all rows at once into model_col. Rows
+    with a NaN group key are dropped, as the inner merge used before did.
+    """
+    df = df.loc[df.groupby(groupings).ngroup().to_numpy() >= 0].reset_index(drop=True)
+    prm = map_group_values(df, params, groupings)
+    df['alpha'] = prm[:, 0]
+    df['beta'] = prm[:, 1]
+    df['c'] = prm[:, 2]
+    if r2 is not None:
+        df['r2'] = map_group_values(df, r2, groupings)[:, 0]
+    df[model_col] = model(df[trial_col].to_numpy(dtype=float), prm[:, 0], prm[:, 1], prm[:, 2])
+    return df
+
+
+def preprocess_nonlinear_regression(df, subject_col, group_cols, trial_col, value_col, yMin=None, yMax=None, parallel=True, overwrite=False, nIter=10000, save_dir=None, flag=None, solver='curve_fit'):
     groupings = [subject_col] + group_cols
     params, r2, y_pred = nonlinear_regression(df, subject_cols=groupings, trial_col=trial_col, value_col=value_col,
-                                                 parallel=parallel, yMin=yMin, yMax=yMax)
-    r2_df = pd.Series(r2).reset_index()  # turn dict into a series with multi-index
-    r2_df = r2_df.reset_index(drop=True)  # reset the index so it becomes a dataframe
-    colnames = groupings + ['r2']
-    column_mapping = dict(zip(r2_df.columns, colnames))
-    r2_df = r2_df.rename(columns=column_mapping)
-
-    identifiers = []
-    alpha = []
-    beta = []
-    c = []
-    for i, group in df.groupby(groupings):
-        pr = params[i]
-        identifiers.append(i)
-        alpha.append(pr[0])
-        beta.append(pr[1])
-        c.append(pr[2])
-
-    ids_df = pd.DataFrame(identifiers, columns=groupings)
-    params_df = ids_df.copy()
-    params_df['alpha'] = alpha
-    params_df['beta'] = beta
-    params_df['c'] = c
-
-    # merge the params with df
-    df2 = df.merge(params_df, on=groupings)
-    df3 = df2.merge(r2_df, on=groupings)
-    # for each row of df3, get the modeled value for that row, by passing the trial number and alpha, beta, c values to the model function
-    modeled = []
-    for i, row in df3.iterrows():
-        pr = row[['alpha', 'beta', 'c']]
-        mod = model(row[trial_col], *pr)
-        modeled.append(mod)
-    df3['modeled'] = modeled
+                                                 parallel=parallel, yMin=yMin, yMax=yMax, solver=solver)
+    df3 = add_model_columns(df, params, groupings, trial_col, r2=r2)
     # get the null distribution of r2 values
     shuffle = iter_shuffle(df3, nIter=nIter, subject_cols=groupings, trial_col=trial_col, value_col=value_col,
                             yMin=yMin, yMax=yMax,
-                            save_dir=save_dir, overwrite=overwrite, parallel=parallel, flag=flag)
+                            save_dir=save_dir, overwrite=overwrite, parallel=parallel, flag=flag, solver=solver)
 
     if shuffle is [] or shuffle is None:
         raise ValueError('shuffle is None')
     return df3, shuffle
 
+def preprocess_nonlinear_regression_multi(df, subject_col, group_cols, trial_cols, value_cols, yMin=None, yMax=None,
+                                          parallel=True, overwrite=False, nIter=10000, save_dir=None, flag=None,
+                                          solver='varpro', seed=None, chunk_size=500):
+    """
+    preprocess_nonlinear_regression for every combination of trial_cols and
+    value_cols at once. The groups of each (trial_col, value_col) target are
+    encoded once and all targets are stacked (stack_encodings), so the
+    observed fits and each block of permutations are fit for all targets in
+    one batch, and a group shares its permutation draws across targets.
+    Each target still gets its own null distribution file, index entry and
+    checkpoints (see iter_shuffle), so an interrupted run resumes only the
+    targets that are missing iterations.
+
+    Rows with a missing trial or value are dropped per target. Because draws
+    are shared, the null distributions of different targets are correlated
+    with each other, but each one on its own is the same permutation null as
+    from iter_shuffle.
+
+    Args:
+    trial_cols (list): trial columns, e.g. ['taste_trial', 'session_trial']
+    value_cols (list): value columns to fit against each trial column
+    yMin, yMax (float or dict): bounds of the fitted values, or a dict of
+        bounds keyed by value column
+    solver (str): 'varpro' or 'batched', the array engine solvers
+    seed (int): seed for the permutations, drawn at random if None
+
+    Returns:
+    dict: (trial_col, value_col) -> (df3, shuffle) as returned by
+        preprocess_nonlinear_regression
+    """
+    if solver not in ('varpro', 'batched'):
+        raise ValueError("solver must be 'varpro' or 'batched', got " + str(solver))
+    groupings = [subject_col] + group_cols
+    targets = [(trial_col, value_col) for trial_col in trial_cols for value_col in value_cols]
+
+    def bound(b, value_col):
+        return b.get(value_col) if isinstance(b, dict) else b
+
+    datas, encs = [], []
+    for trial_col, value_col in targets:
+        data = df.dropna(subset=[trial_col, value_col])
+        datas.append(data)
+        encs.append(encode_shuffle_groups(data, subject_cols=groupings, trial_col=trial_col, value_col=value_col,
+                                          yMin=bound(yMin, value_col), yMax=bound(yMax, value_col)))
+    enc = stack_encodings(encs)
+
+    # observed fits of all targets in one batch
+    valid = enc['valid']
+    params = np.full((len(valid), 3), np.nan)
+    r2 = np.full(len(valid), np.nan)
+    if np.any(valid):
+        params[valid] = fit_arrays(enc['trials'][valid], enc['values'][valid], enc['mask'][valid],
+                                   enc['lower'][valid], enc['upper'][valid], solver=solver)
+        r2[valid] = r2_arrays(enc['trials'][valid], enc['values'][valid], enc['mask'][valid], params[valid])
+    df3s = []
+    for i, ((trial_col, value_col), data) in enumerate(zip(targets, datas)):
+        rows = np.flatnonzero(enc['target'] == i)
+        df3s.append(add_model_columns(data, {enc['keys'][j]: params[j] for j in rows}, groupings, trial_col,
+                                      r2={enc['keys'][j]: r2[j] for j in rows}))
+
+    # null distributions
+    if save_dir is None:
+        nds = None
+        n_done = np.zeros(len(targets), dtype=int)
+    else:
+        nds = [open_null_dist(df3, groupings, trial_col, value_col, save_dir, yMin=bound(yMin, value_col),
+                              yMax=bound(yMax, value_col), solver=solver, seed=seed, flag=flag, overwrite=overwrite)
+               for df3, (trial_col, value_col) in zip(df3s, targets)]
+        n_done = np.array([nd['n_done'] for nd in nds])
+    run_seed = int(np.random.default_rng().integers(2**32)) if seed is None else seed
+    keys = pd.DataFrame([k if isinstance(k, tuple) else (k,) for k in enc['keys']], columns=groupings)
+
+    # subset_encoding keeps each group's draws, so an iternum gets the same draws whichever targets are still running
+    chunks = [[] for _ in targets]
+    for start in range(int(n_done.min()), nIter, chunk_size):
+        stop = min(start + chunk_size, nIter)
+        active = np.flatnonzero(n_done < stop)
+        keep = np.isin(enc['target'], active)
+        sub = subset_encoding(enc, keep)
+        print('targets ' + str(active.tolist()) + ', iters ' + str(start) + ' to ' + str(stop) + ' of ' + str(nIter))
+        prm, r = permutation_blocks(sub, run_seed, start, stop, solver=solver, parallel=parallel)
+        rows = np.flatnonzero(keep)
+        for i in active:
+            cols = np.flatnonzero(enc['target'][rows] == i)
+            first = max(start, n_done[i]) - start
+            n_perm = stop - start - first
+            chunk = shuffle_frame(keys.iloc[np.tile(rows[cols], n_perm)],
+                                  prm[first:, cols].reshape(-1, 3), r[first:, cols].reshape(-1),
+                                  np.repeat(np.arange(start + first, stop), len(cols)))
+            if nds is None:
+                chunks[i].append(chunk)
+            else:
+                write_null_chunk(nds[i], chunk, start + first, stop)
+
+    results = {}
+    for i, target in enumerate(targets):
+        if nds is None:
+            shuffle = pd.concat(chunks[i], ignore_index=True)
+        else:
+            shuffle = close_null_dist(nds[i], nIter)
+        results[target] = (df3s[i], shuffle)
+    return results
+
+
 def plot_nonlinear_regression_stats(df3, shuff, subject_col, group_cols, trial_col, value_col, flag=None, nIter=100, textsize=20, ymin=None, ymax=None, save_dir=None):
     groups = [subject_col] + group_cols
-    avg_shuff = shuff.groupby(groups + ['iternum']).mean().reset_index() #average across exp_names
+    avg_shuff = shuff.groupby(groups + ['iternum'], observed=True).mean().reset_index() #average across exp_names
     avg_df3 = df3.groupby(groups).mean().reset_index() #trial average df3
 
     for exp_group, group in avg_df3.groupby(['exp_group']):
@@ -1410,37 +2424,34 @@ def plot_nonlinear_regression_stats(df3, shuff, subject_col, group_cols, trial_c
             save_flag = trial_col + '_' + value_col + '_' + exp_group + '_only'
         plot_r2_pval_summary(avg_group_shuff, group, save_flag=save_flag, save_dir=save_dir, textsize=textsize, nIter=nIter, n_comp=3, ymin=ymin, ymax=ymax)
 
-def get_session_differences(df3, shuff, stat_col='r2'):
+def pairwise_session_differences(df, group_columns, stat_col='r2', session_col='session'):
+    """
+    For each group, the difference in stat_col between every pair of rows
+    ordered by session (earlier minus later), labelled 'Session Difference'
+    as '<session i>-<session j>'. Done with one self-merge instead of a loop
+    per group.
+    """
     diff_col = stat_col + ' difference'
-    #make a new dataframe called day_diffs that contains the difference in r2 between day 1 and day 2, and day 1 and day 3, and day 2 and day 3
-    def calculate_differences(group_name, group_df):
-        results = []
-        for i in range(len(group_df) - 1):
-            for j in range(i + 1, len(group_df)):
-                diff = group_df.iloc[i][stat_col] - group_df.iloc[j][stat_col]
-                session_diff = f"{group_df.iloc[i]['session']}-{group_df.iloc[j]['session']}"
-                results.append({'Group': group_name, 'Session Difference': session_diff, diff_col: diff})
-        return results
-
-    group_columns = ['exp_group', 'exp_name', 'taste']
-    grouped = df3.groupby(group_columns)
-    results = Parallel(n_jobs=-1)(delayed(calculate_differences)(group_name, group_df.sort_values('session')) for group_name, group_df in grouped)
-    flat_results = [item for sublist in results for item in sublist]
-    r2_diffs = pd.DataFrame(flat_results)
-    expanded_groups = pd.DataFrame(r2_diffs['Group'].tolist(), columns=group_columns)
-    # Concatenate the new columns with the original DataFrame
-    r2_diffs = pd.concat([expanded_groups, r2_diffs.drop('Group', axis=1)], axis=1)
-
-    # Apply function to shuff_r2_df
-    group_columns = ['exp_group', 'exp_name', 'taste', 'iternum']
-    grouped = shuff.groupby(group_columns)
-    results = Parallel(n_jobs=-1)(delayed(calculate_differences)(group_name, group_df.sort_values('session')) for group_name, group_df in grouped)
-    flat_results = [item for sublist in results for item in sublist]
-    shuff_r2_diffs = pd.DataFrame(flat_results)
-    expanded_groups = pd.DataFrame(shuff_r2_diffs['Group'].tolist(), columns=group_columns)
-    # Concatenate the new columns with the original DataFrame
-    shuff_r2_diffs = pd.concat([expanded_groups, shuff_r2_diffs.drop('Group', axis=1)], axis=1)
-    shuff_r2_diffs = shuff_r2_diffs.groupby(['Session Difference', 'exp_group', 'taste', 'iternum']).mean().reset_index()
+    df = df.dropna(subset=group_columns).sort_values(group_columns + [session_col], kind='stable')
+    df = df[group_columns + [session_col, stat_col]].reset_index(drop=True)
+    df['pos'] = df.groupby(group_columns, observed=True).cumcount()
+    pairs = df.merge(df, on=group_columns, suffixes=('_i', '_j'))
+    pairs = pairs[pairs['pos_i'] < pairs['pos_j']].sort_values(group_columns + ['pos_i', 'pos_j'], kind='stable')
+    out = pairs[group_columns].reset_index(drop=True)
+    out['Session Difference'] = (pairs[session_col + '_i'].astype(str) + '-' +
+                                 pairs[session_col + '_j'].astype(str)).to_numpy()
+    out[diff_col] = (pairs[stat_col + '_i'].astype(float) - pairs[stat_col + '_j'].astype(float)).to_numpy()
+    return out
+
+
+def get_session_differences(df3, shuff, stat_col='r2'):
+    #difference in stat_col between each pair of sessions, for the data and for each shuffle iteration
+    r2_diffs = pairwise_session_differences(df3, ['exp_group', 'exp_name', 'taste'], stat_col=stat_col)
+
+    shuff_r2_diffs = pairwise_session_differences(shuff, ['exp_group', 'exp_name', 'taste', 'iternum'],
+                                                  stat_col=stat_col)
+    shuff_r2_diffs = shuff_r2_diffs.groupby(['Session Difference', 'exp_group', 'taste', 'iternum'],
+                                            observed=True).mean(numeric_only=True).reset_index()
     return r2_diffs, shuff_r2_diffs
 
 def plot_session_differences(df3, shuff, subject_col, group_cols, trial_col, value_col, stat_col=None, flag=None, nIter=100, textsize=20, ymin=None, ymax=None, save_dir=None):
@@ -1461,26 +2472,17 @@ def get_pred_change(df3, shuff, subject_col, group_cols, trial_col):
     groups = [subject_col] + group_cols
     trials = df3[trial_col].unique()
 
-    avg_df3 = df3.groupby(groups).mean().reset_index() #trial average df3
-    def add_pred_change(df):
-        pred_change = []
-        for i, row in df.iterrows():
-            params = row[['alpha', 'beta', 'c']]
-            pred_change.append(calc_pred_change(trials, params))
-        df['pred. change'] = pred_change
-        return df
-
-    pred_change_df = add_pred_change(avg_df3)
-
-    pred_change_shuff = []
-    for i, row in shuff.iterrows():
-        params = row['params']
-        pred_change_shuff.append(calc_pred_change(trials, params))
-    shuff['pred. change'] = pred_change_shuff
+    pred_change_df = df3.groupby(groups).mean(numeric_only=True).reset_index() #trial average df3
+    pred_change_df['pred. change'] = calc_pred_change_columns(trials, pred_change_df['alpha'], pred_change_df['beta'],
+                                                              pred_change_df['c'])
+
+    shuff = shuffle_to_columnar(shuff)
+    shuff['pred. change'] = calc_pred_change_columns(trials, shuff['alpha'], shuff['beta'], shuff['c'])
     return pred_change_df, shuff
+
 def plot_predicted_change(pred_change_df, pred_change_shuff, group_cols, trial_col, value_col, flag=None, nIter=100, textsize=20, ymin=None, ymax=None, save_dir=None):
 
-    avg_shuff = pred_change_shuff.groupby(group_cols + ['iternum']).mean().reset_index()
+    avg_shuff = pred_change_shuff.groupby(group_cols + ['iternum'], observed=True).mean().reset_index()
 
     if flag is not None:
         save_flag = trial_col + '_' + value_col + '_' + flag
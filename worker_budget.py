@@ -0,0 +1,118 @@
+import os
+import threading
+import multiprocessing
+import functools
+import joblib
+
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+
+# total number of worker processes any one Parallel/Pool call may start. Can
+# be lowered for a shared machine with the EXPERIENCE_ANALYSIS_MAX_WORKERS
+# environment variable or set_max_workers
+MAX_WORKERS = int(os.environ.get('EXPERIENCE_ANALYSIS_MAX_WORKERS', joblib.cpu_count()))
+
+# BLAS/OpenMP threads allowed inside each worker
+WORKER_BLAS_THREADS = int(os.environ.get('EXPERIENCE_ANALYSIS_WORKER_BLAS_THREADS', 1))
+
+# workers are marked explicitly when they start a task (worker_init,
+# _run_in_worker). Nothing is put in the environment, so scripts launched
+# with subprocess from an analysis process still get the full budget
+_state = threading.local()
+_worker = {'flag': False}
+_pinned = {'pid': None}
+
+
+def set_max_workers(n):
+    '''set the total worker budget for this process and the workers it starts'''
+    global MAX_WORKERS
+    MAX_WORKERS = max(1, int(n))
+    os.environ['EXPERIENCE_ANALYSIS_MAX_WORKERS'] = str(MAX_WORKERS)
+
+
+def in_worker():
+    '''True inside a worker process or thread started through this module'''
+    return getattr(_state, 'depth', 0) > 0 or _worker['flag']
+
+
+def get_n_jobs(n_jobs=-1, n_tasks=None):
+    '''number of workers to actually use for a Parallel/Pool call
+
+    Parameters
+    ----------
+    n_jobs : int or None
+        requested workers, with joblib's conventions (None means 1, -1 all
+        cores, -2 all but one, ...)
+    n_tasks : int, optional
+        number of tasks, no more workers than this are started
+
+    Returns
+    -------
+    int, 1 when already inside a worker (no nested parallelism), otherwise
+    n_jobs capped by MAX_WORKERS and n_tasks
+    '''
+    if in_worker() or n_jobs is None:
+        return 1
+    n_jobs = int(n_jobs)
+    if n_jobs < 0:
+        n_jobs = joblib.cpu_count() + 1 + n_jobs
+    n_jobs = min(max(n_jobs, 1), MAX_WORKERS)
+    if n_tasks is not None:
+        n_jobs = min(n_jobs, max(int(n_tasks), 1))
+    return n_jobs
+
+
+def pin_blas_threads(n_threads=None):
+    '''limit BLAS/OpenMP threads in the current process, once per process'''
+    if n_threads is None:
+        n_threads = WORKER_BLAS_THREADS
+    if _pinned['pid'] == os.getpid():
+        return
+    _pinned['pid'] = os.getpid()
+    for var in ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']:
+        os.environ[var] = str(n_threads)
+    if threadpool_limits is not None:
+        threadpool_limits(limits=n_threads)
+
+
+def worker_init(*args):
+    '''multiprocessing.Pool initializer: marks the process as a worker and
+    pins its BLAS threads'''
+    _worker['flag'] = True
+    pin_blas_threads()
+
+
+def _run_in_worker(func, *args, **kwargs):
+    if multiprocessing.parent_process() is not None:
+        # a worker process (joblib/loky or multiprocessing), not a thread
+        _worker['flag'] = True
+        pin_blas_threads()
+    _state.depth = getattr(_state, 'depth', 0) + 1
+    try:
+        return func(*args, **kwargs)
+    finally:
+        _state.depth -= 1
+
+
+def delayed(func):
+    '''joblib.delayed that runs func as a budgeted worker: nested
+    get_n_jobs/Parallel calls inside it run serially and BLAS threads are
+    pinned in worker processes
+    '''
+    return joblib.delayed(functools.partial(_run_in_worker, func))
+
+
+def Parallel(n_jobs=-1, n_tasks=None, **kwargs):
+    '''joblib.Parallel with n_jobs taken from get_n_jobs'''
+    return joblib.Parallel(n_jobs=get_n_jobs(n_jobs, n_tasks), **kwargs)
+
+
+def Pool(processes=None, n_tasks=None, **kwargs):
+    '''multiprocessing.Pool with processes taken from get_n_jobs and BLAS
+    threads pinned in every worker
+    '''
+    if processes is None:
+        processes = -1
+    return multiprocessing.Pool(processes=get_n_jobs(processes, n_tasks), initializer=worker_init, **kwargs)